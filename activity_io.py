@@ -0,0 +1,218 @@
+import contextlib
+import io
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from activity_schema import ACTIVITY_LOG_DTYPES, apply_schema
+
+FILE_FORMATS = {".csv": "csv", ".parquet": "parquet", ".feather": "feather"}
+CONTENT_TYPES = {"csv": "text/csv", "parquet": "application/octet-stream", "feather": "application/octet-stream"}
+
+# Rows per Parquet row group, which bounds the memory needed to read a file in chunks.
+ROW_GROUP_SIZE = 100000
+
+# Dtypes CSV files are parsed with. Stages and activity types are read as strings, and only then cast by
+# `apply_schema`, since `pd.read_csv` would silently turn values outside of the categories into NaN.
+CSV_DTYPES = {column: "object" if isinstance(dtype, pd.CategoricalDtype) else dtype
+              for column, dtype in ACTIVITY_LOG_DTYPES.items()}
+
+
+def detect_format(file_name):
+    """
+    Detect the format of an activity log file from its extension.
+
+    Args:
+        file_name (str): Name or path of the file.
+
+    Returns:
+        str: One of 'csv', 'parquet' or 'feather'.
+
+    Raises:
+        ValueError: If the extension is not one of FILE_FORMATS.
+
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in FILE_FORMATS:
+        raise ValueError(f"Unsupported file format: {file_name}")
+    return FILE_FORMATS[extension]
+
+
+def read_activity_logs(source, columns=None, chunksize=None, file_format=None):
+    """
+    Read activity logs in the compact schema from a CSV, Parquet or Feather file.
+
+    Args:
+        source (str or file-like): Path or URL of the file, or an open binary file.
+        columns (list): Columns to read. Defaults to all columns.
+        chunksize (int): If set, return an iterator of DataFrames with at most this many rows.
+        file_format (str): Format of the file. Detected from the path if not set.
+
+    Returns:
+        pd.DataFrame or iterator: Activity logs, or an iterator of chunks if chunksize is set.
+
+    Raises:
+        ValueError: If a stage or activity type is not part of the schema, whatever the format.
+
+    """
+    if file_format is None:
+        file_format = detect_format(source)
+
+    if file_format == "csv":
+        reader = pd.read_csv(source, usecols=columns, dtype=CSV_DTYPES, chunksize=chunksize)
+        if chunksize is None:
+            return apply_schema(reader)
+        return _iter_csv_chunks(reader)
+
+    if chunksize is not None:
+        return _iter_arrow_chunks(source, file_format, columns, chunksize)
+
+    if file_format == "parquet":
+        df = pd.read_parquet(source, columns=columns)
+    else:
+        df = pd.read_feather(source, columns=columns)
+    return apply_schema(df)
+
+
+def _iter_csv_chunks(reader):
+    """Yield the chunks of a CSV reader in the compact schema."""
+    with reader:
+        for df in reader:
+            yield apply_schema(df)
+
+
+def _iter_arrow_chunks(source, file_format, columns, chunksize):
+    """Yield chunks of a Parquet or Feather file, indexed by row number like `pd.read_csv` chunks."""
+    if isinstance(source, str):
+        # Imported on first use, as it is only needed for paths and URLs, and slows down cold starts.
+        import fsspec
+
+        opened = fsspec.open(source, "rb")
+    else:
+        opened = contextlib.nullcontext(source)
+
+    with opened as f:
+        if file_format == "parquet":
+            batches = pq.ParquetFile(f).iter_batches(batch_size=chunksize, columns=columns)
+        else:
+            batches = feather.read_table(f, columns=columns).to_batches(max_chunksize=chunksize)
+
+        start = 0
+        for batch in batches:
+            df = apply_schema(batch.to_pandas())
+            df.index = pd.RangeIndex(start, start + len(df))
+            start += len(df)
+            yield df
+
+
+def write_activity_logs(df, destination, file_format=None):
+    """
+    Write activity logs to a CSV, Parquet or Feather file.
+
+    Args:
+        df (pd.DataFrame): Activity logs.
+        destination (str or file-like): Path of the file, or an open binary file.
+        file_format (str): Format of the file. Detected from the path if not set.
+
+    """
+    if file_format is None:
+        file_format = detect_format(destination)
+
+    if file_format == "csv":
+        df.to_csv(destination, index=False)
+    elif file_format == "parquet":
+        df.to_parquet(destination, index=False, row_group_size=ROW_GROUP_SIZE)
+    else:
+        df.reset_index(drop=True).to_feather(destination)
+
+
+def to_bytes(df, file_format):
+    """
+    Serialize activity logs to the contents of a CSV, Parquet or Feather file.
+
+    Args:
+        df (pd.DataFrame): Activity logs.
+        file_format (str): One of 'csv', 'parquet' or 'feather'.
+
+    Returns:
+        bytes: The file contents.
+
+    """
+    buffer = io.BytesIO()
+    write_activity_logs(df, buffer, file_format)
+    return buffer.getvalue()
+
+
+class ActivityLogWriter:
+    """
+    Write activity logs to a CSV, Parquet or Feather file one DataFrame at a time.
+
+    Each DataFrame is appended as it is written, e.g. as a Parquet row group, so the memory
+    used does not grow with the size of the file.
+
+    Args:
+        destination (str or file-like): Path of the file, or an open binary file.
+        file_format (str): Format of the file. Detected from the path if not set.
+
+    """
+
+    def __init__(self, destination, file_format=None):
+        self.file_format = detect_format(destination) if file_format is None else file_format
+        self.rows_written = 0
+
+        self._owns_file = isinstance(destination, str)
+        self._file = open(destination, "wb") if self._owns_file else destination
+        self._writer = None
+        self._csv_header = True
+
+    def write(self, df):
+        """
+        Append activity logs to the file.
+
+        Args:
+            df (pd.DataFrame): Activity logs, with the same columns and dtypes for every call.
+
+        """
+        if self.file_format == "csv":
+            # Encoded here, as pandas writes text to file objects it cannot tell are binary, such as Cloud
+            # Storage writers, which have no mode.
+            self._file.write(df.to_csv(index=False, header=self._csv_header).encode("utf-8"))
+            self._csv_header = False
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                if self.file_format == "parquet":
+                    self._writer = pq.ParquetWriter(self._file, table.schema)
+                else:
+                    options = pa.ipc.IpcWriteOptions(compression="lz4")
+                    self._writer = pa.ipc.new_file(self._file, table.schema, options=options)
+
+            if self.file_format == "parquet":
+                self._writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+            else:
+                self._writer.write_table(table)
+
+        self.rows_written += len(df)
+
+    def close(self):
+        """
+        Finish the file, and close it if it was opened by the writer.
+
+        A file no rows were written to gets the columns of the activity logs, so that it is still a valid file.
+
+        """
+        if self._writer is None and self._csv_header:
+            self.write(pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in ACTIVITY_LOG_DTYPES.items()}))
+        if self._writer is not None:
+            self._writer.close()
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,603 @@
+import functools
+import time
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import take
+
+from activity_schema import ACTIVITY_CONFIG, SCORED_COMPLETIONS
+
+
+class Step:
+    """
+    A pipeline step, declaring the columns it reads and writes.
+
+    Args:
+        name (str): Name of the step, reported in the stage metrics.
+        reads (list): Columns read by the step.
+        writes (list): Columns written by the step.
+        row_wise (bool): Indicates if each output row only depends on the same input row,
+            so that the step gives the same result whether rows are filtered before or after it.
+
+    """
+
+    def __init__(self, name, reads, writes=(), row_wise=True):
+        self.name = name
+        self.reads = list(reads)
+        self.writes = list(writes)
+        self.row_wise = row_wise
+
+
+class Filter(Step):
+    """
+    Keep the rows where `func` is True.
+
+    Args:
+        name (str): Name of the step.
+        reads (list): Columns read by `func`.
+        func (callable): Called with the columns, returns a boolean array.
+
+    """
+
+    def __init__(self, name, reads, func):
+        super().__init__(name, reads)
+        self.func = func
+
+
+class Sort(Step):
+    """
+    Stable sort of the rows on one or more columns.
+
+    Args:
+        name (str): Name of the step.
+        keys (list): Columns to sort on, the first one being the primary key.
+
+    """
+
+    def __init__(self, name, keys):
+        super().__init__(name, keys)
+
+
+class Derive(Step):
+    """
+    Add columns computed from others.
+
+    Args:
+        name (str): Name of the step.
+        reads (list): Columns read by `func`.
+        writes (list): Columns returned by `func`.
+        func (callable): Called with the columns, returns a dict of the new columns.
+        row_wise (bool): Indicates if each new value only depends on the same row.
+
+    """
+
+    def __init__(self, name, reads, writes, func, row_wise=True):
+        super().__init__(name, reads, writes, row_wise)
+        self.func = func
+
+
+def column_values(series):
+    """Get the values of a Series, as an extension array for extension dtypes, and as a NumPy array otherwise."""
+    if isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+        return series.array
+    return series.to_numpy()
+
+
+def sort_key(values):
+    """Get an array sorting like `values` does in `DataFrame.sort_values`, with missing values last."""
+    if isinstance(values, pd.Categorical):
+        codes = values.codes.astype(np.int64)
+        return np.where(codes < 0, len(values.categories), codes)
+    if isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+        return values.to_numpy(dtype=float, na_value=np.nan)
+    return values
+
+
+def packed_key(keys):
+    """
+    Pack integer keys into a single int64 key sorting like they do, by their offsets from their minimums.
+
+    Args:
+        keys (list): Integer arrays, the first one being the primary key.
+
+    Returns:
+        np.ndarray: The packed key, or None if a key is not an integer array or their ranges do not fit.
+
+    """
+    if not all(isinstance(key, np.ndarray) and key.dtype.kind in "iu" for key in keys) or not len(keys[0]):
+        return None
+    bounds = [(int(key.min()), int(key.max())) for key in keys]
+    if np.prod([float(high - low + 1) for low, high in bounds]) >= 2 ** 63:
+        return None
+    packed = np.zeros(len(keys[0]), dtype=np.int64)
+    span = 1
+    for key, (low, high) in zip(keys[::-1], bounds[::-1]):
+        packed += (key.astype(np.int64) - low) * span
+        span *= high - low + 1
+    return packed
+
+
+def sort_order(keys):
+    """Get the order stably sorting rows on some keys, the first one being the primary key."""
+    packed = packed_key(keys)
+    if packed is None:
+        return np.lexsort(keys[::-1])
+    # A single quicksort, several times faster than sorting on each key in turn. Rows with equal keys,
+    # which are rare, are then put back in their input order.
+    order = np.argsort(packed)
+    sorted_keys = packed[order]
+    is_tie = np.zeros(len(order), dtype=bool)
+    is_tie[1:] = sorted_keys[1:] == sorted_keys[:-1]
+    if is_tie.any():
+        is_tie[:-1] |= is_tie[1:]
+        ties = order[is_tie]
+        order[is_tie] = ties[np.lexsort((ties, sorted_keys[is_tie]))]
+    return order
+
+
+def next_row_in_same_group(keys):
+    """
+    Flag the rows whose next row has the same values in every key array.
+
+    Args:
+        keys (list): Arrays identifying a group, with each group in contiguous rows.
+
+    Returns:
+        np.ndarray: Boolean array, False for the last row of every group.
+
+    """
+    num_rows = len(keys[0])
+    same_group = np.zeros(num_rows, dtype=bool)
+    same_group[:-1] = True
+    for values in keys:
+        if isinstance(values, pd.Categorical):
+            values = np.where(values.codes < 0, np.nan, values.codes)
+        elif isinstance(values, pd.api.extensions.ExtensionArray) and pd.api.types.is_numeric_dtype(values.dtype):
+            values = values.to_numpy(dtype=float, na_value=np.nan)
+        values = np.asarray(values)
+        same_group[:-1] &= values[1:] == values[:-1]
+    return same_group
+
+
+def stage_status(stages):
+    """
+    Get the status part of each activity stage, e.g. 'complete' for 'Quiz_complete'.
+    Each distinct stage is split only once, and the statuses are looked up by stage.
+
+    Args:
+        stages (array-like): Activity stages.
+
+    Returns:
+        np.ndarray: Object array of statuses, NaN where the stage is missing.
+
+    """
+    codes, uniques = pd.factorize(stages)
+    # Missing stages are coded as -1, which picks the trailing NaN.
+    statuses = np.array([stage.split("_")[1] for stage in uniques] + [np.nan], dtype=object)
+    return statuses[codes]
+
+
+def optimize(steps):
+    """
+    Move each filter before the steps it does not depend on, and group adjacent filters.
+
+    A filter moves before a sort, and before a row-wise step that does not write any of the
+    columns the filter reads, so that the later steps run on fewer rows.
+
+    Args:
+        steps (list): Steps of a pipeline, in the declared order.
+
+    Returns:
+        list: Groups of steps, in order, with the filters of a group applied as a single mask.
+
+    """
+    steps = list(steps)
+    for i, step in enumerate(steps):
+        if not isinstance(step, Filter):
+            continue
+        j = i
+        while j > 0:
+            previous = steps[j - 1]
+            if not (isinstance(previous, Sort) or isinstance(previous, Derive) and previous.row_wise
+                    and not set(previous.writes) & set(step.reads)):
+                break
+            steps[j - 1], steps[j] = step, previous
+            j -= 1
+
+    groups = []
+    for step in steps:
+        if isinstance(step, Filter) and groups and isinstance(groups[-1][0], Filter):
+            groups[-1].append(step)
+        else:
+            groups.append([step])
+    return groups
+
+
+class Columns:
+    """
+    The columns of a running pipeline, as arrays selected lazily from those of the input frame.
+
+    Filters and sorts only update the selected row positions. Input columns are taken at those
+    positions when first read, so each one is copied at most once per selection, and only if used.
+
+    Args:
+        df (pd.DataFrame): Input DataFrame.
+        names (list): Input columns used by the pipeline.
+
+    """
+
+    def __init__(self, df, names):
+        self.source = {name: column_values(df[name]) for name in names}
+        self.index = df.index
+        self.positions = None
+        self.columns = {}
+        self.num_rows = len(df)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, name):
+        if name not in self.columns:
+            values = self.source[name]
+            self.columns[name] = values if self.positions is None else take(values, self.positions)
+        return self.columns[name]
+
+    def is_shared(self, name):
+        """Indicates if a column is still the array of the input frame, rather than one the pipeline allocated."""
+        return name in self.source and self.columns.get(name) is self.source[name]
+
+    def update(self, columns):
+        self.columns.update(columns)
+
+    def select(self, indexer):
+        """Keep the rows at the given positions of the current rows, in that order."""
+        self.positions = indexer if self.positions is None else self.positions[indexer]
+        self.columns = {name: take(values, indexer) for name, values in self.columns.items()}
+        self.num_rows = len(indexer)
+
+    def keep(self, names):
+        """Release the columns that are not used anymore."""
+        self.source = {name: values for name, values in self.source.items() if name in names}
+        self.columns = {name: values for name, values in self.columns.items() if name in names}
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.columns.values())
+
+    def part(self, start, end):
+        """Get the columns of the rows from `start` to `end`, as views of these."""
+        part = Columns.__new__(Columns)
+        part.source = self.source
+        part.index = self.index
+        part.positions = np.arange(start, end) if self.positions is None else self.positions[start:end]
+        part.columns = {name: values[start:end] for name, values in self.columns.items() if not self.is_shared(name)}
+        part.num_rows = end - start
+        return part
+
+    def frame(self, output):
+        """
+        Build the output frame from the arrays of the pipeline, without copying them again.
+        Arrays shared with the input frame are copied, so that the output never aliases the input.
+
+        Args:
+            output (dict): Output columns, mapped to the pipeline columns they are taken from.
+
+        Returns:
+            pd.DataFrame: The output frame.
+
+        """
+        index = self.index if self.positions is None else self.index.take(self.positions)
+        data = {}
+        for name, column in output.items():
+            values = self[column]
+            data[name] = values.copy() if self.is_shared(column) else values
+        return pd.DataFrame(data, index=index, copy=False)
+
+
+class Pipeline:
+    """
+    Run steps declaring the columns they read and write, in an optimized order.
+
+    Only the input columns used by a step or by the output are read, and every column is
+    released after its last use. Adjacent filters are combined into one mask, and filters and
+    sorts are applied as row positions, so the columns are only copied when they are read.
+
+    Args:
+        steps (list): Steps, in the order they apply.
+        output (dict): Output columns, mapped to the pipeline columns they are taken from.
+        name (str): Name of the pipeline, reported in the stage metrics as the activity.
+
+    """
+
+    def __init__(self, steps, output, name=None):
+        self.groups = optimize(steps)
+        self.output = output
+        self.name = name
+
+        written = set()
+        self.inputs = []
+        for step in [step for group in self.groups for step in group]:
+            self.inputs += [column for column in step.reads if column not in written and column not in self.inputs]
+            written.update(step.writes)
+        self.inputs += [column for column in output.values() if column not in written and column not in self.inputs]
+
+        # Columns still used after each group.
+        self.live = []
+        used = set(output.values())
+        for group in reversed(self.groups):
+            self.live.insert(0, set(used))
+            used.update(column for step in group for column in step.reads)
+
+    def run(self, df, on_stage=None):
+        """
+        Run the pipeline on a DataFrame, which is not modified.
+
+        Args:
+            df (pd.DataFrame): Input DataFrame.
+            on_stage (callable): If set, called after each group of steps with its metrics,
+                as `ActivityProcessor` reports them.
+
+        Returns:
+            pd.DataFrame: Output DataFrame, keeping the index labels of the input rows.
+
+        """
+        return self._run(df, on_stage).frame(self.output)
+
+    def run_partitioned(self, df, key, outputs, on_stage=None):
+        """
+        Run the pipeline on a DataFrame, split by the code of each row once the rows are sorted on it.
+
+        The steps after the `Sort` whose primary key is `key` run on the rows of each code in turn, which fit
+        in the CPU caches better than the rows of every code together. The metrics of such a step are
+        reported once, summed over the codes.
+
+        Args:
+            df (pd.DataFrame): Input DataFrame.
+            key (str): Column of integer codes, the primary key of a `Sort` of the pipeline.
+            outputs (list): Output columns of the rows of each code, from 0 up, mapped to the columns of
+                the pipeline they are taken from.
+            on_stage (callable): If set, called after each group of steps with its metrics.
+
+        Returns:
+            list: Output DataFrame of each code.
+
+        """
+        split = next(i + 1 for i, group in enumerate(self.groups) if isinstance(group[0], Sort)
+                     and group[0].reads[0] == key)
+        used = {key}.union(*(output.values() for output in outputs))
+        columns = Columns(df, self.inputs)
+        self._run_groups(columns, range(split), on_stage, used)
+        bounds = np.searchsorted(columns[key], np.arange(len(outputs) + 1))
+        parts = [columns.part(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+        del columns
+
+        records = []
+        for part in parts:
+            records.append([])
+            self._run_groups(part, range(split, len(self.groups)), None if on_stage is None else records[-1].append,
+                             used)
+        if on_stage is not None:
+            for stage_records in zip(*records):
+                on_stage({**stage_records[0], **{name: sum(record[name] for record in stage_records)
+                                                 for name in ("seconds", "rows_in", "rows_out", "memory_delta")}})
+        return [part.frame(output) for part, output in zip(parts, outputs)]
+
+    def _run(self, df, on_stage):
+        columns = Columns(df, self.inputs)
+        self._run_groups(columns, range(len(self.groups)), on_stage)
+        return columns
+
+    def _run_groups(self, columns, indices, on_stage, used=()):
+        for i in indices:
+            group, live = self.groups[i], self.live[i].union(used)
+            if on_stage is None:
+                self._run_group(group, columns, live)
+                continue
+
+            rows_in, bytes_in = len(columns), columns.nbytes
+            start = time.perf_counter()
+            self._run_group(group, columns, live)
+            on_stage({"stage": "+".join(step.name for step in group), "activity": self.name,
+                      "seconds": time.perf_counter() - start, "rows_in": rows_in, "rows_out": len(columns),
+                      "memory_delta": int(columns.nbytes - bytes_in)})
+
+    @staticmethod
+    def _run_group(group, columns, live):
+        if isinstance(group[0], Filter):
+            mask = group[0].func(columns)
+            for step in group[1:]:
+                mask = mask & step.func(columns)
+            # Released first, so that the columns only read by the filters are not selected.
+            columns.keep(live)
+            if not mask.all():
+                columns.select(np.flatnonzero(mask))
+        elif isinstance(group[0], Sort):
+            keys = [sort_key(columns[key]) for key in group[0].reads]
+            columns.keep(live)
+            columns.select(sort_order(keys))
+        else:
+            columns.update(group[0].func(columns))
+            columns.keep(live)
+
+
+def lead_step(keys, lead_columns):
+    """
+    Step adding the value of the next row of the same group for some columns, on rows sorted by group.
+
+    Args:
+        keys (list): Columns identifying a group.
+        lead_columns (dict): New columns, mapped to the columns their values are taken from.
+
+    Returns:
+        Derive: The step.
+
+    """
+    def add_leads(columns):
+        indexer = np.arange(1, len(columns) + 1)
+        indexer[~next_row_in_same_group([columns[key] for key in keys])] = -1
+        return {lead: take(columns[column], indexer, allow_fill=True) for lead, column in lead_columns.items()}
+
+    return Derive("add_lead_columns", keys + list(lead_columns.values()), list(lead_columns), add_leads,
+                  row_wise=False)
+
+
+def lead_columns(scored):
+    """Get the lead columns of the activities, mapped to the columns their values are taken from."""
+    columns = {'ts_lead': 'timestamp', 'act_stg_lead': 'activity_stage'}
+    if scored:
+        columns['score_lead'] = 'score'
+    return columns
+
+
+def activity_output(scored):
+    """Get the output columns of an activity type, mapped to the pipeline columns they are taken from."""
+    output = {'activity_id': 'activity_id', 'user_id': 'user_id', 'start_timestamp': 'timestamp',
+              'activity_duration': 'activity_duration', 'status': 'status'}
+    if scored:
+        output['score'] = 'score_lead'
+    return output
+
+
+def derive_steps():
+    """Get the steps adding the duration and status of each row, the last ones of every plan."""
+    return [
+        Derive("calculate_activity_duration", ['ts_lead', 'timestamp'], ['activity_duration'],
+               lambda columns: {'activity_duration': columns['ts_lead'] - columns['timestamp']}),
+        Derive("extract_status", ['act_stg_lead'], ['status'],
+               lambda columns: {'status': stage_status(columns['act_stg_lead'])}),
+    ]
+
+
+def is_in(values, allowed):
+    """Flag the values that are one of `allowed`, for NumPy and extension arrays alike."""
+    if isinstance(values, pd.api.extensions.ExtensionArray):
+        return np.asarray(values.isin(allowed))
+    return np.isin(values, allowed)
+
+
+def type_codes(values, categories):
+    """Get the position of each value in `categories`, as small integers, -1 for the other values."""
+    # Each distinct value is looked up only once.
+    if isinstance(values, pd.Categorical):
+        codes, uniques = values.codes, values.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    positions = {category: i for i, category in enumerate(categories)}
+    lookup = np.array([positions.get(value, -1) for value in uniques] + [-1],
+                      dtype=np.min_scalar_type(-len(categories) - 1))
+    return lookup[codes]
+
+
+def activity_plan(activity, scored):
+    """
+    Build the pipeline processing one activity type.
+
+    Args:
+        activity (str): The type of activity to process.
+        scored (bool): Indicates if completions need a score, which is also output.
+
+    Returns:
+        Pipeline: The pipeline.
+
+    """
+    steps = [
+        Filter("filter_activity_type", ['activity_type'], lambda columns: columns['activity_type'] == activity),
+        Sort("sort_dataframe", ['activity_id', 'timestamp']),
+        lead_step(['activity_id'], lead_columns(scored)),
+        # Also removes activities that have started, but not finished.
+        Filter("remove_null_stages", ['act_stg_lead'], lambda columns: ~pd.isnull(columns['act_stg_lead'])),
+    ]
+    if scored:
+        # A completion of any scored type needs a score, as well as one of this type if it is not configured.
+        completions = list(dict.fromkeys(SCORED_COMPLETIONS + [f"{activity}_complete"]))
+        steps.append(Filter("remove_invalid_quiz_rows", ['act_stg_lead', 'score_lead'],
+                            lambda columns: ~(is_in(columns['act_stg_lead'], completions)
+                                              & pd.isnull(columns['score_lead']))))
+    return Pipeline(steps + derive_steps(), activity_output(scored), name=activity)
+
+
+def combined_plan(activities):
+    """
+    Build the pipeline processing several activity types in a single pass.
+
+    The rows of all of the activity types are filtered and sorted once, by type first so that every
+    activity is a contiguous block of rows. Types are handled as 'type_code', their position in
+    `activities`, rather than as strings, so that the sort keys pack into a single integer. The later
+    steps run on the block of each type with `Pipeline.run_partitioned`, whose rows come out in the same
+    order as from the plan of that type alone. The output has the 'score' if any type is scored.
+
+    Args:
+        activities (tuple): The types of activity to process.
+
+    Returns:
+        Pipeline: The pipeline.
+
+    """
+    is_scored_type = np.array([ACTIVITY_CONFIG[activity]["scored"] for activity in activities])
+
+    def is_valid_score(columns):
+        type_code = columns['type_code']
+        if len(type_code) and type_code[0] == type_code[-1]:
+            # The rows are sorted by type, so they are all of the same type.
+            if not is_scored_type[type_code[0]]:
+                return np.ones(len(type_code), dtype=bool)
+            is_scored = True
+        else:
+            is_scored = is_scored_type[type_code]
+        # Within a scored type, a completion of any scored type needs a score.
+        return ~(is_in(columns['act_stg_lead'], SCORED_COMPLETIONS) & pd.isnull(columns['score_lead']) & is_scored)
+
+    scored = bool(is_scored_type.any())
+    steps = [
+        Derive("encode_activity_type", ['activity_type'], ['type_code'],
+               lambda columns: {'type_code': type_codes(columns['activity_type'], activities)}),
+        Filter("filter_activity_type", ['type_code'], lambda columns: columns['type_code'] >= 0),
+        Sort("sort_dataframe", ['type_code', 'activity_id', 'timestamp']),
+        lead_step(['type_code', 'activity_id'], lead_columns(scored)),
+        Filter("remove_null_stages", ['act_stg_lead'], lambda columns: ~pd.isnull(columns['act_stg_lead'])),
+    ]
+    if scored:
+        steps.append(Filter("remove_invalid_quiz_rows", ['type_code', 'act_stg_lead', 'score_lead'],
+                            is_valid_score))
+    return Pipeline(steps + derive_steps(), activity_output(scored))
+
+
+@functools.lru_cache(maxsize=None)
+def get_plan(activity):
+    """
+    Get the pipeline of an activity type, from its configuration.
+
+    Args:
+        activity (str): The type of activity to process.
+
+    Returns:
+        Pipeline: The pipeline.
+
+    Raises:
+        ValueError: If the activity type is not configured in ACTIVITY_CONFIG.
+
+    """
+    if activity not in ACTIVITY_CONFIG:
+        raise ValueError(f"Unknown activity type: {activity}, expected one of {list(ACTIVITY_CONFIG)}")
+    return activity_plan(activity, ACTIVITY_CONFIG[activity]["scored"])
+
+
+@functools.lru_cache(maxsize=None)
+def get_combined_plan(activities):
+    """
+    Get the pipeline processing several activity types in a single pass.
+
+    Args:
+        activities (tuple): The types of activity to process.
+
+    Returns:
+        Pipeline: The pipeline, from `combined_plan`.
+
+    Raises:
+        ValueError: If one of the activity types is not configured in ACTIVITY_CONFIG.
+
+    """
+    for activity in activities:
+        if activity not in ACTIVITY_CONFIG:
+            raise ValueError(f"Unknown activity type: {activity}, expected one of {list(ACTIVITY_CONFIG)}")
+    return combined_plan(activities)
@@ -1,9 +1,28 @@
+import numpy as np
 import pandas as pd
 
+import activity_pipeline
+from activity_pipeline import get_combined_plan, get_plan
+from activity_schema import ACTIVITY_TYPES, SCORED_ACTIVITY_TYPES, SCORED_COMPLETIONS
+
+ACTIVITIES = ACTIVITY_TYPES
+SCORABLE_ACTIVITIES = SCORED_ACTIVITY_TYPES
+
 
 class ActivityProcessor:
-    def __init__(self):
-        pass
+    """
+    Turn raw activity logs into one row per activity stage, with its duration and status.
+
+    Args:
+        on_stage (callable): If set, called after each pipeline step, or group of filters applied
+            together, with a dict of its 'stage' and 'activity', its wall time in 'seconds', its
+            'rows_in' and 'rows_out', and the 'memory_delta' in bytes of the pipeline's columns.
+            When not set, the steps run without any instrumentation.
+
+    """
+
+    def __init__(self, on_stage=None):
+        self.on_stage = on_stage
 
     def filter_activity_type(self, df, activity):
         """
@@ -32,23 +51,72 @@ class ActivityProcessor:
         """
         return df.sort_values(['activity_id', 'timestamp'])
 
-    def add_lead_columns(self, df, is_scorable_activity):
+    @staticmethod
+    def writable(df, inplace):
+        """
+        Get the frame a step adds its columns to.
+
+        Args:
+            df (pd.DataFrame): Input DataFrame.
+            inplace (bool): Indicates if the caller owns `df`, which may then be modified.
+
+        Returns:
+            pd.DataFrame: `df` itself if `inplace`, otherwise a shallow copy sharing its data,
+                so that new columns are not added to the caller's frame or to the frame it is a slice of.
+
+        """
+        return df if inplace else df.copy(deep=False)
+
+    def add_lead_columns(self, df, is_scorable_activity, by='activity_id', presorted=False, inplace=False):
         """
         Add 'ts_lead', 'act_stg_lead', and 'score_lead' columns.
 
+        When the DataFrame is already sorted so that each activity is a contiguous block
+        of rows, the leads are taken from the next row and kept only where that row
+        belongs to the same activity. This avoids a grouped shift altogether.
+
         Args:
             df (pd.DataFrame): Input DataFrame.
+            is_scorable_activity (bool): Indicates if the 'score_lead' column is required.
+            by (str or list): Column(s) identifying a single activity.
+            presorted (bool): Indicates if the rows of each activity are contiguous.
+            inplace (bool): Indicates if the columns are added to `df` itself, which the caller owns.
 
         Returns:
             pd.DataFrame: DataFrame with lead columns.
 
         """
-        df['ts_lead'] = df.groupby('activity_id')['timestamp'].shift(-1)
-        df['act_stg_lead'] = df.groupby('activity_id')['activity_stage'].shift(-1)
+        df = self.writable(df, inplace)
+        lead_columns = {'ts_lead': 'timestamp', 'act_stg_lead': 'activity_stage'}
         if is_scorable_activity:
-            df['score_lead'] = df.groupby('activity_id')['score'].shift(-1)
+            lead_columns['score_lead'] = 'score'
+
+        if presorted:
+            same_activity = self.next_row_in_same_group(df, by)
+            for lead_column, column in lead_columns.items():
+                df[lead_column] = df[column].shift(-1).where(same_activity)
+        else:
+            df_lead = df.groupby(by)[list(lead_columns.values())].shift(-1)
+            for lead_column, column in lead_columns.items():
+                df[lead_column] = df_lead[column]
         return df
 
+    @staticmethod
+    def next_row_in_same_group(df, by):
+        """
+        Flag the rows whose next row has the same values in the group column(s).
+
+        Args:
+            df (pd.DataFrame): Input DataFrame, with each group in contiguous rows.
+            by (str or list): Column(s) identifying a group.
+
+        Returns:
+            np.ndarray: Boolean array, False for the last row of every group.
+
+        """
+        keys = [by] if isinstance(by, str) else by
+        return activity_pipeline.next_row_in_same_group([activity_pipeline.column_values(df[key]) for key in keys])
+
     def remove_null_stages(self, df):
         """
         Remove rows where 'act_stg_lead' is null.
@@ -65,7 +133,8 @@ class ActivityProcessor:
 
     def remove_invalid_quiz_rows(self, df):
         """
-        Remove rows where 'act_stg_lead' is 'Quiz_complete' and 'score_lead' is null.
+        Remove rows where 'act_stg_lead' is the completion of a scored activity type, such as 'Quiz_complete',
+        and 'score_lead' is null.
 
         Args:
             df (pd.DataFrame): Input DataFrame.
@@ -74,39 +143,57 @@ class ActivityProcessor:
             pd.DataFrame: DataFrame with invalid quiz rows removed.
 
         """
-        return df[~(((df['act_stg_lead'] == "Quiz_complete") | (
-                df['act_stg_lead'] == "Challenge_complete")) & pd.isnull(df['score_lead']))]
+        return df[~(df['act_stg_lead'].isin(SCORED_COMPLETIONS) & pd.isnull(df['score_lead']))]
 
-    def calculate_activity_duration(self, df):
+    def calculate_activity_duration(self, df, inplace=False):
         """
         Calculate 'activity_duration' as the difference between 'ts_lead' and 'timestamp'.
 
         Args:
             df (pd.DataFrame): Input DataFrame.
+            inplace (bool): Indicates if the column is added to `df` itself, which the caller owns.
 
         Returns:
             pd.DataFrame: DataFrame with activity duration calculated.
 
         """
+        df = self.writable(df, inplace)
         df['activity_duration'] = df['ts_lead'] - df['timestamp']
 
         return df
 
-    def extract_status(self, df):
+    def extract_status(self, df, inplace=False):
         """
         Extract 'status' from 'act_stg_lead'.
 
         Args:
             df (pd.DataFrame): Input DataFrame.
+            inplace (bool): Indicates if the column is added to `df` itself, which the caller owns.
 
         Returns:
             pd.DataFrame: DataFrame with 'status' column added.
 
         """
-        df['status'] = df['act_stg_lead'].apply(lambda x: x.split("_")[1])
+        df = self.writable(df, inplace)
+        df['status'] = self.stage_status(df['act_stg_lead'])
 
         return df
 
+    @staticmethod
+    def stage_status(stages):
+        """
+        Get the status part of each activity stage, e.g. 'complete' for 'Quiz_complete'.
+        Each distinct stage is split only once, and the statuses are looked up by stage.
+
+        Args:
+            stages (pd.Series): Activity stages.
+
+        Returns:
+            np.ndarray: Object array of statuses, NaN where the stage is missing.
+
+        """
+        return activity_pipeline.stage_status(stages)
+
     def drop_score_column(self, df):
         """
         Drop the 'score' column.
@@ -155,6 +242,9 @@ class ActivityProcessor:
         """
         Process a DataFrame to extract relevant information based on the specified activity.
 
+        The steps are run by the pipeline configured for the activity in `activity_pipeline`,
+        which gives the same result as chaining the methods above, without modifying the input.
+
         Args:
             df (pd.DataFrame): Input DataFrame.
             activity (str): The type of activity to process.
@@ -163,27 +253,169 @@ class ActivityProcessor:
             pd.DataFrame: Processed DataFrame.
 
         Raises:
-            ValueError: If activity type is not one of ['Quiz', 'Challenge', 'Video'].
+            ValueError: If activity type is not one of ACTIVITIES.
+
+        """
+        return get_plan(activity).run(df, self.on_stage)
 
+    def reference_processor(self, df, activity):
         """
-        is_scorable_activity = activity in ["Quiz", "Challenge"]
+        Process a DataFrame by chaining the step methods one after the other.
+
+        This is the reference the optimized paths, such as `processor`, are checked against: it is
+        slower, and copies the frame at every step, but each step is simple enough to review on its own.
+
+        Args:
+            df (pd.DataFrame): Input DataFrame.
+            activity (str): The type of activity to process.
+
+        Returns:
+            pd.DataFrame: Processed DataFrame.
+
+        Raises:
+            ValueError: If activity type is not one of ACTIVITIES.
+
+        """
+        if activity not in ACTIVITIES:
+            raise ValueError(f"Unknown activity type: {activity}, expected one of {ACTIVITIES}")
+        is_scorable_activity = activity in SCORABLE_ACTIVITIES
 
         df_act = self.filter_activity_type(df, activity)
         df_act = self.sort_dataframe(df_act)
         df_act = self.add_lead_columns(df_act, is_scorable_activity)
-
         df_act = self.remove_null_stages(df_act)
-
         if is_scorable_activity:
             df_act = self.remove_invalid_quiz_rows(df_act)
-
         df_act = self.calculate_activity_duration(df_act)
         df_act = self.extract_status(df_act)
         df_act = self.drop_score_column(df_act)
         df_act = self.rename_columns(df_act)
-
         return self.select_final_columns(df_act, is_scorable_activity)
 
+    def process_all(self, df, activities=None):
+        """
+        Process a DataFrame for several activity types in a single pass.
+
+        The input is filtered and sorted once, and the lead columns of every activity are
+        computed in one pass, by the combined plan of `activity_pipeline`. The result is split
+        per activity at the end and is identical to calling `processor` for each activity.
+
+        Args:
+            df (pd.DataFrame): Input DataFrame.
+            activities (list): The types of activity to process. Defaults to ACTIVITIES.
+
+        Returns:
+            dict: Processed DataFrame for each activity type, keyed by activity.
+
+        Raises:
+            ValueError: If one of the activity types is not one of ACTIVITIES.
+
+        """
+        if activities is None:
+            activities = ACTIVITIES
+
+        outputs = [activity_pipeline.activity_output(activity in SCORABLE_ACTIVITIES) for activity in activities]
+        parts = get_combined_plan(tuple(activities)).run_partitioned(df, 'type_code', outputs, self.on_stage)
+        input_types = None
+        results = {}
+        for activity, df_act in zip(activities, parts):
+            if df_act.empty:
+                if input_types is None:
+                    input_types = set(df['activity_type'].unique())
+                if activity not in input_types:
+                    # Without any input row, the columns of an activity type keep their input dtypes, which the
+                    # missing leads of the other types widen, so they come from its own plan.
+                    df_act = get_plan(activity).run(df.iloc[:0])
+            results[activity] = df_act
+        return results
+
+    @staticmethod
+    def activity_keys(df):
+        """
+        Number the activities of a DataFrame by type and id, as the same id could be used by two activity types.
+
+        Args:
+            df (pd.DataFrame): Input DataFrame.
+
+        Returns:
+            np.ndarray: Integer array, the same for every row of an activity.
+
+        """
+        return df.groupby(['activity_type', 'activity_id'], sort=False, observed=True,
+                          dropna=False).ngroup().to_numpy()
+
+    def open_activities(self, df, keys=None):
+        """
+        Flag the rows of activities whose latest stage is a start, i.e. that have not finished yet.
+
+        Args:
+            df (pd.DataFrame): Input DataFrame.
+            keys (np.ndarray): The activity of each row, from `activity_keys`. Computed if not set.
+
+        Returns:
+            np.ndarray: Boolean array, True for every row of an unfinished activity.
+
+        """
+        if keys is None:
+            keys = self.activity_keys(df)
+        order = np.lexsort((df['timestamp'].to_numpy(), keys))
+        sorted_keys = keys[order]
+
+        is_last = ~activity_pipeline.next_row_in_same_group([sorted_keys])
+        is_open = is_last & (self.stage_status(df['activity_stage'].iloc[order]) == "start")
+
+        return np.isin(keys, sorted_keys[is_open])
+
+    def process_chunks(self, chunks, activities=None, max_carry=1, process=None):
+        """
+        Process a DataFrame read in chunks, yielding the processed output of each chunk.
+
+        Unfinished activities, and the activity of the last row of the chunk, are held back and
+        prepended to the next chunk, so that records of an activity split across a chunk boundary
+        still pair up. Activities are identified by their type and id. An activity is carried over
+        at most `max_carry` times and is then processed as it is, which keeps the memory bounded by
+        the chunk size even when activities never finish.
+
+        Args:
+            chunks (iterable): DataFrames in file order, e.g. from `pd.read_csv(..., chunksize=n)`.
+            activities (list): The types of activity to process. Defaults to ACTIVITIES.
+            max_carry (int): Maximum number of chunks an unfinished activity is carried over.
+            process (callable): Called with each DataFrame to process and the activities, instead of
+                `process_all`, e.g. to process it in another process.
+
+        Yields:
+            dict: Processed DataFrame for each activity type, keyed by activity.
+
+        """
+        if process is None:
+            process = self.process_all
+        df_carry = None
+        carry_age = np.zeros(0, dtype=int)
+
+        for chunk in chunks:
+            if df_carry is None:
+                df = chunk
+            else:
+                df = pd.concat([df_carry, chunk])
+            age = np.concatenate([carry_age, np.zeros(len(chunk), dtype=int)])
+
+            keys = self.activity_keys(df)
+            held = self.open_activities(df, keys)
+            if len(chunk) > 0:
+                # The activity of the last row may have more records at the start of the next chunk.
+                held |= keys == keys[-1]
+            expired = held & (age >= max_carry)
+            if expired.any():
+                held &= ~np.isin(keys, keys[expired])
+
+            df_carry = df[held]
+            carry_age = age[held] + 1
+
+            yield process(df[~held], activities)
+
+        if df_carry is not None and len(df_carry) > 0:
+            yield process(df_carry, activities)
+
 
 if __name__ == "__main__":
     df = pd.read_csv("activity_logs.csv", sep='\t')
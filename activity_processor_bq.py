@@ -1,86 +1,143 @@
-import pandas as pd
-from datetime import datetime
-from google.cloud import storage
-from activity_processor import ActivityProcessor
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from batch_sink import BatchingSink, get_writer
+from file_manifest import FileManifest
+from ingestion_ledger import IngestionLedger
+from parallel_ingest import file_opener, ingest_files
+from result_cache import ResultCache
+from session_store import SessionStore
+from stage_metrics import emit_metrics
+from storage_backend import get_storage
 
 bucket_name = "hom_case_study"
+dataset = "thinking-heaven-281113.activity_tables"
 
+# Storage holding the raw files. Set STORAGE_URL to a local directory to run without cloud access.
+storage_url = os.environ.get("STORAGE_URL", f"gs://{bucket_name}")
 
-def list_bucket_files(bucket_name):
-    """Lists all the blobs in the bucket."""
-    storage_client = storage.Client()
+# Number of rows read from an input file at a time. Set CHUNK_SIZE to 0 to download each file at once, in
+# parallel ranges, and process it whole, for files that fit in memory.
+chunk_size = int(os.environ.get("CHUNK_SIZE", 500000)) or None
 
-    blobs = storage_client.list_blobs(bucket_name)
+# Number of files read, processed or uploaded at once, and of processes running the processor.
+# Set CPU_WORKERS to 0 to process the files in the I/O threads.
+io_workers = int(os.environ.get("IO_WORKERS", 8))
+cpu_workers = int(os.environ.get("CPU_WORKERS", os.cpu_count()))
 
-    return [blob.name for blob in blobs if "raw_data" in blob.name]
+# Output rows are written in batches of this many rows, or at least this often.
+# Set SINK_DIR to write the tables to local Parquet files instead of BigQuery.
+batch_rows = int(os.environ.get("BATCH_ROWS", 1000000))
+batch_seconds = float(os.environ.get("BATCH_SECONDS", 60))
+sink_dir = os.environ.get("SINK_DIR")
 
+# Local cache of the ingested files. When it is missing, e.g. on a cold start, it is rebuilt from the logs table.
+manifest_path = os.environ.get("MANIFEST_PATH", os.path.join(tempfile.gettempdir(), "activity_manifest.json"))
 
-def get_logs():
-    query = "select filename from `thinking-heaven-281113.activity_tables.processing_logs`"
-    df_logs = pd.read_gbq(query)
-    return df_logs['filename'].values
-
-
-def add_ingestion_timestamp(df):
-    dt = datetime.utcnow()
-    df['ingested_at'] = dt.strftime("%Y-%m-%d %H:%M:%S")
-    df['ingested_at'] = pd.to_datetime(df['ingested_at'])
-    return df
-
-
-def process_activities(df):
-    processor_instance = ActivityProcessor()
-
-    df_quiz = processor_instance.processor(df, 'Quiz')
+# Files are claimed in a ledger, by content hash, before they are ingested, by default in the storage of the files.
+# A claim older than CLAIM_SECONDS is considered abandoned by a crashed run, and the file is retried.
+ledger_url = os.environ.get("LEDGER_URL")
+claim_seconds = float(os.environ.get("CLAIM_SECONDS", 3600))
 
-    df_challenge = processor_instance.processor(df, 'Challenge')
+# Set SESSION_STORE_PATH to pair activities started in one file and finished in another, keeping the
+# activities left open at the edge of the files there until they are older than MAX_OPEN_SECONDS.
+session_store_path = os.environ.get("SESSION_STORE_PATH")
+max_open_seconds = int(os.environ.get("MAX_OPEN_SECONDS", 86400))
 
-    df_video = processor_instance.processor(df, 'Video')
+# Set RESULT_CACHE_DIR to keep the processed outputs of the files in a local cache, by content hash and version
+# of the processing logic, so that unchanged files are not processed again, up to RESULT_CACHE_BYTES in total.
+result_cache_dir = os.environ.get("RESULT_CACHE_DIR")
+result_cache_bytes = int(os.environ.get("RESULT_CACHE_BYTES", 1 << 30))
 
-    df_quiz = add_ingestion_timestamp(df_quiz)
-    df_challenge = add_ingestion_timestamp(df_challenge)
-    df_video = add_ingestion_timestamp(df_video)
+# Set PROFILE_STAGES to 1 to log structured metrics of each file, its processing stages and each batch write
+# as JSON lines. Off by default, as measuring every stage adds work to the processing.
+profile_stages = os.environ.get("PROFILE_STAGES", "0") == "1"
 
-    return df_quiz, df_challenge, df_video
 
-
-def upload_to_bq(df, table_name):
-    df.to_gbq(f"thinking-heaven-281113.activity_tables.{table_name}", if_exists="append", progress_bar=False)
-
-
-def update_logs(file_name):
-    records = [{"filename": file_name}]
-    df = pd.DataFrame(records)
-    df = add_ingestion_timestamp(df)
-    df.to_gbq(f"thinking-heaven-281113.activity_tables.processing_logs", if_exists="append", progress_bar=False)
+def get_logs(writer):
+    df_logs = writer.read_table("processing_logs", columns=["filename"])
+    return df_logs['filename'].values
 
 
 def activity_process_to_bq(request=None):
-    print("Getting file list in bucket")
-    files_in_gcp = list_bucket_files(bucket_name)
+    writer = get_writer(dataset, sink_dir)
+    bucket = get_storage(storage_url)
+    manifest = FileManifest(manifest_path)
+
+    if not manifest.exists:
+        print("Getting file list in logs table")
+        manifest.add(get_logs(writer))
 
-    print("Getting file list in logs table")
-    processed_files = get_logs()
+    print(f"Getting file list in bucket after: {manifest.high_water_mark}")
+    files_in_gcp = bucket.list("raw_data/", start_offset=manifest.high_water_mark)
 
-    new_files = list(set(files_in_gcp) - set(processed_files))
+    new_files = manifest.new_files(files_in_gcp)
 
     if len(new_files) == 0:
         print("No new files to ingest")
+        manifest.advance(files_in_gcp)
         return {"Status": "No files to ingest."}
     print(f"New files to ingest: {len(new_files)}")
-    for file_name in new_files:
-        print(f"Processing file: {file_name}")
-        df = pd.read_csv(f"gs://{bucket_name}/{file_name}")
-        df_quiz, df_challenge, df_video = process_activities(df)
-        print("Uploading to BigQuery")
-        upload_to_bq(df_quiz, f"quiz_table")
-        upload_to_bq(df_challenge, f"challenge_table")
-        upload_to_bq(df_video, f"video_table")
-
-        print("Uploading logs")
-        update_logs(file_name)
+
+    # Claim the files by content hash, so that a file ingested under another name, or being ingested by a
+    # concurrent run, is not ingested twice.
+    ledger = IngestionLedger(get_storage(ledger_url) if ledger_url else bucket, claim_seconds=claim_seconds)
+    with ThreadPoolExecutor(io_workers) as pool:
+        hashes = dict(zip(new_files, pool.map(bucket.content_hash, new_files)))
+        claims = dict(zip(new_files, pool.map(lambda name: ledger.claim(name, hashes[name]), new_files)))
+    duplicate_files = [name for name in new_files if claims[name] is None and ledger.is_done(hashes[name])]
+    manifest.add(duplicate_files)
+    claimed_files = [name for name in new_files if claims[name] is not None]
+    print(f"Files already ingested: {len(duplicate_files)}, "
+          f"claimed by another run: {len(new_files) - len(duplicate_files) - len(claimed_files)}")
+
+    def upload(file_name, chunks):
+        # The outputs of the file are written as each chunk is processed, and its rollups once for the file.
+        # The rows of an earlier, failed attempt at the file are deleted before the new ones are written.
+        claim = claims[file_name]
+        if claim["retry"]:
+            sink.replace(claim["batch_id"])
+        sink.add_chunks(file_name, chunks, batch_id=claim["batch_id"])
+
+    def on_logged(file_names):
+        manifest.add(file_names)
+        if session_store is not None:
+            session_store.commit(file_names)
+        for file_name in file_names:
+            ledger.complete(file_name, hashes[file_name])
+
+    # Files are logged by the sink, and then added to the manifest, only once all of their rows are written.
+    on_file_metrics = (lambda metrics: emit_metrics("file_ingested", **metrics)) if profile_stages else None
+    on_flushed = (lambda tables: emit_metrics("batch_written", tables=tables)) if profile_stages else None
+    session_store = SessionStore(session_store_path, max_open_seconds) if session_store_path else None
+    cache = ResultCache(result_cache_dir, result_cache_bytes) if result_cache_dir else None
+    try:
+        with BatchingSink(writer, max_rows=batch_rows, max_seconds=batch_seconds, on_logged=on_logged,
+                          on_flushed=on_flushed) as sink:
+            ingested_files, failed_files = ingest_files(claimed_files, file_opener(bucket, chunk_size), upload,
+                                                        io_workers=io_workers, cpu_workers=cpu_workers,
+                                                        chunksize=chunk_size,
+                                                        on_metrics=on_file_metrics, session_store=session_store,
+                                                        cache=cache, content_hash=hashes.get)
+    except Exception:
+        for file_name in claimed_files:
+            if file_name not in manifest.processed:
+                ledger.release(file_name, hashes[file_name])
+        raise
+    for file_name in failed_files:
+        ledger.release(file_name, hashes[file_name])
+        if session_store is not None:
+            session_store.discard(file_name)
+    # Only the updates of the files whose outputs and pairs were written are saved, so a failed file is
+    # paired again by its retry.
+    if session_store is not None:
+        session_store.save()
+        print(f"Open activities: {len(session_store)}, expired: {session_store.expired}")
+    manifest.advance(files_in_gcp)
+    for file_name, error in failed_files.items():
+        print(f"Failed to ingest file: {file_name}: {error!r}")
     print("Complete")
-    return {"Status": f"Files ingested: {len(new_files)}"}
+    return {"Status": f"Files ingested: {len(ingested_files)}", "Failed": len(failed_files)}
 
 
 if __name__ == "__main__":
@@ -1,79 +1,110 @@
-import pandas as pd
-from datetime import datetime
-from google.cloud import storage
-from activity_processor import ActivityProcessor
+import os
+import time
+from activity_io import detect_format
+from batch_sink import BatchingSink, get_writer
+from ingestion_ledger import IngestionLedger
+from parallel_ingest import file_opener, process_stream
+from session_store import SessionStore
+from stage_metrics import StageRecorder, emit_metrics
+from storage_backend import get_storage
 
+dataset = "thinking-heaven-281113.activity_tables_gcs"
 
-def list_bucket_files(bucket_name):
-    """Lists all the blobs in the bucket."""
-    storage_client = storage.Client()
+# Number of rows read from an input file at a time. Set CHUNK_SIZE to 0 to download each file at once, in
+# parallel ranges, and process it whole, for files that fit in memory.
+chunk_size = int(os.environ.get("CHUNK_SIZE", 500000)) or None
 
-    blobs = storage_client.list_blobs(bucket_name)
+# Output rows are written in batches of this many rows, or at least this often.
+# Set SINK_DIR to write the tables to local Parquet files instead of BigQuery.
+batch_rows = int(os.environ.get("BATCH_ROWS", 1000000))
+batch_seconds = float(os.environ.get("BATCH_SECONDS", 60))
+sink_dir = os.environ.get("SINK_DIR")
 
-    return [blob.name for blob in blobs if "raw_data" in blob.name]
+# Storage holding the raw files, by default the bucket of the event.
+# Set STORAGE_URL to a local directory to run without cloud access.
+storage_url = os.environ.get("STORAGE_URL")
 
+# Files are claimed in a ledger, by content hash, before they are ingested, by default in the bucket of the event.
+# A claim older than CLAIM_SECONDS is considered abandoned by a crashed invocation, and the file is retried.
+ledger_url = os.environ.get("LEDGER_URL")
+claim_seconds = float(os.environ.get("CLAIM_SECONDS", 3600))
 
-def get_logs():
-    query = "select filename from `thinking-heaven-281113.activity_tables.processing_logs`"
-    df_logs = pd.read_gbq(query)
-    return df_logs['filename'].values
+# Set SESSION_STORE_PATH to pair activities started in one file and finished in another, keeping the
+# activities left open at the edge of the files there until they are older than MAX_OPEN_SECONDS.
+session_store_path = os.environ.get("SESSION_STORE_PATH")
+max_open_seconds = int(os.environ.get("MAX_OPEN_SECONDS", 86400))
 
+# Set PROFILE_STAGES to 1 to log structured metrics of the file, its processing stages and each batch write
+# as JSON lines. Off by default, as measuring every stage adds work to the processing.
+profile_stages = os.environ.get("PROFILE_STAGES", "0") == "1"
 
-def add_ingestion_timestamp(df):
-    dt = datetime.utcnow()
-    df['ingested_at'] = dt.strftime("%Y-%m-%d %H:%M:%S")
-    df['ingested_at'] = pd.to_datetime(df['ingested_at'])
-    return df
 
-
-def process_activities(df):
-    processor_instance = ActivityProcessor()
-
-    df_quiz = processor_instance.processor(df, 'Quiz')
-
-    df_challenge = processor_instance.processor(df, 'Challenge')
-
-    df_video = processor_instance.processor(df, 'Video')
-
-    df_quiz = add_ingestion_timestamp(df_quiz)
-    df_challenge = add_ingestion_timestamp(df_challenge)
-    df_video = add_ingestion_timestamp(df_video)
-
-    return df_quiz, df_challenge, df_video
-
-
-def upload_to_bq(df, table_name):
-    df.to_gbq(f"thinking-heaven-281113.activity_tables_gcs.{table_name}", if_exists="append", progress_bar=False)
-
-
-def update_logs(file_name):
-    records = [{"filename": file_name}]
-    df = pd.DataFrame(records)
-    df = add_ingestion_timestamp(df)
-    df.to_gbq(f"thinking-heaven-281113.activity_tables_gcs.processing_logs", if_exists="append", progress_bar=False)
+def is_relevant(event):
+    """Indicates if a storage event is about a raw data file to ingest."""
+    return event.get('bucket') == "hom_case_study" and "raw_data" in event.get('name', "")
 
 
 def activity_process_gcs_to_bq(event, context):
     bucket_name = event['bucket']
     file_name = event['name']
-    if bucket_name != "hom_case_study" or "raw_data" not in file_name:
+    if not is_relevant(event):
         return {"Status": f"No relevant files to ingest."}
-    file_path = f"gs://{bucket_name}/{file_name}"
-    print(f"File to ingest: {file_path}")
+    print(f"File to ingest: {file_name}")
+
+    bucket = get_storage(storage_url or f"gs://{bucket_name}")
+    # Events can be delivered more than once, and the same contents can be uploaded under another name.
+    ledger = IngestionLedger(get_storage(ledger_url) if ledger_url else bucket, claim_seconds=claim_seconds)
+    content_hash = bucket.content_hash(file_name)
+    claim = ledger.claim(file_name, content_hash)
+    if claim is None:
+        print(f"File already ingested, or being ingested: {file_name}")
+        return {"Status": "File already ingested."}
 
     print(f"Processing file: {file_name}")
-    df = pd.read_csv(file_path)
-    df_quiz, df_challenge, df_video = process_activities(df)
-    print("Uploading to BigQuery")
-    upload_to_bq(df_quiz, f"quiz_table")
-    upload_to_bq(df_challenge, f"challenge_table")
-    upload_to_bq(df_video, f"video_table")
-
-    print("Uploading logs")
-    update_logs(file_name)
+    recorder = StageRecorder() if profile_stages else None
+    on_flushed = (lambda tables: emit_metrics("batch_written", tables=tables)) if profile_stages else None
+
+    session_store = SessionStore(session_store_path, max_open_seconds) if session_store_path else None
+
+    def stream(f):
+        boundaries = [] if session_store is not None else None
+        yield from process_stream(f, detect_format(file_name), chunk_size, on_stage=recorder, boundaries=boundaries)
+        if boundaries:
+            # The rows of the activities the file continues or leaves open, paired with the other files.
+            yield session_store.join(boundaries[0], file_name=file_name)
+
+    start = time.perf_counter()
+    # The sink writes the rows in batches, and logs the file only once all of its rows are written.
+    # They are written under the batch id of the claim, so a retry replaces the rows of a failed attempt.
+    try:
+        with file_opener(bucket, chunk_size)(file_name) as f, \
+                BatchingSink(get_writer(dataset, sink_dir), max_rows=batch_rows, max_seconds=batch_seconds,
+                             on_flushed=on_flushed) as sink:
+            if claim["retry"]:
+                sink.replace(claim["batch_id"])
+            # The rows of each chunk are added as it is processed, and the rollups of the chunks once for the file.
+            sink.add_chunks(file_name, stream(f), batch_id=claim["batch_id"])
+    except Exception:
+        ledger.release(file_name, content_hash)
+        raise
+    ledger.complete(file_name, content_hash)
+    if session_store is not None:
+        # Saved once the outputs and pairs of the file are written, so that a failed file is paired again by its retry.
+        session_store.commit([file_name])
+        session_store.save()
+    seconds = time.perf_counter() - start
+
+    if profile_stages:
+        stages = recorder.totals()
+        rows = stages.get("read", {}).get("rows_out", 0)
+        emit_metrics("file_ingested", file=file_name, rows=rows, seconds=seconds,
+                     rows_per_second=rows / seconds if seconds > 0 else None, stages=stages)
     print("Complete")
     return {"Status": f"Files ingested: {len(file_name)}"}
 
 
 if __name__ == "__main__":
-    activity_process_gcs_to_bq()
+    # Ingest one file, as the event of its upload would: python activity_processor_gcs_trigger.py raw_data/...
+    import sys
+
+    activity_process_gcs_to_bq({"bucket": "hom_case_study", "name": sys.argv[1]}, None)
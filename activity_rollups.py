@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+# Columns the rows of each rollup are grouped by.
+ROLLUP_KEYS = {
+    "daily": ["day", "activity_type", "status"],
+    "user": ["day", "user_id", "activity_type", "status"],
+}
+
+# Scores are counted in buckets of this width, the last bucket also holding the maximum score of 100.
+SCORE_BUCKET_WIDTH = 10
+SCORE_BUCKETS = [f"score_{bucket:02d}" for bucket in range(0, 100, SCORE_BUCKET_WIDTH)]
+
+# Measures of each rollup. The per-user rollup has as many groups as there are active users each day,
+# so it only keeps the sums completion rates and means are derived from.
+ROLLUP_MEASURES = {
+    "daily": ["activities", "duration_sum", "duration_sum_squares", "duration_min", "duration_max",
+              "score_count", "score_sum"] + SCORE_BUCKETS,
+    "user": ["activities", "duration_sum", "score_count", "score_sum"],
+}
+
+# Measures that are combined with something else than a sum, across partial rollups of the same group.
+MIN_MEASURES = ["duration_min"]
+MAX_MEASURES = ["duration_max"]
+
+
+def activity_rows(results):
+    """
+    Stack the processed DataFrames of every activity type, with the columns the rollups need.
+
+    Args:
+        results (dict): Processed DataFrame for each activity type, keyed by activity.
+
+    Returns:
+        pd.DataFrame: The day, user_id, activity_type, status, activity_duration and score of every activity.
+
+    """
+    frames = []
+    for activity, df in results.items():
+        frames.append(pd.DataFrame({
+            "day": pd.to_datetime(df['start_timestamp'].to_numpy() // 86400 * 86400, unit="s"),
+            "user_id": df['user_id'].to_numpy(),
+            "activity_type": activity,
+            "status": df['status'].to_numpy(),
+            "activity_duration": df['activity_duration'].to_numpy(dtype=float),
+            "score": df['score'].to_numpy(dtype=float, na_value=np.nan) if 'score' in df.columns else np.nan,
+        }))
+    if not frames:
+        return pd.DataFrame({"day": pd.to_datetime([]), "user_id": np.array([], dtype=np.int64),
+                             "activity_type": np.array([], dtype=object), "status": np.array([], dtype=object),
+                             "activity_duration": np.array([]), "score": np.array([])})
+    df = pd.concat(frames, ignore_index=True)
+    # Grouping by categorical codes is much faster than by strings.
+    df['activity_type'] = df['activity_type'].astype("category")
+    df['status'] = df['status'].astype("category")
+    return df
+
+
+def aggregate(measures, keys):
+    """Combine the measures of the rows of each group, with a sum, or a min or max for the extremes."""
+    grouped = measures.groupby(keys, sort=True, observed=True)
+    names = [name for name in measures.columns if name not in keys]
+    sums = [name for name in names if name not in MIN_MEASURES + MAX_MEASURES]
+    df = grouped[sums].sum()
+    for name in names:
+        if name in MIN_MEASURES:
+            df[name] = grouped[name].min()
+        elif name in MAX_MEASURES:
+            df[name] = grouped[name].max()
+    return df[names].reset_index()
+
+
+def rollup(df, name):
+    """
+    Aggregate activities into the measures of a rollup per group: counts, sums, extremes and a score histogram.
+
+    Every measure can be combined across partial rollups of the same group, e.g. of different files,
+    with `merge_rollups`. Completion rates, mean and standard deviation of the durations and mean
+    scores are derived from the combined sums.
+
+    Args:
+        df (pd.DataFrame): Activities, from `activity_rows`.
+        name (str): Name of the rollup, as in ROLLUP_KEYS.
+
+    Returns:
+        pd.DataFrame: One row per group, with the keys and the measures as columns.
+
+    """
+    keys = ROLLUP_KEYS[name]
+    duration = df['activity_duration'].to_numpy()
+    score = df['score'].to_numpy()
+    has_score = ~np.isnan(score)
+    columns = {key: df[key].array for key in keys}
+    columns.update({
+        "activities": np.ones(len(df), dtype=np.int64),
+        "duration_sum": duration,
+        "duration_sum_squares": duration ** 2,
+        "duration_min": duration,
+        "duration_max": duration,
+        "score_count": has_score.astype(np.int64),
+        "score_sum": np.where(has_score, score, 0),
+    })
+    if set(SCORE_BUCKETS) & set(ROLLUP_MEASURES[name]):
+        bucket = np.minimum(np.where(has_score, score, -1) // SCORE_BUCKET_WIDTH, len(SCORE_BUCKETS) - 1)
+        columns.update({bucket_name: (bucket == i).astype(np.int64) for i, bucket_name in enumerate(SCORE_BUCKETS)})
+    measures = pd.DataFrame({column: columns[column] for column in keys + ROLLUP_MEASURES[name]})
+    return aggregate(measures, keys)
+
+
+def rollup_results(results):
+    """
+    Compute every rollup of the processed DataFrames of a file.
+
+    Args:
+        results (dict): Processed DataFrame for each activity type, keyed by activity.
+
+    Returns:
+        dict: The rollup DataFrames, keyed by rollup name as in ROLLUP_KEYS.
+
+    """
+    df = activity_rows(results)
+    return {name: rollup(df, name) for name in ROLLUP_KEYS}
+
+
+def merge_rollups(frames, name):
+    """
+    Combine partial rollups, e.g. of several files or chunks, into one row per group.
+
+    Args:
+        frames (list): Rollup DataFrames, from `rollup`.
+        name (str): Name of the rollup, as in ROLLUP_KEYS.
+
+    Returns:
+        pd.DataFrame: The combined rollup.
+
+    """
+    return aggregate(pd.concat(frames, ignore_index=True), ROLLUP_KEYS[name])
@@ -0,0 +1,90 @@
+import pandas as pd
+
+# The activity types, in the order of their categories, the only definition the processor, the output tables and
+# the data generator derive theirs from. A scored activity needs a score on completion, which is also part of its
+# output. The weight is the share of the generated activities of the type. Adding an activity type only takes a new
+# entry here.
+ACTIVITY_CONFIG = {
+    "Quiz": {"scored": True, "table": "quiz_table", "weight": 0.4},
+    "Video": {"scored": False, "table": "video_table", "weight": 0.3},
+    "Challenge": {"scored": True, "table": "challenge_table", "weight": 0.3},
+}
+
+ACTIVITY_TYPES = list(ACTIVITY_CONFIG)
+SCORED_ACTIVITY_TYPES = [activity for activity, config in ACTIVITY_CONFIG.items() if config["scored"]]
+ACTIVITY_STATUSES = ['start', 'complete', 'abandon']
+ACTIVITY_STAGES = [f"{activity}_{status}" for activity in ACTIVITY_TYPES for status in ACTIVITY_STATUSES]
+# The stages that need a score, whatever the type of the activity they follow the start of.
+SCORED_COMPLETIONS = [f"{activity}_complete" for activity in SCORED_ACTIVITY_TYPES]
+
+# Explicit dtypes of the activity logs, shared by the generator, the processors and the readers.
+# activity_id has 10 digits and needs 64 bits, user_id has 6 digits, timestamps are epoch seconds
+# (unsigned 32 bits last until 2106) and scores range from 0 to 100, missing for most stages.
+ACTIVITY_LOG_DTYPES = {
+    'activity_id': 'int64',
+    'timestamp': 'uint32',
+    'user_id': 'int32',
+    'activity_stage': pd.CategoricalDtype(ACTIVITY_STAGES),
+    'activity_type': pd.CategoricalDtype(ACTIVITY_TYPES),
+    'score': 'Int8',
+}
+
+
+def apply_schema(df):
+    """
+    Cast the columns of an activity log DataFrame to the compact schema.
+
+    Args:
+        df (pd.DataFrame): Activity logs, e.g. with the dtypes inferred by `pd.read_csv`.
+
+    Returns:
+        pd.DataFrame: Activity logs with the dtypes in ACTIVITY_LOG_DTYPES.
+
+    Raises:
+        ValueError: If a stage or activity type is not part of the schema.
+
+    """
+    df_schema = df.astype({column: dtype for column, dtype in ACTIVITY_LOG_DTYPES.items() if column in df.columns})
+
+    for column in ['activity_stage', 'activity_type']:
+        if column in df.columns and df_schema[column].isna().sum() != df[column].isna().sum():
+            unknown = set(df.loc[df_schema[column].isna(), column].dropna())
+            raise ValueError(f"Unknown values in column '{column}': {sorted(unknown)}")
+
+    return df_schema
+
+
+def memory_report(df):
+    """
+    Compare the memory used by activity logs before and after applying the compact schema.
+
+    Args:
+        df (pd.DataFrame): Activity logs with inferred dtypes.
+
+    Returns:
+        pd.DataFrame: Bytes per row of each column, and in total, before and after.
+
+    """
+    df_schema = apply_schema(df)
+    num_rows = max(len(df), 1)
+
+    report = pd.DataFrame({
+        'before': df.memory_usage(index=False, deep=True) / num_rows,
+        'after': df_schema.memory_usage(index=False, deep=True) / num_rows,
+    })
+    report.loc['total'] = report.sum()
+    report['ratio'] = report['after'] / report['before']
+
+    return report
+
+
+if __name__ == "__main__":
+    import io
+    import random
+    from data_generator import DataGenerator
+
+    random.seed(1234)
+    df_generated = DataGenerator("2023-01-01", "2023-01-31").generate_records(10000)
+    # Round trip through CSV to get the dtypes that `pd.read_csv` infers.
+    df_inferred = pd.read_csv(io.StringIO(df_generated.to_csv(index=False)))
+    print(memory_report(df_inferred).round(2))
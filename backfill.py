@@ -0,0 +1,153 @@
+"""
+Reprocess the raw files of a date range or prefix, e.g. after a change of the processing logic.
+
+The files are ingested in parallel with the settings of `activity_processor_bq`, including its result cache,
+into a separate target dataset, so a backfill can run in the background without touching the tables of the live
+ingestion, and without claiming the files in its ledger. Ingested files are recorded in a checkpoint once their
+rows are written: an interrupted backfill run again with the same checkpoint resumes with the files it had not
+finished, and deletes the rows they may have left in the target dataset before writing them again.
+
+Usage, from the repository root:
+    python backfill.py --start-date 2023-01-01 --end-date 2023-01-31 --checkpoint january.json
+    python backfill.py --prefix raw_data/data_1700 --dataset project.activity_tables_v2 --sink-dir out
+"""
+import argparse
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import activity_processor_bq as bq
+from batch_sink import BatchingSink, get_writer
+from file_manifest import FileManifest
+from parallel_ingest import ingest_files
+from result_cache import ResultCache
+from stage_metrics import emit_metrics
+from storage_backend import get_storage
+
+# Dataset the backfilled tables are written to, by default next to the live ones.
+target_dataset = "thinking-heaven-281113.activity_tables_backfill"
+
+# The generator names the raw files after the time they were uploaded, e.g. raw_data/data_1700000000.parquet.
+FILE_TIMESTAMP = re.compile(r"data_(\d+)")
+
+
+def file_timestamp(file_name):
+    """Get the upload time, in seconds since the epoch, in the name of a raw file, or None if it has none."""
+    match = FILE_TIMESTAMP.search(file_name.rsplit("/", 1)[-1])
+    return int(match.group(1)) if match else None
+
+
+def list_files(bucket, prefix="raw_data/", start_date=None, end_date=None):
+    """
+    List the raw files to reprocess.
+
+    Args:
+        bucket (Storage): Storage holding the raw files.
+        prefix (str): Prefix of the file names.
+        start_date (str): If set, only files uploaded on this day, as YYYY-MM-DD in UTC, or later are listed.
+        end_date (str): If set, only files uploaded on this day or earlier are listed.
+
+    Returns:
+        list: Sorted names of the files. Files without an upload time in their name are only listed
+            when no date is set.
+
+    """
+    names = bucket.list(prefix)
+    if start_date is None and end_date is None:
+        return names
+
+    start = _day_start(start_date) if start_date else float("-inf")
+    end = _day_start(end_date) + timedelta(days=1).total_seconds() if end_date else float("inf")
+    timestamps = {name: file_timestamp(name) for name in names}
+    return [name for name in names if timestamps[name] is not None and start <= timestamps[name] < end]
+
+
+def _day_start(date):
+    return datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
+
+def backfill(file_names, checkpoint_path, dataset=target_dataset, sink_dir=None, replace=False, io_workers=None,
+             cpu_workers=None):
+    """
+    Ingest raw files into a target dataset, skipping those already in the checkpoint.
+
+    Rows are written under the content hash of their file as batch id, so that the rows of a file
+    written before an interruption, or by an earlier backfill, can be replaced.
+
+    Args:
+        file_names (list): Names of the raw files, in the storage of `activity_processor_bq`.
+        checkpoint_path (str): Path of the JSON file the ingested files are recorded in.
+        dataset (str): The BigQuery dataset the tables are written to, as project.dataset.
+        sink_dir (str): If set, tables are written to this local directory instead of BigQuery.
+        replace (bool): Indicates if the rows of the files already in the target dataset are deleted first.
+            Always done for the files left by an interrupted run, when the checkpoint exists.
+        io_workers (int): Number of files read, processed or uploaded at once.
+            Defaults to the setting of `activity_processor_bq`.
+        cpu_workers (int): Number of processes running the processor; 0 processes files in the I/O threads.
+            Defaults to the setting of `activity_processor_bq`.
+
+    Returns:
+        dict: Counts of the 'files' to backfill, and of those 'skipped' as in the checkpoint, 'ingested' and 'failed'.
+
+    """
+    io_workers = bq.io_workers if io_workers is None else io_workers
+    cpu_workers = bq.cpu_workers if cpu_workers is None else cpu_workers
+    bucket = get_storage(bq.storage_url)
+    checkpoint = FileManifest(checkpoint_path)
+    replace = replace or checkpoint.exists
+    # Saved before any rows are written, so that a run interrupted even during its first flush is resumed as one,
+    # and replaces the rows it left.
+    checkpoint.save()
+
+    pending_files = checkpoint.new_files(file_names)
+    print(f"Files to backfill: {len(pending_files)}, already in the checkpoint: {len(file_names) - len(pending_files)}")
+    with ThreadPoolExecutor(io_workers) as pool:
+        hashes = dict(zip(pending_files, pool.map(bucket.content_hash, pending_files)))
+
+    def upload(file_name, chunks):
+        if replace:
+            sink.replace(hashes[file_name])
+        sink.add_chunks(file_name, chunks, batch_id=hashes[file_name])
+
+    # Files are added to the checkpoint, and saved, only once all of their rows are written.
+    on_file_metrics = (lambda metrics: emit_metrics("file_ingested", **metrics)) if bq.profile_stages else None
+    on_flushed = (lambda tables: emit_metrics("batch_written", tables=tables)) if bq.profile_stages else None
+    cache = ResultCache(bq.result_cache_dir, bq.result_cache_bytes) if bq.result_cache_dir else None
+    with BatchingSink(get_writer(dataset, sink_dir), max_rows=bq.batch_rows, max_seconds=bq.batch_seconds,
+                      on_logged=checkpoint.add, on_flushed=on_flushed) as sink:
+        ingested_files, failed_files = ingest_files(pending_files, bucket.open, upload, io_workers=io_workers,
+                                                    cpu_workers=cpu_workers, chunksize=bq.chunk_size,
+                                                    on_metrics=on_file_metrics, cache=cache, content_hash=hashes.get)
+    checkpoint.advance(file_names)
+    for file_name, error in failed_files.items():
+        print(f"Failed to ingest file: {file_name}: {error!r}")
+
+    return {"files": len(file_names), "skipped": len(file_names) - len(pending_files),
+            "ingested": len(ingested_files), "failed": len(failed_files)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prefix", default="raw_data/", help="Prefix of the raw files to reprocess.")
+    parser.add_argument("--start-date", help="First upload day of the files, as YYYY-MM-DD in UTC.")
+    parser.add_argument("--end-date", help="Last upload day of the files, as YYYY-MM-DD in UTC.")
+    parser.add_argument("--dataset", default=target_dataset, help="Target dataset, as project.dataset.")
+    parser.add_argument("--sink-dir", default=bq.sink_dir,
+                        help="Write the tables to Parquet files in this directory instead of BigQuery.")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json",
+                        help="Checkpoint of the run; pass the same one to resume it, and a new one for another run.")
+    parser.add_argument("--replace", action="store_true",
+                        help="Delete the rows of the files already in the target dataset, e.g. from an earlier run.")
+    parser.add_argument("--io-workers", type=int, default=bq.io_workers)
+    parser.add_argument("--cpu-workers", type=int, default=bq.cpu_workers)
+    args = parser.parse_args()
+
+    file_names = list_files(get_storage(bq.storage_url), args.prefix, args.start_date, args.end_date)
+    stats = backfill(file_names, args.checkpoint, dataset=args.dataset, sink_dir=args.sink_dir, replace=args.replace,
+                     io_workers=args.io_workers, cpu_workers=args.cpu_workers)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
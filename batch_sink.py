@@ -0,0 +1,515 @@
+import functools
+import glob
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import pandas as pd
+
+from activity_rollups import ROLLUP_KEYS, merge_rollups, rollup_results
+from activity_schema import ACTIVITY_CONFIG
+
+# Output table of each activity type.
+TABLE_NAMES = {activity: config["table"] for activity, config in ACTIVITY_CONFIG.items()}
+
+# Aggregate table of each rollup computed during ingestion, see activity_rollups.py.
+ROLLUP_TABLE_NAMES = {"daily": "daily_activity_rollup", "user": "user_daily_activity_rollup"}
+
+# Minimum delay before a failed flush of a BatchingSink is retried by its timer.
+MIN_RETRY_SECONDS = 1
+
+
+@functools.lru_cache(maxsize=None)
+def get_bigquery_client():
+    """
+    Get the BigQuery client, created on first use and shared for the life of the process.
+
+    Returns:
+        google.cloud.bigquery.Client: The client.
+
+    """
+    from google.cloud import bigquery
+
+    return bigquery.Client()
+
+
+# Column each table is partitioned by day on, and the columns its rows are clustered by within a day.
+# Output tables are partitioned on the day of start_timestamp, added as 'start_day'. Other tables are not partitioned.
+PARTITION_FIELDS = {**{table_name: "start_day" for table_name in TABLE_NAMES.values()},
+                    **{table_name: "day" for table_name in ROLLUP_TABLE_NAMES.values()}}
+CLUSTERING_FIELDS = {**{table_name: ["user_id", "activity_id"] for table_name in TABLE_NAMES.values()},
+                     ROLLUP_TABLE_NAMES["daily"]: ["activity_type", "status"],
+                     ROLLUP_TABLE_NAMES["user"]: ["user_id"]}
+
+# BigQuery types of the columns whose type is not the one the client would infer from their dtypes: the partition
+# columns are days, and the naive ingestion time is a UTC timestamp in every table, including the logs.
+WAREHOUSE_SCHEMA = {**{field: "DATE" for field in PARTITION_FIELDS.values()}, 'ingested_at': "TIMESTAMP"}
+
+
+# Types of the columns of the warehouse tables. The processing works in the compact schema of activity_schema.py,
+# whose narrow and unsigned integers the existing INTEGER and FLOAT columns do not accept: pandas-gbq would load
+# unsigned integers as STRING, and the nullable Int8 score as INTEGER instead of FLOAT.
+WAREHOUSE_DTYPES = {
+    'activity_id': 'int64',
+    'user_id': 'int64',
+    'start_timestamp': 'int64',
+    'activity_duration': 'float64',
+    'score': 'float64',
+}
+
+
+def to_warehouse_types(df):
+    """
+    Cast the columns of output rows to the types of the warehouse tables.
+
+    Args:
+        df (pd.DataFrame): Output rows, e.g. processed in the compact schema.
+
+    Returns:
+        pd.DataFrame: The rows with the columns of WAREHOUSE_DTYPES cast, any other integer column as 64 bits,
+            and categorical columns as strings.
+
+    """
+    dtypes = {}
+    for column, dtype in df.dtypes.items():
+        if column in WAREHOUSE_DTYPES:
+            dtypes[column] = WAREHOUSE_DTYPES[column]
+        elif isinstance(dtype, pd.CategoricalDtype):
+            dtypes[column] = object
+        elif pd.api.types.is_integer_dtype(dtype):
+            # Nullable integers keep their missing values.
+            dtypes[column] = 'Int64' if pd.api.types.is_extension_array_dtype(dtype) else 'int64'
+    return df.astype(dtypes)
+
+
+def ingestion_timestamp():
+    """Get the current UTC time, to the second, as a timestamp without time zone."""
+    return pd.Timestamp(datetime.utcnow().replace(microsecond=0))
+
+
+def add_ingestion_timestamp(df, ingested_at=None):
+    """
+    Add the 'ingested_at' column, as one typed scalar for every row.
+
+    Args:
+        df (pd.DataFrame): Output rows, modified in place.
+        ingested_at (pd.Timestamp): The ingestion time. Defaults to the current time.
+
+    Returns:
+        pd.DataFrame: `df`, with the column.
+
+    """
+    df['ingested_at'] = ingestion_timestamp() if ingested_at is None else ingested_at
+    return df
+
+
+def add_partition_day(table_name, df):
+    """
+    Add the day a partitioned output table is partitioned on, from the start timestamp of each row.
+
+    Args:
+        table_name (str): Name of the table.
+        df (pd.DataFrame): Rows of the table.
+
+    Returns:
+        pd.DataFrame: The rows with the 'start_day' column, or `df` as it is if the table does not need it.
+
+    """
+    if PARTITION_FIELDS.get(table_name) != "start_day" or "start_day" in df.columns:
+        return df
+    seconds = df['start_timestamp'].to_numpy(dtype="int64")
+    return df.assign(start_day=pd.to_datetime(seconds - seconds % 86400, unit="s"))
+
+
+def partitions(table_name, df):
+    """
+    Split the rows of a table by partition.
+
+    Args:
+        table_name (str): Name of the table.
+        df (pd.DataFrame): Rows of the table, with its partition column.
+
+    Yields:
+        tuple: The day of each partition, None for a table that is not partitioned, and its rows.
+
+    """
+    field = PARTITION_FIELDS.get(table_name)
+    if field is None:
+        yield None, df
+        return
+    for day, df_day in df.groupby(field, sort=True):
+        yield day, df_day
+
+
+class BigQueryWriter:
+    """
+    Append DataFrames to the tables of a BigQuery dataset.
+
+    Args:
+        dataset (str): The dataset, as project.dataset.
+
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def write(self, table_name, df):
+        schema = [(column, WAREHOUSE_SCHEMA[column]) for column in df.columns if column in WAREHOUSE_SCHEMA]
+        if table_name not in PARTITION_FIELDS:
+            df.to_gbq(f"{self.dataset}.{table_name}", if_exists="append", progress_bar=False,
+                      table_schema=[{"name": column, "type": type_} for column, type_ in schema])
+            return
+
+        from google.cloud import bigquery
+
+        # The table is created partitioned by day and clustered by the first load. Each load appends its
+        # rows to the partitions of their days, and queries filtering on the partition column only scan those.
+        field = PARTITION_FIELDS[table_name]
+        df = df.assign(**{field: df[field].dt.date})
+        job_config = bigquery.LoadJobConfig(
+            schema=[bigquery.SchemaField(column, type_) for column, type_ in schema],
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            time_partitioning=bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY,
+                                                        field=field),
+            clustering_fields=CLUSTERING_FIELDS.get(table_name))
+        get_bigquery_client().load_table_from_dataframe(df, f"{self.dataset}.{table_name}",
+                                                        job_config=job_config).result()
+
+    def read_table(self, table_name, columns=None, days=None):
+        select = ", ".join(columns) if columns else "*"
+        query = f"select {select} from `{self.dataset}.{table_name}`"
+        if days is not None:
+            # A filter on the partition column, so that only the partitions of these days are scanned.
+            day_list = ", ".join(f"date '{pd.Timestamp(day):%Y-%m-%d}'" for day in days)
+            query += f" where {PARTITION_FIELDS[table_name]} in ({day_list})"
+        return pd.read_gbq(query)
+
+    def delete_batches(self, table_name, batch_ids):
+        """Delete the rows written under some batch ids, e.g. by a failed attempt."""
+        from google.cloud import bigquery
+
+        client = get_bigquery_client()
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("batch_ids", "STRING", list(batch_ids))])
+        try:
+            client.query(f"delete from `{self.dataset}.{table_name}` where batch_id in unnest(@batch_ids)",
+                         job_config=job_config).result()
+        except Exception as error:
+            # Nothing to delete from a table that was not created yet.
+            if getattr(error, "code", None) != 404:
+                raise
+
+
+class FileWriter:
+    """
+    Local stand-in for BigQueryWriter, appending DataFrames as Parquet files in a directory per table.
+
+    Partitioned tables have a subdirectory per day, e.g. `quiz_table/day=2023-01-31/`, so reading
+    or rewriting a day only touches the files of that day.
+
+    Args:
+        directory (str): Root directory of the tables.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, table_name, df):
+        for day, df_day in partitions(table_name, df):
+            table_dir = os.path.join(self.directory, table_name)
+            if day is not None:
+                table_dir = os.path.join(table_dir, f"day={day:%Y-%m-%d}")
+            os.makedirs(table_dir, exist_ok=True)
+
+            path = os.path.join(table_dir, f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet")
+            # Write to a temporary name first, so that readers never see a partial file.
+            df_day.to_parquet(path + ".tmp", index=False)
+            os.replace(path + ".tmp", path)
+
+    def _paths(self, table_name, days=None):
+        """Get the files of a table, only of some days if set."""
+        if days is None:
+            patterns = [os.path.join(self.directory, table_name, "**", "*.parquet")]
+        else:
+            patterns = [os.path.join(self.directory, table_name, f"day={pd.Timestamp(day):%Y-%m-%d}", "*.parquet")
+                        for day in days]
+        return sorted(path for pattern in patterns for path in glob.glob(pattern, recursive=True))
+
+    def read_table(self, table_name, columns=None, days=None):
+        """Read a table, or only some days of a partitioned table."""
+        paths = self._paths(table_name, days)
+        if not paths:
+            return pd.DataFrame(columns=columns)
+        return pd.concat([pd.read_parquet(path, columns=columns) for path in paths], ignore_index=True)
+
+    def delete_batches(self, table_name, batch_ids):
+        """Delete the rows written under some batch ids, rewriting the files that contain them."""
+        for path in self._paths(table_name):
+            df = pd.read_parquet(path)
+            if 'batch_id' not in df.columns:
+                continue
+            is_deleted = df['batch_id'].isin(batch_ids)
+            if is_deleted.all():
+                os.remove(path)
+            elif is_deleted.any():
+                df[~is_deleted].to_parquet(path + ".tmp", index=False)
+                os.replace(path + ".tmp", path)
+
+
+def get_writer(dataset, sink_dir=None):
+    """
+    Get the writer of the output tables.
+
+    Args:
+        dataset (str): The BigQuery dataset, as project.dataset.
+        sink_dir (str): If set, tables are written to this local directory instead of BigQuery.
+
+    Returns:
+        BigQueryWriter or FileWriter: The writer.
+
+    """
+    if sink_dir:
+        return FileWriter(os.path.join(sink_dir, dataset))
+    return BigQueryWriter(dataset)
+
+
+class BatchingSink:
+    """
+    Accumulate output rows and processed file names across files, and write them in batches.
+
+    The pending rows are flushed, with one load per table, once `max_rows` rows are pending or
+    the oldest pending item is `max_seconds` old, by a timer when nothing else is added meanwhile.
+    File names are written to the log table only after the rows of every table were written, so a
+    failed flush never logs a file whose rows are missing. Tables written before a failure are not
+    written again when the flush is retried.
+
+    A flush due to either threshold that fails does not fail the file being added: its rows are kept,
+    and the timer retries the flush, so the rows of the files already added are not left pending until
+    the next file arrives. An explicit `flush`, e.g. on exit, raises if it still fails.
+
+    Rows added with a batch id get it in a 'batch_id' column. Batches passed to `replace` are
+    deleted from every table by the next flush, before any new row is written, so that a retried
+    file replaces the rows of its failed attempt instead of duplicating them.
+
+    Args:
+        writer (BigQueryWriter or FileWriter): Writer of the tables.
+        max_rows (int): Number of pending rows that triggers a flush.
+        max_seconds (float): Age of the oldest pending item that triggers a flush.
+        log_table (str): Name of the table the processed file names are written to.
+        on_logged (callable): Called with the list of file names written to the log table by a flush.
+        on_flushed (callable): Called after each flush that wrote anything, with a dict of the rows
+            written and the seconds taken for each table, keyed by table name.
+
+    """
+
+    def __init__(self, writer, max_rows=1000000, max_seconds=60, log_table="processing_logs", on_logged=None,
+                 on_flushed=None):
+        self.writer = writer
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.log_table = log_table
+        self.on_logged = on_logged
+        self.on_flushed = on_flushed
+
+        self._tables = {}
+        self._logs = []
+        self._replaced = set()
+        self._rows = 0
+        self._first_added_at = None
+        self._timer = None
+        self._closed = False
+        self._lock = threading.RLock()
+
+    @property
+    def rows_pending(self):
+        return self._rows
+
+    def write(self, table_name, df, batch_id=None):
+        """Add rows to a table, optionally under a batch id."""
+        with self._lock:
+            self._append(table_name, df, batch_id)
+            self._flush_if_due()
+
+    def log(self, file_name, batch_id=None):
+        """Add a processed file to the log table, once the rows added before are written."""
+        with self._lock:
+            self._append_log(file_name, batch_id)
+            self._flush_if_due()
+
+    def add(self, file_name, results, batch_id=None, rollups=None):
+        """
+        Add the processed DataFrames of a file, and the file to the log table.
+
+        Args:
+            file_name (str): Name of the processed file.
+            results (dict): Processed DataFrame for each activity type, keyed by activity.
+            batch_id (str): If set, the rows and the log entry of the file are written under this batch id.
+            rollups (dict): Rollup DataFrames of the file, keyed by rollup name, e.g. from `rollup_results`.
+
+        """
+        with self._lock:
+            for activity, df in results.items():
+                self._append(TABLE_NAMES[activity], df, batch_id)
+            for name, df in (rollups or {}).items():
+                self._append(ROLLUP_TABLE_NAMES[name], df, batch_id)
+            self._append_log(file_name, batch_id)
+            self._flush_if_due()
+
+    def add_chunks(self, file_name, chunks, batch_id=None):
+        """
+        Add the processed DataFrames of a file as they are produced, one chunk at a time, and then the file
+        to the log table.
+
+        Rows may be flushed while the file is still being processed. Its rollups are combined across the chunks,
+        and added once for the file. If the chunks fail half-way, the pending rows of the batch are discarded
+        and the file is not logged.
+
+        Args:
+            file_name (str): Name of the processed file.
+            chunks (iterable): Processed DataFrame for each activity type, keyed by activity, of each chunk.
+            batch_id (str): If set, the rows and the log entry of the file are written under this batch id.
+
+        """
+        chunk_rollups = {name: [] for name in ROLLUP_KEYS}
+        try:
+            for results in chunks:
+                for activity, df in results.items():
+                    self.write(TABLE_NAMES[activity], df, batch_id)
+                for name, df in rollup_results(results).items():
+                    chunk_rollups[name].append(df)
+            with self._lock:
+                for name, frames in chunk_rollups.items():
+                    if frames:
+                        self._append(ROLLUP_TABLE_NAMES[name], merge_rollups(frames, name), batch_id)
+                self._append_log(file_name, batch_id)
+                self._flush_if_due()
+        except BaseException:
+            if batch_id is not None:
+                self.discard(batch_id)
+            raise
+
+    def replace(self, batch_id):
+        """Delete the rows written under a batch id by an earlier attempt, before the next rows are written."""
+        with self._lock:
+            self._replaced.add(batch_id)
+
+    def discard(self, batch_id):
+        """
+        Drop the pending rows and log entries of a batch, e.g. of a file that failed half-way.
+
+        Rows of the batch already written by an earlier flush are kept, for a retry to `replace`.
+
+        """
+        with self._lock:
+            for table_name in list(self._tables):
+                kept = [(df_batch_id, df) for df_batch_id, df in self._tables[table_name] if df_batch_id != batch_id]
+                self._rows -= sum(len(df) for df_batch_id, df in self._tables[table_name] if df_batch_id == batch_id)
+                if kept:
+                    self._tables[table_name] = kept
+                else:
+                    del self._tables[table_name]
+            self._logs = [(file_name, log_batch_id) for file_name, log_batch_id in self._logs
+                          if log_batch_id != batch_id]
+            if not self._tables and not self._logs:
+                self._first_added_at = None
+
+    def flush(self):
+        """Write the pending rows of every table, and then the pending file names."""
+        with self._lock:
+            if self._replaced:
+                table_names = list(TABLE_NAMES.values()) + list(ROLLUP_TABLE_NAMES.values()) + [self.log_table]
+                for table_name in table_names:
+                    self.writer.delete_batches(table_name, sorted(self._replaced))
+                self._replaced = set()
+
+            written = {}
+            ingested_at = ingestion_timestamp()
+            for table_name in list(self._tables):
+                df = to_warehouse_types(pd.concat([df for _, df in self._tables[table_name]],
+                                                  ignore_index=True))
+                df = add_partition_day(table_name, df)
+                written[table_name] = self._write(table_name, add_ingestion_timestamp(df, ingested_at))
+                del self._tables[table_name]
+                self._rows -= len(df)
+
+            if self._logs:
+                logged_files = [file_name for file_name, _ in self._logs]
+                df_logs = pd.DataFrame({"filename": logged_files})
+                batch_ids = [batch_id for _, batch_id in self._logs]
+                if any(batch_id is not None for batch_id in batch_ids):
+                    df_logs['batch_id'] = batch_ids
+                df_logs = add_ingestion_timestamp(df_logs, ingested_at)
+                written[self.log_table] = self._write(self.log_table, df_logs)
+                self._logs = []
+                if self.on_logged is not None:
+                    self.on_logged(logged_files)
+
+            self._first_added_at = None
+            if written and self.on_flushed is not None:
+                self.on_flushed(written)
+
+    def _write(self, table_name, df):
+        start = time.perf_counter()
+        self.writer.write(table_name, df)
+        return {"rows": len(df), "seconds": time.perf_counter() - start}
+
+    def _append(self, table_name, df, batch_id=None):
+        if df.empty:
+            return
+        if batch_id is not None:
+            df = df.assign(batch_id=batch_id)
+        self._tables.setdefault(table_name, []).append((batch_id, df))
+        self._rows += len(df)
+        if self._first_added_at is None:
+            self._first_added_at = time.monotonic()
+
+    def _append_log(self, file_name, batch_id=None):
+        self._logs.append((file_name, batch_id))
+        if self._first_added_at is None:
+            self._first_added_at = time.monotonic()
+
+    def _flush_if_due(self):
+        if self._first_added_at is None:
+            return
+        if self._rows >= self.max_rows or time.monotonic() - self._first_added_at >= self.max_seconds:
+            try:
+                self.flush()
+            except Exception as error:
+                print(f"Failed to flush the pending rows, retrying: {error!r}")
+        self._start_timer()
+
+    def _start_timer(self):
+        if self._first_added_at is None or self._timer is not None or self._closed:
+            return
+        delay = self._first_added_at + self.max_seconds - time.monotonic()
+        if delay <= 0:
+            # Already due, so the last flush failed: it is retried after a while.
+            delay = max(self.max_seconds, MIN_RETRY_SECONDS)
+        self._timer = threading.Timer(delay, self._flush_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._flush_if_due()
+
+    def close(self):
+        """Stop the timer, without flushing. The pending rows are dropped with the sink."""
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # Rows of a file that failed half-way are not flushed, as the file is not logged.
+        if exc_type is None:
+            self.flush()
@@ -0,0 +1,65 @@
+"""
+Compare the parse time and the stored size of activity logs in CSV, Parquet and Feather.
+
+Usage, from the repository root:
+    python -m benchmarks.formats --users 50000 --repeat 3
+"""
+import argparse
+import io
+import random
+import time
+
+from activity_io import FILE_FORMATS, read_activity_logs, to_bytes
+from data_generator import DataGenerator
+
+
+def benchmark_formats(df, repeat=3):
+    """
+    Measure the size and the best parse time of activity logs in each file format.
+
+    Args:
+        df (pd.DataFrame): Activity logs in the compact schema.
+        repeat (int): Number of times each file is parsed.
+
+    Returns:
+        list: One dict per file format, with sizes and times scaled to a million rows.
+
+    """
+    scale = 1000000 / len(df)
+    results = []
+    for file_format in FILE_FORMATS.values():
+        contents = to_bytes(df, file_format)
+
+        parse_times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            read_activity_logs(io.BytesIO(contents), file_format=file_format)
+            parse_times.append(time.perf_counter() - start)
+
+        results.append({
+            "format": file_format,
+            "rows": len(df),
+            "mb_per_million_rows": len(contents) * scale / 2 ** 20,
+            "parse_seconds_per_million_rows": min(parse_times) * scale,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50000, help="Number of users to generate records for.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of times each file is parsed.")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    df = DataGenerator("2023-01-01", "2023-01-31").generate_records(args.users)
+
+    print(f"{'format':<10}{'MB / 1M rows':>15}{'parse s / 1M rows':>20}")
+    for result in benchmark_formats(df, args.repeat):
+        print(f"{result['format']:<10}{result['mb_per_million_rows']:>15.2f}"
+              f"{result['parse_seconds_per_million_rows']:>20.3f}")
+
+
+if __name__ == "__main__":
+    main()
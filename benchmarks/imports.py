@@ -0,0 +1,130 @@
+"""
+Benchmark the import time of the cloud function entry points, as paid on a cold start.
+
+Each module is imported in a fresh interpreter with `python -X importtime`, and the cumulative time of
+its import, and of the heaviest packages it loads, is taken from the best of several runs.
+The results can be saved as JSON and compared against a stored baseline.
+
+Usage, from the repository root:
+    python -m benchmarks.imports --output imports.json
+    python -m benchmarks.imports --baseline imports.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.suite import find_regressions
+
+# Modules loaded on a cold start: main.py, loaded for every function, and the module of each entry point.
+ENTRY_MODULES = ["main", "data_generator_gcp", "activity_processor_bq", "activity_processor_gcs_trigger"]
+
+# Root of the repository, the modules are imported from there.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of `python -X importtime`.
+
+    Args:
+        stderr (str): Standard error of the interpreter.
+
+    Returns:
+        list: The name, cumulative seconds and nesting depth of each imported module, in import order:
+            the modules imported by a module are listed before it, one level deeper.
+
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(cumulative) / 10 ** 6, depth))
+    return modules
+
+
+def import_time(module, top=5):
+    """
+    Import a module in a fresh interpreter, and get its import time.
+
+    Args:
+        module (str): Name of the module.
+        top (int): Number of the heaviest modules it imports directly to report.
+
+    Returns:
+        tuple: The import seconds of the module, and a dict of the seconds of its heaviest direct imports.
+
+    """
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT,
+                               capture_output=True, text=True, check=True)
+    modules = parse_importtime(completed.stderr)
+    position = max(i for i, (name, _, depth) in enumerate(modules) if name == module and depth == 0)
+    children = []
+    for name, seconds, depth in reversed(modules[:position]):
+        if depth == 0:
+            break
+        if depth == 1:
+            children.append((name, seconds))
+    children.sort(key=lambda child: -child[1])
+    return modules[position][1], dict(children[:top])
+
+
+def benchmark_module(module, repeat=5):
+    """
+    Measure the import time of a module.
+
+    Args:
+        module (str): Name of the module.
+        repeat (int): Number of imports; the fastest one is kept.
+
+    Returns:
+        dict: The module, its import seconds, and the seconds of its heaviest direct imports.
+
+    """
+    seconds, heaviest = min((import_time(module) for _ in range(repeat)), key=lambda run: run[0])
+    return {"module": module, "seconds": seconds, "heaviest": heaviest}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", default=",".join(ENTRY_MODULES), help="Comma-separated modules to import.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of imports of each module.")
+    parser.add_argument("--output", help="Path of the JSON file the results are saved to.")
+    parser.add_argument("--baseline", help="Path of a JSON file of earlier results to compare with.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown against the baseline.")
+    parser.add_argument("--min-seconds", type=float, default=0.01,
+                        help="Modules faster than this in the baseline are not compared.")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {"python": platform.python_version(), "machine": platform.machine(),
+                 "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "records": [],
+    }
+    for module in args.modules.split(","):
+        record = benchmark_module(module, args.repeat)
+        results["records"].append(record)
+        heaviest = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in record["heaviest"].items())
+        print(f"{module:<34}{record['seconds']:>8.3f}s  ({heaviest})")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold, args.min_seconds, fields=("module",))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Benchmark the ActivityProcessor stages on generated datasets of increasing size.
+
+Each dataset size runs in its own process, so that its peak RSS is measured separately.
+The results can be saved as JSON and compared against a stored baseline. The run fails if `process_all` is
+slower than calling the processor for each activity type by more than the threshold.
+
+Usage, from the repository root:
+    python -m benchmarks.suite --sizes 10k,1M,10M --output results.json
+    python -m benchmarks.suite --sizes 10k,1M --baseline results.json --threshold 0.2
+"""
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from activity_processor import ACTIVITIES, ActivityProcessor
+from data_generator import DataGenerator
+from stage_metrics import StageRecorder
+
+# Average number of generated records per user, used to size the datasets.
+RECORDS_PER_USER = 3.8
+
+
+def parse_size(size):
+    """Parse a number of rows such as '10k' or '1M'."""
+    multipliers = {"k": 10 ** 3, "m": 10 ** 6}
+    if size[-1].lower() in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1].lower()])
+    return int(size)
+
+
+def time_stages(df, activity):
+    """
+    Run the processor for an activity, timing each of its stages.
+
+    Args:
+        df (pd.DataFrame): Input DataFrame.
+        activity (str): The type of activity to process.
+
+    Returns:
+        dict: Seconds taken by each stage.
+
+    """
+    recorder = StageRecorder()
+    ActivityProcessor(on_stage=recorder).processor(df, activity)
+    return {stage: totals["seconds"] for stage, totals in recorder.totals().items()}
+
+
+def best_of(repeat, func, *args):
+    """Run a function several times, returning the smallest time taken."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_size(rows, repeat=3, seed=1234):
+    """
+    Generate a dataset of about `rows` rows and benchmark the processor on it.
+
+    Args:
+        rows (int): Target number of rows.
+        repeat (int): Number of runs of each measurement; the fastest one is kept.
+        seed (int): Seed of the generated dataset.
+
+    Returns:
+        dict: The number of rows, the peak RSS in MB and one record per measured stage.
+
+    """
+    df = DataGenerator("2023-01-01", "2023-01-31").generate_frame(max(1, round(rows / RECORDS_PER_USER)), seed=seed)
+    processor = ActivityProcessor()
+
+    records = []
+
+    def add_record(activity, stage, seconds):
+        records.append({"rows": len(df), "activity": activity, "stage": stage, "seconds": seconds,
+                        "rows_per_second": len(df) / seconds if seconds > 0 else None})
+
+    processor_seconds = 0
+    for activity in ACTIVITIES:
+        runs = [time_stages(df, activity) for _ in range(repeat)]
+        for stage in runs[0]:
+            add_record(activity, stage, min(timings[stage] for timings in runs))
+        seconds = best_of(repeat, processor.processor, df, activity)
+        add_record(activity, "processor", seconds)
+        processor_seconds += seconds
+    # process_all replaces a call of the processor per activity type, which it should not be slower than.
+    add_record("all", "processor", processor_seconds)
+    add_record("all", "process_all", best_of(repeat, processor.process_all, df))
+
+    # ru_maxrss is in KB on Linux, and in bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 2 ** 20 if sys.platform == "darwin" else peak_rss / 2 ** 10
+
+    return {"rows": len(df), "peak_rss_mb": peak_rss_mb, "records": records}
+
+
+def find_regressions(results, baseline, threshold, min_seconds, fields=("size", "activity", "stage")):
+    """
+    Compare results with a baseline.
+
+    Args:
+        results (dict): Benchmark results.
+        baseline (dict): Baseline results, from an earlier run.
+        threshold (float): Allowed relative slowdown, e.g. 0.2 for 20%.
+        min_seconds (float): Records faster than this in the baseline are ignored, as too noisy.
+        fields (tuple): Fields identifying a record in both results, e.g. its stage.
+
+    Returns:
+        list: A message for each record slower than the baseline by more than the threshold.
+
+    """
+    def key(record):
+        return tuple(record[field] for field in fields)
+
+    baseline_seconds = {key(record): record["seconds"] for record in baseline["records"]}
+
+    regressions = []
+    for record in results["records"]:
+        expected = baseline_seconds.get(key(record))
+        if expected is None or expected < min_seconds:
+            continue
+        if record["seconds"] > expected * (1 + threshold):
+            regressions.append(f"{'/'.join(key(record))}: {record['seconds']:.4f}s vs {expected:.4f}s baseline")
+    return regressions
+
+
+def find_slow_process_all(results, threshold, min_seconds):
+    """
+    Compare the time of `process_all` with the time of calling the processor for each activity type.
+
+    Args:
+        results (dict): Benchmark results.
+        threshold (float): Allowed relative slowdown, e.g. 0.2 for 20%.
+        min_seconds (float): Sizes where the processor calls take less than this are ignored, as too noisy.
+
+    Returns:
+        list: A message for each size where `process_all` is slower than the processor calls by more than the
+            threshold.
+
+    """
+    seconds = {(record["size"], record["stage"]): record["seconds"]
+               for record in results["records"] if record["activity"] == "all"}
+
+    slow = []
+    for (size, stage), expected in seconds.items():
+        if stage != "processor" or expected < min_seconds or (size, "process_all") not in seconds:
+            continue
+        if seconds[size, "process_all"] > expected * (1 + threshold):
+            slow.append(f"{size}/all/process_all: {seconds[size, 'process_all']:.4f}s vs {expected:.4f}s "
+                        f"for the processor of each activity type")
+    return slow
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10k,1M,10M", help="Comma-separated numbers of rows, e.g. 10k,1M,10M.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each measurement.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="Path of the JSON file the results are saved to.")
+    parser.add_argument("--baseline", help="Path of a JSON file of earlier results to compare with.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown against the baseline.")
+    parser.add_argument("--min-seconds", type=float, default=0.005,
+                        help="Stages faster than this in the baseline are not compared.")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                 "machine": platform.machine(), "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "peak_rss_mb": {},
+        "records": [],
+    }
+    for size in args.sizes.split(","):
+        # A fresh process per size, so that the peak RSS is not carried over from larger sizes.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            size_results = executor.submit(benchmark_size, parse_size(size), args.repeat, args.seed).result()
+
+        results["peak_rss_mb"][size] = size_results["peak_rss_mb"]
+        for record in size_results["records"]:
+            results["records"].append({"size": size, **record})
+            print(f"{size:>6} {record['activity']:<10}{record['stage']:<28}{record['seconds']:>10.4f}s"
+                  f"{record['rows_per_second'] or 0:>16,.0f} rows/s")
+        print(f"{size:>6} peak RSS: {size_results['peak_rss_mb']:.0f} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressions = find_slow_process_all(results, args.threshold, args.min_seconds)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions += find_regressions(results, baseline, args.threshold, args.min_seconds)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,36 @@
 import numpy as np
 import pandas as pd
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 import time
 
+from activity_io import ROW_GROUP_SIZE, ActivityLogWriter, read_activity_logs, write_activity_logs
+from activity_schema import (ACTIVITY_CONFIG, ACTIVITY_LOG_DTYPES, ACTIVITY_STAGES, ACTIVITY_STATUSES,
+                             ACTIVITY_TYPES, SCORED_ACTIVITY_TYPES, apply_schema)
+
 
 class DataGenerator:
+    ACTIVITIES = ACTIVITY_TYPES
+    # The weights of the types, in the order of ACTIVITIES, scaled to sum to 1.
+    ACT_WEIGHTS = [ACTIVITY_CONFIG[activity]["weight"] / sum(config["weight"] for config in ACTIVITY_CONFIG.values())
+                   for activity in ACTIVITIES]
+
+    # We add a None stage to simulate an incomplete record.
+    STAGES = ['start', 'complete', 'abandon', None]
+    STG_WEIGHTS = [0.0, 0.7, 0.2, 0.1]
+
+    SCORABLE_ACTIVITIES = SCORED_ACTIVITY_TYPES
+
     def __init__(self, start_date, end_date):
         self.start_date = start_date
         self.end_date = end_date
 
+        # Parse the dates once, rather than for every generated timestamp.
+        self.start_datetime = datetime.strptime(start_date, "%Y-%m-%d")
+        self.end_datetime = datetime.strptime(end_date, "%Y-%m-%d")
+
     @staticmethod
     def get_activity():
         """
@@ -18,9 +39,7 @@ class DataGenerator:
         Returns:
             str: A randomly selected activity type.
         """
-        activities = ['Quiz', 'Video', 'Challenge']
-        act_weights = [0.4, 0.3, 0.3]
-        return random.choices(activities, act_weights)[0]  # random.choices returns a list
+        return random.choices(DataGenerator.ACTIVITIES, DataGenerator.ACT_WEIGHTS)[0]  # random.choices returns a list
 
     @staticmethod
     def get_stage():
@@ -29,11 +48,7 @@ class DataGenerator:
         Returns:
             str: A randomly selected stage type.
         """
-
-        # We add a None stage to simulate an incomplete record.
-        stages = ['start', 'complete', 'abandon', None]
-        stg_weights = [0.0, 0.7, 0.2, 0.1]
-        return random.choices(stages, stg_weights)[0]  # random.choices returns a list
+        return random.choices(DataGenerator.STAGES, DataGenerator.STG_WEIGHTS)[0]  # random.choices returns a list
 
     # Define a function to generate a random timestamp between two given dates
 
@@ -44,12 +59,8 @@ class DataGenerator:
         Returns:
             datetime.datetime: A randomly generated timestamp.
         """
-        # Convert the input dates to datetime objects
-        start_datetime = datetime.strptime(self.start_date, "%Y-%m-%d")
-        end_datetime = datetime.strptime(self.end_date, "%Y-%m-%d")
-
         # Calculate the time range in seconds
-        time_range = (end_datetime - start_datetime).total_seconds()
+        time_range = (self.end_datetime - self.start_datetime).total_seconds()
 
         # Generate a random number of seconds within the time range
         random_seconds = random.uniform(0, time_range)
@@ -58,7 +69,7 @@ class DataGenerator:
         random_timedelta = timedelta(seconds=random_seconds)
 
         # Add the random timedelta to the start datetime to get the random datetime
-        random_datetime = start_datetime + random_timedelta
+        random_datetime = self.start_datetime + random_timedelta
 
         return random_datetime
 
@@ -102,7 +113,7 @@ class DataGenerator:
             num_users (int): The number of users for which records will be generated.
 
         Returns:
-            pandas.DataFrame: A DataFrame containing the generated activity records.
+            pandas.DataFrame: A DataFrame containing the generated activity records, in the compact schema.
         """
         # Generate a list of 100 random user IDs
         user_ids = self.generate_user_ids(num_users)
@@ -146,8 +157,8 @@ class DataGenerator:
                            "user_id": user_id,
                            "activity_stage": act_stg,
                            "activity_type": act,
-                           "score": random.randint(0, 100) if act in ['Quiz',
-                                                                      'Challenge'] and stg == 'complete' else None}
+                           "score": (random.randint(0, 100) if act in self.SCORABLE_ACTIVITIES and stg == 'complete'
+                                     else None)}
 
                     # Add the record to the list of records
                     records.append(rec)
@@ -155,7 +166,264 @@ class DataGenerator:
                     # Update the timestamp for the next stage
                     timestamp = self.update_timestamp(timestamp)
 
-        return pd.DataFrame(records)
+        return apply_schema(pd.DataFrame(records))
+
+    def generate_frame(self, num_users, seed=None):
+        """
+        Generates activity records for a specified number of users, drawing every value as a NumPy array.
+
+        The records follow the same distributions as `generate_records`, but are several orders of
+        magnitude faster to produce. Timestamps are converted to epoch seconds with the local time
+        offset of the start date.
+
+        Args:
+            num_users (int): The number of users for which records will be generated.
+            seed (int): Seed of the random generator, for reproducible records.
+
+        Returns:
+            pandas.DataFrame: A DataFrame containing the generated activity records, in the compact schema.
+        """
+        rng = np.random.default_rng(seed)
+
+        # Draw the users and a random number of activities (between 1 and 3) for each of them
+        user_ids = rng.integers(100000, 999999, size=num_users, endpoint=True)
+        num_activities = rng.integers(1, 3, size=num_users, endpoint=True)
+        num_acts = int(num_activities.sum())
+
+        # Draw the activities, with their type, second stage, start time, duration and score
+        act_user_ids = np.repeat(user_ids, num_activities)
+        activity_ids = rng.integers(10 ** 9, 10 ** 10 - 1, size=num_acts, endpoint=True)
+        act_idx = rng.choice(len(self.ACTIVITIES), size=num_acts, p=self.ACT_WEIGHTS)
+        stg_idx = rng.choice(len(self.STAGES), size=num_acts, p=self.STG_WEIGHTS)
+        time_range = (self.end_datetime - self.start_datetime).total_seconds()
+        start_epoch = int(time.mktime(self.start_datetime.timetuple()))
+        start_ts = start_epoch + np.floor(rng.uniform(0, time_range, size=num_acts)).astype(np.int64)
+        durations = rng.integers(30, 120, size=num_acts, endpoint=True)
+        scores = rng.integers(0, 100, size=num_acts, endpoint=True)
+
+        # Every activity has a start record, and a second one unless it was left unfinished
+        num_records = 1 + np.array([stg is not None for stg in self.STAGES])[stg_idx]
+        rec_act = np.repeat(np.arange(num_acts), num_records)
+        is_second = np.arange(len(rec_act)) - np.repeat(np.cumsum(num_records) - num_records, num_records)
+        rec_stg_idx = np.where(is_second == 1, stg_idx[rec_act], self.STAGES.index('start'))
+
+        # Look up the schema codes of the activity types and stages
+        act_codes = np.array([ACTIVITY_TYPES.index(act) for act in self.ACTIVITIES])
+        stg_codes = np.array([[ACTIVITY_STAGES.index(f"{act}_{stg}") if stg else -1 for stg in self.STAGES]
+                              for act in self.ACTIVITIES])
+        rec_act_idx = act_idx[rec_act]
+
+        is_scorable = np.isin(np.array(self.ACTIVITIES), self.SCORABLE_ACTIVITIES)[rec_act_idx]
+        has_score = is_scorable & (rec_stg_idx == self.STAGES.index('complete'))
+
+        return pd.DataFrame({
+            "activity_id": activity_ids[rec_act],
+            "timestamp": (start_ts[rec_act] + durations[rec_act] * is_second).astype(ACTIVITY_LOG_DTYPES['timestamp']),
+            "user_id": act_user_ids[rec_act].astype(ACTIVITY_LOG_DTYPES['user_id']),
+            "activity_stage": pd.Categorical.from_codes(stg_codes[rec_act_idx, rec_stg_idx],
+                                                        dtype=ACTIVITY_LOG_DTYPES['activity_stage']),
+            "activity_type": pd.Categorical.from_codes(act_codes[rec_act_idx],
+                                                       dtype=ACTIVITY_LOG_DTYPES['activity_type']),
+            "score": pd.arrays.IntegerArray(scores[rec_act].astype(np.int8), ~has_score),
+        })
+
+    def generate_batches(self, num_users, batch_users=100000, seed=None):
+        """
+        Generates activity records like `generate_frame`, in batches of users, so that only one batch is in memory.
+
+        Each batch gets a seed derived from `seed`, so the batches are the same records as the shards of
+        `generate_shards` with as many users per shard.
+
+        Args:
+            num_users (int): The number of users for which records will be generated.
+            batch_users (int): The number of users in each batch.
+            seed (int): Seed of the random generator, for reproducible records.
+
+        Yields:
+            pandas.DataFrame: The activity records of each batch, in the compact schema.
+        """
+        num_batches = -(-num_users // batch_users)
+        batch_seeds = np.random.SeedSequence(seed).spawn(num_batches)
+        for i, batch_seed in enumerate(batch_seeds):
+            yield self.generate_frame(min(batch_users, num_users - i * batch_users), seed=batch_seed)
+
+    def generate_adversarial_frame(self, num_users, seed=None, duplicate_timestamps=0.0, extra_stages=0.0,
+                                   missing_scores=0.0, orphan_completes=0.0, null_stages=0.0, duplicate_rows=0.0,
+                                   mismatched_stages=0.0, shuffle=False):
+        """
+        Generates activity records like `generate_frame`, with edge cases injected at the given rates.
+
+        The records of each activity stay next to each other, in timestamp order, unless `shuffle` is set.
+
+        Args:
+            num_users (int): The number of users for which records will be generated.
+            seed (int): Seed of the random generator, for reproducible records.
+            duplicate_timestamps (float): Fraction of activities whose records all share the start timestamp.
+            extra_stages (float): Fraction of activities with 1 to 3 more records after the last one,
+                e.g. a restart or a second completion, some of them at the same timestamp.
+            missing_scores (float): Fraction of the completions of scored activities without a score.
+            orphan_completes (float): Fraction of activities whose start record is dropped.
+            null_stages (float): Fraction of the records after a start without a stage.
+            duplicate_rows (float): Fraction of the records that are repeated.
+            mismatched_stages (float): Fraction of the records after a start with the stage of another activity
+                type, e.g. a 'Challenge_complete' in a quiz, half of them without a score.
+            shuffle (bool): Whether to shuffle the records.
+
+        Returns:
+            pandas.DataFrame: A DataFrame containing the generated activity records, in the compact schema.
+        """
+        rng = np.random.default_rng(None if seed is None else [seed, 1])
+        df = self.generate_frame(num_users, seed=seed).astype({"activity_stage": object, "activity_type": object})
+        df['order'] = np.arange(len(df), dtype=float)
+
+        def pick(num, rate):
+            return rng.random(num) < rate
+
+        # Extra stages after the last record of some activities, at the same or later timestamps
+        df_last = df.drop_duplicates('activity_id', keep='last')
+        df_last = df_last[pick(len(df_last), extra_stages)]
+        num_extra = rng.integers(1, 3, size=len(df_last), endpoint=True)
+        df_extra = df_last.loc[df_last.index.repeat(num_extra)].reset_index(drop=True)
+        step = np.arange(len(df_extra)) - np.repeat(np.cumsum(num_extra) - num_extra, num_extra) + 1
+        gaps = rng.integers(0, 120, size=len(df_extra), endpoint=True) * pick(len(df_extra), 0.7)
+        offsets = pd.Series(gaps).groupby(np.repeat(np.arange(len(df_last)), num_extra)).cumsum().to_numpy()
+        df_extra['timestamp'] = df_extra['timestamp'].to_numpy(np.int64) + offsets
+        statuses = np.array(ACTIVITY_STATUSES)[rng.integers(0, len(ACTIVITY_STATUSES), size=len(df_extra))]
+        df_extra['activity_stage'] = df_extra['activity_type'] + "_" + statuses
+        is_scored = df_extra['activity_type'].isin(self.SCORABLE_ACTIVITIES).to_numpy()
+        is_scored_complete = is_scored & (statuses == "complete")
+        df_extra['score'] = pd.array(np.where(is_scored_complete, rng.integers(0, 100, size=len(df_extra),
+                                                                               endpoint=True), 0), dtype="Int8")
+        df_extra.loc[~is_scored_complete, 'score'] = pd.NA
+        df_extra['order'] += step / 4
+        df = pd.concat([df, df_extra], ignore_index=True).sort_values('order', kind='stable', ignore_index=True)
+
+        # Every record of some activities at the start timestamp
+        activity_ids = df['activity_id'].unique()
+        tied = activity_ids[pick(len(activity_ids), duplicate_timestamps)]
+        is_tied = df['activity_id'].isin(tied)
+        first_timestamps = df.groupby('activity_id', sort=False)['timestamp'].transform('first')
+        df.loc[is_tied, 'timestamp'] = first_timestamps[is_tied]
+
+        # Scored completions without a score
+        is_complete = df['activity_stage'].str.endswith("_complete").fillna(False).to_numpy()
+        df.loc[is_complete & pick(len(df), missing_scores), 'score'] = pd.NA
+
+        # Records after a start without a stage
+        is_first = ~df['activity_id'].duplicated().to_numpy()
+        df.loc[~is_first & pick(len(df), null_stages), 'activity_stage'] = None
+
+        # Records after a start with the stage of another activity type, some of them completions without a score
+        is_mismatched = ~is_first & pick(len(df), mismatched_stages)
+        type_positions = pd.Categorical(df.loc[is_mismatched, 'activity_type'], categories=ACTIVITY_TYPES).codes
+        shifts = rng.integers(1, len(ACTIVITY_TYPES), size=len(type_positions))
+        other_types = np.array(ACTIVITY_TYPES)[(type_positions + shifts) % len(ACTIVITY_TYPES)]
+        statuses = np.array(ACTIVITY_STATUSES)[rng.integers(0, len(ACTIVITY_STATUSES), size=len(type_positions))]
+        df.loc[is_mismatched, 'activity_stage'] = [f"{activity}_{status}"
+                                                   for activity, status in zip(other_types, statuses)]
+        df.loc[is_mismatched & pick(len(df), 0.5), 'score'] = pd.NA
+
+        # Activities without their start record
+        orphans = activity_ids[pick(len(activity_ids), orphan_completes)]
+        df = df[~(is_first & df['activity_id'].isin(orphans).to_numpy())]
+
+        # Repeated records, right after the original one
+        df_repeated = df[pick(len(df), duplicate_rows)].copy()
+        df_repeated['order'] += 0.1
+        df = pd.concat([df, df_repeated]).sort_values('order', kind='stable')
+
+        if shuffle:
+            df = df.iloc[rng.permutation(len(df))]
+        return apply_schema(df.drop(columns='order').reset_index(drop=True))
+
+
+def generate_shard(start_date, end_date, num_users, seed, path):
+    """
+    Generates the activity records of one shard and writes them to a file.
+
+    Args:
+        start_date (str): Start of the timestamps, as YYYY-MM-DD.
+        end_date (str): End of the timestamps, as YYYY-MM-DD.
+        num_users (int): The number of users in the shard.
+        seed (numpy.random.SeedSequence): Seed of the shard.
+        path (str): Path of the shard file. The format is detected from the extension.
+
+    Returns:
+        str: The path of the shard file.
+    """
+    df = DataGenerator(start_date, end_date).generate_frame(num_users, seed=seed)
+    write_activity_logs(df, path)
+    return path
+
+
+def stream_records(start_date, end_date, num_users, destination, seed=None, batch_users=100000, file_format=None):
+    """
+    Generates activity records for any number of users into a single file, with a memory bounded by one batch.
+
+    Each batch of `batch_users` users is generated and appended to the file, e.g. as a Parquet row group,
+    before the next one is generated. Written to a stream, such as `Storage.open(name, "wb")`, the file is
+    uploaded in chunks as it is written.
+
+    Args:
+        start_date (str): Start of the timestamps, as YYYY-MM-DD.
+        end_date (str): End of the timestamps, as YYYY-MM-DD.
+        num_users (int): The number of users for which records will be generated.
+        destination (str or file-like): Path of the file, or an open binary file.
+        seed (int): Seed of the random generator, for reproducible records.
+        batch_users (int): The number of users generated at a time.
+        file_format (str): Format of the file: csv, parquet or feather. Detected from the path if not set.
+
+    Returns:
+        int: The number of records written.
+    """
+    data_generator = DataGenerator(start_date, end_date)
+    with ActivityLogWriter(destination, file_format) as writer:
+        for df in data_generator.generate_batches(num_users, batch_users, seed=seed):
+            writer.write(df)
+    return writer.rows_written
+
+
+def generate_shards(start_date, end_date, num_users, output_dir, seed=None, users_per_shard=100000,
+                    workers=None, file_format="parquet", concat=False):
+    """
+    Generates activity records for a large number of users in shards, across a pool of processes.
+
+    The users are split into shards of `users_per_shard` users, and each shard gets a seed derived
+    from `seed`. The records are therefore the same whatever the number of workers.
+
+    Args:
+        start_date (str): Start of the timestamps, as YYYY-MM-DD.
+        end_date (str): End of the timestamps, as YYYY-MM-DD.
+        num_users (int): The number of users for which records will be generated.
+        output_dir (str): Directory the shard files are written to.
+        seed (int): Seed of the random generator, for reproducible records.
+        users_per_shard (int): The number of users in each shard.
+        workers (int): The number of worker processes. Defaults to the number of CPUs.
+        file_format (str): Format of the files: csv, parquet or feather.
+        concat (bool): Indicates if the shards are also concatenated into a single file.
+
+    Returns:
+        list: Paths of the shard files, or of the concatenated file if `concat` is set.
+    """
+    num_shards = -(-num_users // users_per_shard)
+    shard_users = [min(users_per_shard, num_users - i * users_per_shard) for i in range(num_shards)]
+    shard_seeds = np.random.SeedSequence(seed).spawn(num_shards)
+    shard_paths = [os.path.join(output_dir, f"shard_{i:05d}.{file_format}") for i in range(num_shards)]
+
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shard_paths = list(executor.map(generate_shard, [start_date] * num_shards, [end_date] * num_shards,
+                                        shard_users, shard_seeds, shard_paths))
+
+    if not concat:
+        return shard_paths
+
+    path = os.path.join(output_dir, f"activity_logs.{file_format}")
+    with ActivityLogWriter(path) as writer:
+        for shard_path in shard_paths:
+            for df in read_activity_logs(shard_path, chunksize=ROW_GROUP_SIZE):
+                writer.write(df)
+    return [path]
 
 
 if __name__ == "__main__":
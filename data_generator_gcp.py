@@ -1,27 +1,59 @@
-from data_generator import DataGenerator
-import random
-import numpy as np
-from google.cloud import storage
+from data_generator import DataGenerator, generate_shards, stream_records
+from activity_io import CONTENT_TYPES, to_bytes
+from storage_backend import get_storage
+import os
+import tempfile
 import time
 
+# Format of the uploaded files: csv, parquet or feather.
+file_format = os.environ.get("FILE_FORMAT", "parquet")
+
+# Storage the files are uploaded to. Set STORAGE_URL to a local directory to run without cloud access.
+storage_url = os.environ.get("STORAGE_URL", "gs://hom_case_study")
+
+# Larger requests are generated in shards of this many users, one file each.
+users_per_shard = int(os.environ.get("USERS_PER_SHARD", 100000))
+
+# Set STREAM_FILE to 1 to upload larger requests as a single file instead, generated BATCH_USERS users at a time
+# and streamed to the bucket in chunks, so the memory used does not depend on the number of users.
+stream_file = os.environ.get("STREAM_FILE") == "1"
+batch_users = int(os.environ.get("BATCH_USERS", 10000))
+
 
 def generate_data(request=None):
     seed = int(time.time())
-    random.seed(seed)
-    np.random.seed = seed
-    print(f"Dummy generation started. Seed: {seed}")
+    num_users = int(request.args.get("num_users", 100)) if request else 100
+    print(f"Dummy generation started. Seed: {seed}. Users: {num_users}")
     start_date = "2023-01-01"
     end_date = "2023-01-31"
 
-    data_generator = DataGenerator(start_date, end_date)
-    df = data_generator.generate_records(100)
+    bucket = get_storage(storage_url)
+
+    if num_users <= users_per_shard:
+        data_generator = DataGenerator(start_date, end_date)
+        df = data_generator.generate_frame(num_users, seed=seed)
+
+        dest = f'raw_data/data_{seed}.{file_format}'
+        print(f"Uploading generated table to: {dest}")
+        bucket.write(dest, to_bytes(df, file_format), CONTENT_TYPES[file_format])
+        return {"Status": "Success"}
 
-    client = storage.Client()
-    bucket = client.get_bucket('hom_case_study')
+    if stream_file:
+        dest = f'raw_data/data_{seed}.{file_format}'
+        print(f"Streaming generated records to: {dest}")
+        # The file is only written under its name once every batch is uploaded, so a failed request leaves none.
+        with bucket.open(dest, "wb", CONTENT_TYPES[file_format]) as f:
+            stream_records(start_date, end_date, num_users, f, seed=seed, batch_users=batch_users,
+                           file_format=file_format)
+        return {"Status": "Success"}
 
-    dest = f'raw_data/data_{seed}.csv'
-    print(f"Uploading generated table to: {dest}")
-    bucket.blob(dest).upload_from_string(df.to_csv(index=False), 'text/csv')
+    with tempfile.TemporaryDirectory() as output_dir:
+        shard_paths = generate_shards(start_date, end_date, num_users, output_dir, seed=seed,
+                                      users_per_shard=users_per_shard, file_format=file_format)
+        for shard_idx, shard_path in enumerate(shard_paths):
+            dest = f'raw_data/data_{seed}_{shard_idx:05d}.{file_format}'
+            print(f"Uploading generated shard to: {dest}")
+            bucket.upload(dest, shard_path, CONTENT_TYPES[file_format])
     return {"Status": "Success"}
 
 
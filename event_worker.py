@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import activity_processor_gcs_trigger as trigger
+from batch_sink import BatchingSink, get_writer
+from ingestion_ledger import IngestionLedger
+from parallel_ingest import file_opener, ingest_files
+from session_store import SessionStore
+from stage_metrics import emit_metrics
+from storage_backend import get_storage
+
+
+class EventWorker:
+    """
+    Long-running ingestion of storage events, as an alternative to one function invocation per file.
+
+    Events are queued, and coalesced into batches: a batch is closed once no event arrived for
+    `debounce_seconds`, `max_wait_seconds` after its first event, or once it holds `max_batch_files`
+    files. Repeated events of the same object are ingested once. The files of a batch are read,
+    processed and uploaded concurrently with `ingest_files`, reusing the storage clients, the process
+    pool and the sink of the worker, and the next batch is collected meanwhile.
+
+    The queue of events holds at most `max_pending` events, and only one batch waits for the one being
+    ingested, so when the sink is slow, `submit` blocks instead of buffering events without bound.
+
+    Files are claimed in the ingestion ledger of the trigger, and written under the batch id of their claim,
+    with the settings of `activity_processor_gcs_trigger`. With its SESSION_STORE_PATH, the activities left
+    open at the edge of the files are paired across files in one session store, saved after each batch.
+
+    Args:
+        debounce_seconds (float): Time without events that closes a batch.
+        max_wait_seconds (float): Maximum time a batch stays open after its first event.
+        max_batch_files (int): Maximum number of files in a batch.
+        max_pending (int): Maximum number of queued events.
+        io_workers (int): Number of files read, processed or uploaded at once.
+        cpu_workers (int): Number of processes running the processor; 0 processes files in the I/O threads.
+
+    """
+
+    def __init__(self, debounce_seconds=1.0, max_wait_seconds=10.0, max_batch_files=500, max_pending=10000,
+                 io_workers=8, cpu_workers=None):
+        self.debounce_seconds = debounce_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.max_batch_files = max_batch_files
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.stats = {"events": 0, "batches": 0, "ingested": 0, "skipped": 0, "failed": 0}
+
+        self._events = asyncio.Queue(max_pending)
+        self._batches = asyncio.Queue(1)
+        self._claims = {}
+        self._sink = None
+        self._process_pool = None
+        self._session_store = None
+
+    async def submit(self, event):
+        """Queue a storage event, waiting while the queue is full."""
+        await self._events.put(event)
+
+    async def close(self):
+        """Stop the worker once the events queued so far are ingested."""
+        await self._events.put(None)
+
+    async def run(self):
+        """Ingest the queued events until the worker is closed."""
+        on_flushed = (lambda tables: emit_metrics("batch_written", tables=tables)) if trigger.profile_stages else None
+        self._sink = BatchingSink(get_writer(trigger.dataset, trigger.sink_dir), max_rows=trigger.batch_rows,
+                                  max_seconds=trigger.batch_seconds, on_logged=self._on_logged,
+                                  on_flushed=on_flushed)
+        self._process_pool = ProcessPoolExecutor(self.cpu_workers) if self.cpu_workers != 0 else None
+        self._session_store = (SessionStore(trigger.session_store_path, trigger.max_open_seconds)
+                               if trigger.session_store_path else None)
+        try:
+            await asyncio.gather(self._collect(), self._ingest_batches())
+        finally:
+            self._sink.close()
+            if self._process_pool is not None:
+                self._process_pool.shutdown()
+        return self.stats
+
+    async def _collect(self):
+        """Coalesce the queued events into batches of files, keyed by bucket and name."""
+        loop = asyncio.get_running_loop()
+        closed = False
+        while not closed:
+            event = await self._events.get()
+            if event is None:
+                break
+            batch = {}
+            deadline = loop.time() + self.max_wait_seconds
+            while True:
+                self.stats["events"] += 1
+                if trigger.is_relevant(event):
+                    batch[(event['bucket'], event['name'])] = event
+                timeout = min(self.debounce_seconds, deadline - loop.time())
+                if len(batch) >= self.max_batch_files or timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._events.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    closed = True
+                    break
+            if batch:
+                await self._batches.put(list(batch))
+        await self._batches.put(None)
+
+    async def _ingest_batches(self):
+        while True:
+            batch = await self._batches.get()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            buckets = {}
+            for bucket_name, file_name in batch:
+                buckets.setdefault(bucket_name, []).append(file_name)
+            for bucket_name, file_names in buckets.items():
+                try:
+                    await self._ingest(bucket_name, file_names)
+                except Exception as error:
+                    # The claims of the files are released by _ingest, so their events can be retried.
+                    print(f"Failed to ingest batch of {len(file_names)} files from {bucket_name}: {error!r}")
+                    self.stats["failed"] += len(file_names)
+            self.stats["batches"] += 1
+            if trigger.profile_stages:
+                emit_metrics("events_batch_ingested", files=len(batch), seconds=time.perf_counter() - start,
+                             queued_events=self._events.qsize())
+
+    async def _ingest(self, bucket_name, file_names):
+        bucket = get_storage(trigger.storage_url or f"gs://{bucket_name}")
+        ledger = IngestionLedger(get_storage(trigger.ledger_url) if trigger.ledger_url else bucket,
+                                 claim_seconds=trigger.claim_seconds)
+
+        async def claim(file_name):
+            try:
+                content_hash = await asyncio.to_thread(bucket.content_hash, file_name)
+            except FileNotFoundError:
+                # Deleted since the event was sent.
+                return None
+            file_claim = await asyncio.to_thread(ledger.claim, file_name, content_hash)
+            return None if file_claim is None else dict(file_claim, ledger=ledger, content_hash=content_hash)
+
+        claims = dict(zip(file_names, await asyncio.gather(*map(claim, file_names))))
+        claimed_files = [file_name for file_name in file_names if claims[file_name] is not None]
+        self.stats["skipped"] += len(file_names) - len(claimed_files)
+        self._claims.update({file_name: claims[file_name] for file_name in claimed_files})
+
+        def upload(file_name, chunks):
+            file_claim = claims[file_name]
+            if file_claim["retry"]:
+                self._sink.replace(file_claim["batch_id"])
+            self._sink.add_chunks(file_name, chunks, batch_id=file_claim["batch_id"])
+
+        on_metrics = (lambda metrics: emit_metrics("file_ingested", **metrics)) if trigger.profile_stages else None
+        try:
+            ingested_files, failed_files = await asyncio.to_thread(
+                ingest_files, claimed_files, file_opener(bucket, trigger.chunk_size), upload,
+                io_workers=self.io_workers, cpu_workers=self.cpu_workers, chunksize=trigger.chunk_size,
+                on_metrics=on_metrics, session_store=self._session_store,
+                process_pool=self._process_pool)
+            # Written at the end of each batch, so that files are not left pending while no event arrives.
+            await asyncio.to_thread(self._sink.flush)
+        except Exception:
+            for file_name in claimed_files:
+                self._release(file_name)
+            raise
+        for file_name, error in failed_files.items():
+            print(f"Failed to ingest file: {file_name}: {error!r}")
+            self._release(file_name)
+        if self._session_store is not None:
+            # Only the updates of the files whose outputs and pairs were written, so a released file is paired
+            # again by its retry.
+            await asyncio.to_thread(self._session_store.save)
+        self.stats["ingested"] += len(ingested_files)
+        self.stats["failed"] += len(failed_files)
+
+    def _on_logged(self, file_names):
+        for file_name in file_names:
+            file_claim = self._claims.pop(file_name, None)
+            if file_claim is None:
+                # Released after a failure, its pending rows dropped.
+                continue
+            if self._session_store is not None:
+                self._session_store.commit([file_name])
+            file_claim["ledger"].complete(file_name, file_claim["content_hash"])
+
+    def _release(self, file_name):
+        file_claim = self._claims.pop(file_name, None)
+        if file_claim is not None:
+            # Its pending rows are dropped, so that a later flush does not log the file while it is released.
+            self._sink.discard(file_claim["batch_id"])
+            if self._session_store is not None:
+                self._session_store.discard(file_name)
+            file_claim["ledger"].release(file_name, file_claim["content_hash"])
+
+
+async def read_events(f):
+    """
+    Read storage events from a file of JSON lines, e.g. exported notifications or stdin.
+
+    Args:
+        f (file): Text file object, with one event with a 'bucket' and a 'name' per line.
+
+    Yields:
+        dict: The events.
+
+    """
+    while True:
+        line = await asyncio.to_thread(f.readline)
+        if not line:
+            return
+        if line.strip():
+            yield json.loads(line)
+
+
+async def run_worker(events, **kwargs):
+    """
+    Ingest a stream of storage events with an EventWorker.
+
+    Args:
+        events (async iterable): The storage events, e.g. from `read_events`.
+        **kwargs: Options of the EventWorker.
+
+    Returns:
+        dict: Counts of the events, batches, and ingested, skipped and failed files.
+
+    """
+    worker = EventWorker(**kwargs)
+    task = asyncio.create_task(worker.run())
+    try:
+        async for event in events:
+            await worker.submit(event)
+            if task.done():
+                break
+        await worker.close()
+    finally:
+        stats = await task
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a stream of storage events in a long-running worker.")
+    parser.add_argument("--events", default="-", help="File of JSON line events, or - for stdin.")
+    parser.add_argument("--debounce-seconds", type=float, default=1.0)
+    parser.add_argument("--max-wait-seconds", type=float, default=10.0)
+    parser.add_argument("--max-batch-files", type=int, default=500)
+    parser.add_argument("--max-pending", type=int, default=10000)
+    parser.add_argument("--io-workers", type=int, default=8)
+    parser.add_argument("--cpu-workers", type=int, default=None)
+    args = parser.parse_args()
+
+    f = sys.stdin if args.events == "-" else open(args.events)
+    with f:
+        stats = asyncio.run(run_worker(read_events(f), debounce_seconds=args.debounce_seconds,
+                                       max_wait_seconds=args.max_wait_seconds, max_batch_files=args.max_batch_files,
+                                       max_pending=args.max_pending, io_workers=args.io_workers,
+                                       cpu_workers=args.cpu_workers))
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import json
+import os
+
+
+class FileManifest:
+    """
+    Local cache of the raw files that were already ingested, for incremental discovery.
+
+    The manifest keeps a high-water mark: the greatest file name such that every listed file
+    up to it was ingested. Only files after the mark need to be listed, and only the ingested
+    files after the mark are kept in the index, so both stay small however old the bucket is.
+    Files named before the mark after it has moved past them are not discovered, which holds
+    for the time-stamped names the generator uses.
+
+    Args:
+        path (str): Path of the JSON file the manifest is persisted to.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.high_water_mark = None
+        self.processed = set()
+        self.exists = os.path.exists(path)
+
+        if self.exists:
+            with open(path) as f:
+                state = json.load(f)
+            self.high_water_mark = state["high_water_mark"]
+            self.processed = set(state["processed"])
+
+    def new_files(self, file_names):
+        """
+        Select the files that were not ingested yet.
+
+        Args:
+            file_names (list): Listed file names, e.g. starting from the high-water mark.
+
+        Returns:
+            list: Sorted names of the files to ingest.
+
+        """
+        return sorted(name for name in set(file_names)
+                      if (self.high_water_mark is None or name > self.high_water_mark) and name not in self.processed)
+
+    def add(self, file_names):
+        """Record ingested files, and persist the manifest."""
+        self.processed.update(file_names)
+        self.save()
+
+    def advance(self, file_names):
+        """
+        Move the high-water mark past the leading ingested files, and drop them from the index.
+
+        Args:
+            file_names (list): Every file name listed after the current high-water mark.
+
+        """
+        for name in sorted(set(file_names)):
+            if self.high_water_mark is not None and name <= self.high_water_mark:
+                continue
+            if name not in self.processed:
+                break
+            self.high_water_mark = name
+
+        if self.high_water_mark is not None:
+            self.processed = {name for name in self.processed if name > self.high_water_mark}
+        self.save()
+
+    def save(self):
+        state = {"high_water_mark": self.high_water_mark, "processed": sorted(self.processed)}
+        # Write to a temporary file first, so that an interrupted save keeps the previous manifest.
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
+        self.exists = True
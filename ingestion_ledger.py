@@ -0,0 +1,100 @@
+import json
+import time
+
+
+class IngestionLedger:
+    """
+    Record of the ingested files, by content hash, shared by every instance of the entry points.
+
+    A file is claimed before it is processed, by atomically creating a claim named after its content
+    hash, so a duplicate event or a copy of a file already ingested is skipped. Once the outputs of the
+    file are written and logged, the claim is replaced by a done marker.
+
+    The outputs of a file are written under a batch id, the content hash, so that a retry of a file
+    whose previous attempt failed half-way can replace the rows written by that attempt. A claim that
+    was released after a failure, or that is older than `claim_seconds` because its worker crashed,
+    can be claimed again, as a retry.
+
+    Args:
+        storage (Storage): Storage the ledger is kept in.
+        prefix (str): Prefix of the names of the ledger files.
+        claim_seconds (float): Time after which a claim is considered abandoned.
+
+    """
+
+    def __init__(self, storage, prefix="ingestion_ledger/", claim_seconds=3600):
+        self.storage = storage
+        self.prefix = prefix
+        self.claim_seconds = claim_seconds
+
+    def _claim_name(self, content_hash):
+        return f"{self.prefix}claims/{content_hash}.json"
+
+    def _done_name(self, content_hash):
+        return f"{self.prefix}done/{content_hash}.json"
+
+    def is_done(self, content_hash):
+        """Indicates if a file with this content was already ingested."""
+        try:
+            self.storage.size(self._done_name(content_hash))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def claim(self, file_name, content_hash):
+        """
+        Claim a file for ingestion.
+
+        Args:
+            file_name (str): Name of the file.
+            content_hash (str): Hash of the file contents, e.g. from `Storage.content_hash`.
+
+        Returns:
+            dict: The 'batch_id' the outputs of the file are written under, and 'retry', True if an
+                earlier attempt may have written some of them. None if the file was already ingested,
+                or is being ingested by another worker.
+
+        """
+        if self.is_done(content_hash):
+            return None
+
+        name = self._claim_name(content_hash)
+        claim = json.dumps({"file": file_name, "claimed_at": time.time()}).encode()
+        if self.storage.create(name, claim, "application/json"):
+            return {"batch_id": content_hash, "retry": False}
+
+        previous, generation = self._read_claim(name)
+        if previous is None or time.time() - previous["claimed_at"] < self.claim_seconds:
+            return None
+
+        # An abandoned claim is taken over only if it is still the one that was read, so when several
+        # workers take it over at once, one of them wins and the others back off.
+        if not self.storage.replace(name, claim, generation, "application/json"):
+            return None
+        return {"batch_id": content_hash, "retry": True}
+
+    def _read_claim(self, name):
+        try:
+            data, generation = self.storage.read_generation(name)
+        except FileNotFoundError:
+            # The claim was completed in the meantime.
+            return None, None
+        return json.loads(data), generation
+
+    def complete(self, file_name, content_hash):
+        """Mark a file as ingested, once its outputs are written and logged."""
+        done = json.dumps({"file": file_name, "completed_at": time.time()}).encode()
+        self.storage.write(self._done_name(content_hash), done, "application/json")
+        self.storage.delete(self._claim_name(content_hash))
+
+    def release(self, file_name, content_hash):
+        """Give up a claim after a failure, so that the file can be retried right away."""
+        name = self._claim_name(content_hash)
+        # A file completed in the meantime, e.g. by another worker, keeps no claim.
+        if self.is_done(content_hash):
+            return
+        previous, generation = self._read_claim(name)
+        if previous is None:
+            return
+        claim = json.dumps({"file": file_name, "claimed_at": 0}).encode()
+        self.storage.replace(name, claim, generation, "application/json")
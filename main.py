@@ -1,3 +1,26 @@
-from data_generator_gcp import generate_data
-from activity_processor_bq import activity_process_to_bq
-from activity_processor_gcs_trigger import activity_process_gcs_to_bq
\ No newline at end of file
+"""
+Entry points of the cloud functions.
+
+Every function is deployed from this file, so the modules of each entry point are only imported on its
+first call: the generator does not load the processing and BigQuery code, and a cold start of any function
+does not pay for the others. Modules stay imported, and their clients cached, for the next calls of a
+warm instance.
+"""
+
+
+def generate_data(request=None):
+    from data_generator_gcp import generate_data as run
+
+    return run(request)
+
+
+def activity_process_to_bq(request=None):
+    from activity_processor_bq import activity_process_to_bq as run
+
+    return run(request)
+
+
+def activity_process_gcs_to_bq(event, context):
+    from activity_processor_gcs_trigger import activity_process_gcs_to_bq as run
+
+    return run(event, context)
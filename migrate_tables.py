@@ -0,0 +1,98 @@
+"""
+Recreate the output tables of a dataset with the partitioning, clustering and column types of `batch_sink`.
+
+Tables created before the outputs were partitioned, or loaded with the day and ingestion time columns as DATETIME,
+cannot be appended to by `BigQueryWriter`. Each table is copied to a new table partitioned by day and clustered
+as in `batch_sink.PARTITION_FIELDS` and `batch_sink.CLUSTERING_FIELDS`, deriving `start_day` from
+`start_timestamp` where it is missing, casting the columns of `batch_sink.WAREHOUSE_SCHEMA` and adding an empty
+`batch_id` column, and then replaces the original table. Stop the ingestion while the tables are migrated.
+
+Usage, from the repository root:
+    python migrate_tables.py --dry-run
+    python migrate_tables.py --dataset project.activity_tables_backfill
+"""
+import argparse
+
+import activity_processor_bq as bq
+from batch_sink import (CLUSTERING_FIELDS, PARTITION_FIELDS, ROLLUP_TABLE_NAMES, TABLE_NAMES, WAREHOUSE_SCHEMA,
+                        get_bigquery_client)
+
+# Tables migrated, in this order: those of the activities and rollups, then the processing logs.
+MIGRATED_TABLES = list(TABLE_NAMES.values()) + list(ROLLUP_TABLE_NAMES.values()) + ["processing_logs"]
+
+# Suffix of the new table, while it is being built.
+MIGRATION_SUFFIX = "__migration"
+
+
+def migration_queries(table, table_name, columns):
+    """
+    Get the statements recreating a table with the partitioning and column types of `batch_sink`.
+
+    Args:
+        table (str): The table, as project.dataset.table.
+        table_name (str): Name of the table, to look up its partitioning.
+        columns (list): Names of the columns of the existing table.
+
+    Returns:
+        list: The statements, to run in order: create the new table, drop the old one, and rename the new one.
+
+    """
+    select = []
+    for column in columns:
+        if column in WAREHOUSE_SCHEMA:
+            select.append(f"cast({column} as {WAREHOUSE_SCHEMA[column]}) as {column}")
+        else:
+            select.append(column)
+    field = PARTITION_FIELDS.get(table_name)
+    if field == "start_day" and field not in columns:
+        select.append(f"date(timestamp_seconds(start_timestamp)) as {field}")
+    if "batch_id" not in columns:
+        # Rows written before batch ids were added belong to no batch.
+        select.append("cast(null as string) as batch_id")
+
+    create = f"create table `{table}{MIGRATION_SUFFIX}`"
+    if field is not None:
+        create += f" partition by {field}"
+    if CLUSTERING_FIELDS.get(table_name):
+        create += f" cluster by {', '.join(CLUSTERING_FIELDS[table_name])}"
+    create += f" as select {', '.join(select)} from `{table}`"
+    return [create, f"drop table `{table}`",
+            f"alter table `{table}{MIGRATION_SUFFIX}` rename to `{table.rsplit('.', 1)[-1]}`"]
+
+
+def migrate(dataset, table_names=MIGRATED_TABLES, dry_run=False):
+    """
+    Migrate the tables of a dataset, skipping those that do not exist yet.
+
+    Args:
+        dataset (str): The dataset, as project.dataset.
+        table_names (list): Names of the tables.
+        dry_run (bool): Print the statements instead of running them.
+
+    """
+    from google.api_core.exceptions import NotFound
+
+    client = get_bigquery_client()
+    for table_name in table_names:
+        table = f"{dataset}.{table_name}"
+        try:
+            columns = [field.name for field in client.get_table(table).schema]
+        except NotFound:
+            print(f"Skipping missing table: {table}")
+            continue
+        for query in migration_queries(table, table_name, columns):
+            print(query)
+            if not dry_run:
+                client.query(query).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", default=bq.dataset, help="Dataset of the tables, as project.dataset.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the statements without running them.")
+    args = parser.parse_args()
+    migrate(args.dataset, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
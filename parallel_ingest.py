@@ -0,0 +1,261 @@
+import hashlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from activity_io import detect_format, read_activity_logs
+from activity_processor import ActivityProcessor
+from session_store import boundary_rows, track_boundaries
+from stage_metrics import StageRecorder, read_record, record_reads
+
+# Size of the blocks a file is read in to hash its contents.
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def process_stream(source, file_format, chunksize=None, on_stage=None, boundaries=None, process=None):
+    """
+    Read an activity log file and process it for every activity type, one chunk at a time.
+
+    Args:
+        source (str or file-like): Path or binary file object of the file, e.g. from `Storage.open`.
+        file_format (str): Format of the file: csv, parquet or feather.
+        chunksize (int): If set, the file is read and processed in chunks of this many rows.
+            Otherwise it is read and processed at once.
+        on_stage (callable): If set, called with the metrics of each processing stage.
+        boundaries (list): If set, the boundary rows of the activities, for a SessionStore, are kept in it,
+            reduced with each chunk.
+        process (callable): If set, called with each DataFrame to process and the activities instead of
+            `ActivityProcessor.process_all`, e.g. to process it in another process.
+
+    Yields:
+        dict: Processed DataFrame for each activity type of a chunk, keyed by activity.
+
+    """
+    processor_instance = ActivityProcessor(on_stage)
+    if process is None:
+        process = processor_instance.process_all
+
+    if chunksize is None:
+        start = time.perf_counter()
+        df = read_activity_logs(source, file_format=file_format)
+        if on_stage is not None:
+            on_stage(read_record(df, time.perf_counter() - start))
+        if boundaries is not None:
+            boundaries.append(boundary_rows(df))
+        yield process(df, None)
+        return
+
+    chunks = read_activity_logs(source, chunksize=chunksize, file_format=file_format)
+    if on_stage is not None:
+        chunks = record_reads(chunks, on_stage)
+    if boundaries is not None:
+        chunks = track_boundaries(chunks, boundaries)
+    yield from processor_instance.process_chunks(chunks, process=process)
+
+
+def process_chunk(df, activities=None, profile=False):
+    """
+    Process a DataFrame for every activity type, e.g. in a worker process, optionally measuring each stage.
+
+    Returns:
+        tuple: Processed DataFrame for each activity type, keyed by activity, and the stage records if `profile`.
+
+    """
+    recorder = StageRecorder() if profile else None
+    results = ActivityProcessor(recorder).process_all(df, activities)
+    return results, recorder.records if profile else None
+
+
+def hash_file(f):
+    """Get the content hash of a binary file object, as 'md5-<hex digest>', and rewind it."""
+    digest = hashlib.md5()
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+        digest.update(block)
+    f.seek(0)
+    return f"md5-{digest.hexdigest()}"
+
+
+def file_size(f):
+    """Get the size of a binary file object, or None if it is not seekable."""
+    if not f.seekable():
+        return None
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    return size
+
+
+def file_opener(storage, chunksize):
+    """
+    Get the function opening the files to ingest from a storage backend.
+
+    Files read in chunks are streamed. Files read at once are downloaded whole with `Storage.read`, in
+    parallel ranges, as all of their contents are needed before they are processed anyway.
+
+    Args:
+        storage (Storage): Storage of the files.
+        chunksize (int): Number of rows of the chunks the files are read in, or None if they are read at once.
+
+    Returns:
+        callable: Called with a file name, returns a binary file object of its contents.
+
+    """
+    if chunksize is not None:
+        return storage.open
+    return lambda file_name: io.BytesIO(storage.read(file_name))
+
+
+def ingest_files(file_names, open_file, upload, io_workers=8, cpu_workers=None, chunksize=None, on_metrics=None,
+                 session_store=None, process_pool=None, cache=None, content_hash=None):
+    """
+    Read, process and upload several files concurrently, streaming each one chunk by chunk.
+
+    Each file is handled by a thread of an I/O pool, so that reads and uploads of some files
+    overlap with the processing of others. A file is read from its file object in chunks of
+    `chunksize` rows, and the processed outputs of each chunk are handed to `upload` as they
+    are produced, so the memory used by a file is bounded by the chunk size rather than by
+    its size. The processing itself runs in a pool of processes. A file that fails at any
+    step is reported and does not stop the others.
+
+    Args:
+        file_names (list): Names of the files to ingest.
+        open_file (callable): Called with a file name, returns a binary file object of its contents,
+            e.g. `Storage.open`.
+        upload (callable): Called with a file name and an iterator of its processed outputs: a DataFrame
+            for each activity type, keyed by activity, for each chunk, processed as it is iterated. It
+            should write each of them as it comes, and only record the file as processed once the
+            iterator is exhausted, e.g. with `BatchingSink.add_chunks`.
+        io_workers (int): Maximum number of files read, processed or uploaded at once.
+        cpu_workers (int): Number of processes. Defaults to the number of CPUs; 0 processes
+            files in the I/O threads instead.
+        chunksize (int): If set, files are read and processed in chunks of this many rows.
+            Otherwise each file is read and processed at once.
+        on_metrics (callable): If set, the processing stages are measured, and this is called with a dict
+            of metrics for each ingested file: its size, rows, throughput, the time taken by each step
+            and the totals of each processing stage.
+        session_store (SessionStore): If set, the activities of each file are also paired with those
+            left open by other files, and the pairs are uploaded after the outputs of the file. The update
+            of the store is staged under the file name, for the caller to `commit` once the file is written,
+            or to `discard` if it failed.
+        process_pool (Executor): If set, files are processed in this pool, e.g. one kept by a long-running
+            worker across calls, instead of a pool of `cpu_workers` processes. It is not shut down.
+        cache (ResultCache): If set, the processed outputs of each file are read from this cache when it holds
+            them for the same `chunksize`, skipping the processing, and cached otherwise.
+        content_hash (callable): Called with a file name, returns the content hash of the file, e.g. from the
+            metadata of the storage, so that a cached file is not even opened. Defaults to hashing the
+            contents of the file, which reads it once more.
+
+    Returns:
+        tuple: The names of the ingested files, and a dict of the exception raised by each failed file.
+
+    """
+    owns_pool = process_pool is None
+    if owns_pool:
+        process_pool = ProcessPoolExecutor(cpu_workers) if cpu_workers != 0 else None
+    profile = on_metrics is not None
+
+    def processor(recorder):
+        def process(df, activities):
+            if process_pool is None:
+                return ActivityProcessor(recorder).process_all(df, activities)
+            results, records = process_pool.submit(process_chunk, df, activities, profile).result()
+            if recorder is not None:
+                recorder.records.extend(records)
+            return results
+        return process
+
+    def lookup(file_hash):
+        if file_hash is None:
+            return None
+        cached = cache.get(cache.key(file_hash, chunksize))
+        if cached is not None and session_store is not None and cached[1] is None:
+            # Cached without the boundary rows the session store needs.
+            return None
+        return cached
+
+    def stream(file_name, metrics, recorder):
+        file_hash = content_hash(file_name) if cache is not None and content_hash is not None else None
+        cached = lookup(file_hash)
+        boundaries = None
+        if cached is None:
+            with open_file(file_name) as f:
+                metrics["bytes"] = file_size(f)
+                if cache is not None and file_hash is None:
+                    file_hash = hash_file(f)
+                    cached = lookup(file_hash)
+                if cached is None:
+                    boundaries = [] if session_store is not None else None
+                    entry = cache.open(cache.key(file_hash, chunksize)) if cache is not None else None
+                    try:
+                        for results in process_stream(f, detect_format(file_name), chunksize, recorder, boundaries,
+                                                      processor(recorder)):
+                            if entry is not None:
+                                entry.add(results)
+                            yield results
+                    except BaseException:
+                        # Also when the upload stops half-way, which closes this generator.
+                        if entry is not None:
+                            entry.abort()
+                        raise
+                    boundaries = pd.concat(boundaries, ignore_index=True) if boundaries else None
+                    if entry is not None:
+                        entry.commit(boundaries)
+
+        if cached is not None:
+            metrics["cached"] = True
+            chunks, boundaries = cached
+            yield from chunks
+        if session_store is not None and boundaries is not None:
+            yield session_store.join(boundaries, file_name=file_name)
+
+    def measure(chunks, metrics):
+        chunks = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                results = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                metrics["process_seconds"] += time.perf_counter() - start
+            metrics["rows_out"] += sum(len(df) for df in results.values())
+            yield results
+
+    def ingest(file_name):
+        start = time.perf_counter()
+        metrics = {"file": file_name, "bytes": None, "cached": False, "rows_out": 0, "process_seconds": 0.0}
+        recorder = StageRecorder() if profile else None
+        upload(file_name, measure(stream(file_name, metrics, recorder), metrics))
+
+        if on_metrics is not None:
+            stages = recorder.totals()
+            rows = stages.get("read", {}).get("rows_out", 0)
+            seconds = metrics["process_seconds"]
+            on_metrics({
+                **metrics,
+                "rows": rows,
+                # Time spent writing the outputs, between the chunks and after the last one.
+                "upload_seconds": time.perf_counter() - start - seconds,
+                "rows_per_second": rows / seconds if seconds > 0 and not metrics["cached"] else None,
+                "stages": stages,
+            })
+
+    ingested_files = []
+    failed_files = {}
+    try:
+        with ThreadPoolExecutor(io_workers) as io_pool:
+            futures = {io_pool.submit(ingest, file_name): file_name for file_name in file_names}
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    future.result()
+                    ingested_files.append(file_name)
+                except Exception as error:
+                    failed_files[file_name] = error
+    finally:
+        if owns_pool and process_pool is not None:
+            process_pool.shutdown()
+
+    return ingested_files, failed_files
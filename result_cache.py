@@ -0,0 +1,215 @@
+import functools
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+import pandas as pd
+
+# Modules whose code determines the processed outputs of a file. Any change to them changes the fingerprint.
+LOGIC_MODULES = ["activity_io", "activity_schema", "activity_pipeline", "activity_processor", "parallel_ingest",
+                 "session_store"]
+
+# Name of the file of the boundary rows of an entry, next to a file per activity.
+BOUNDARIES = "_boundaries"
+
+
+@functools.lru_cache(maxsize=None)
+def processor_fingerprint(modules=tuple(LOGIC_MODULES)):
+    """
+    Get a fingerprint of the processing logic, from the source code of its modules.
+
+    Args:
+        modules (tuple): Names of the modules.
+
+    Returns:
+        str: A short hash, which changes whenever the code of one of the modules does.
+
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(__import__(module).__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Local on-disk cache of the processed outputs of raw files, to skip reading and processing unchanged files.
+
+    Entries are keyed by the content hash of a file and the fingerprint of the processing logic, so a
+    changed file, or a change to the processor, misses the cache, and the entries of an older version of
+    the logic are no longer read. Callers processing files with other settings, e.g. another chunk size,
+    add them to the hash with `key`. Each entry is a directory of Parquet files, one per activity and chunk of
+    the file, so that it is written and read back one chunk at a time. The cache is bounded by the total
+    size of its files: after each write, the least recently used entries are deleted until it fits, starting
+    with those of other versions of the logic, which are never used again.
+
+    Args:
+        directory (str): Directory of the cache. It can be shared by several processes.
+        max_bytes (int): Maximum total size of the cached files.
+        fingerprint (str): Version of the processing logic. Defaults to `processor_fingerprint()`.
+
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30, fingerprint=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fingerprint = processor_fingerprint() if fingerprint is None else fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(content_hash, chunksize=None):
+        """Get the key of the outputs of a file processed in chunks of `chunksize` rows, or at once if None."""
+        return f"{content_hash}-{chunksize or 'all'}"
+
+    def _path(self, content_hash):
+        return os.path.join(self.directory, f"{self.fingerprint}-{content_hash}")
+
+    def get(self, content_hash):
+        """
+        Read the processed outputs of a file.
+
+        Args:
+            content_hash (str): Content hash of the file.
+
+        Returns:
+            tuple: An iterator of the processed outputs of each chunk of the file, as a DataFrame for each
+                activity type, keyed by activity, read one chunk at a time, and the boundary rows of the
+                file if they were cached. None if the file is not in the cache.
+
+        """
+        path = self._path(content_hash)
+        try:
+            names = sorted(name[:-len(".parquet")] for name in os.listdir(path) if name.endswith(".parquet"))
+            boundaries = None
+            if BOUNDARIES in names:
+                boundaries = pd.read_parquet(os.path.join(path, f"{BOUNDARIES}.parquet"))
+            # Marks the entry as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            # Not cached, or evicted meanwhile by another process.
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+
+        chunks = {}
+        for name in names:
+            if name != BOUNDARIES:
+                index, activity = name.split("-", 1)
+                chunks.setdefault(int(index), []).append(activity)
+        return self._read_chunks(path, chunks), boundaries
+
+    @staticmethod
+    def _read_chunks(path, chunks):
+        for index, activities in sorted(chunks.items()):
+            yield {activity: pd.read_parquet(os.path.join(path, f"{index:05d}-{activity}.parquet"))
+                   for activity in activities}
+
+    def open(self, content_hash):
+        """
+        Start writing the processed outputs of a file, one chunk at a time.
+
+        Args:
+            content_hash (str): Content hash of the file.
+
+        Returns:
+            CacheEntry: The entry, which is only visible to readers once committed.
+
+        """
+        return CacheEntry(self, self._path(content_hash))
+
+    def put(self, content_hash, chunks, boundaries=None):
+        """
+        Cache the processed outputs of a file, and evict the least recently used entries over the size bound.
+
+        Args:
+            content_hash (str): Content hash of the file.
+            chunks (iterable): Processed DataFrame for each activity type, keyed by activity, of each chunk.
+            boundaries (pd.DataFrame): If set, the boundary rows of the file, for a SessionStore.
+
+        """
+        entry = self.open(content_hash)
+        for results in chunks:
+            entry.add(results)
+        entry.commit(boundaries)
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in `max_bytes`."""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    size = sum(file.stat().st_size for file in os.scandir(entry.path))
+                    entries.append((entry.name.startswith(f"{self.fingerprint}-"), entry.stat().st_mtime, size,
+                                    entry.path))
+                except FileNotFoundError:
+                    continue
+
+            total = sum(size for _, _, size, _ in entries)
+            for _, _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+class CacheEntry:
+    """
+    An entry of a ResultCache being written, in a temporary directory until it is committed.
+
+    Args:
+        cache (ResultCache): The cache.
+        path (str): Directory of the entry once committed.
+
+    """
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self.chunks = 0
+        self._tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(self._tmp_path)
+
+    def add(self, results):
+        """Write the processed outputs of the next chunk of the file."""
+        for activity, df in results.items():
+            df.to_parquet(os.path.join(self._tmp_path, f"{self.chunks:05d}-{activity}.parquet"))
+        self.chunks += 1
+
+    def commit(self, boundaries=None):
+        """Make the entry visible, with the boundary rows of the file if set, and evict older entries."""
+        if boundaries is not None:
+            boundaries.to_parquet(os.path.join(self._tmp_path, f"{BOUNDARIES}.parquet"))
+        try:
+            os.rename(self._tmp_path, self.path)
+        except OSError:
+            # Cached meanwhile by another thread or process. An entry cached without the boundary rows is
+            # replaced by one with them.
+            if boundaries is None or os.path.exists(os.path.join(self.path, f"{BOUNDARIES}.parquet")):
+                self.abort()
+            else:
+                self._replace()
+        self.cache.evict()
+
+    def _replace(self):
+        old_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.rename(self.path, old_path)
+            os.rename(self._tmp_path, self.path)
+        except OSError:
+            # Replaced meanwhile by another thread or process.
+            self.abort()
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def abort(self):
+        """Delete the entry, e.g. when the file failed half-way."""
+        shutil.rmtree(self._tmp_path, ignore_errors=True)
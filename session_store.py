@@ -0,0 +1,219 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from activity_io import read_activity_logs, write_activity_logs
+from activity_pipeline import next_row_in_same_group, stage_status
+from activity_processor import ActivityProcessor
+from activity_schema import ACTIVITY_LOG_DTYPES, apply_schema
+
+
+# Columns identifying an activity: ids are only unique within an activity type.
+ACTIVITY_KEYS = ['activity_type', 'activity_id']
+
+
+def activity_edges(df):
+    """
+    Flag the first and the last row of each activity, in rows sorted by activity.
+
+    Args:
+        df (pd.DataFrame): Activity logs, with the rows of each activity next to each other.
+
+    Returns:
+        tuple: Boolean arrays flagging the first rows, and the last rows.
+
+    """
+    is_last = ~next_row_in_same_group([df[column].values for column in ACTIVITY_KEYS])
+    is_first = np.ones(len(df), dtype=bool)
+    is_first[1:] = is_last[:-1]
+    return is_first, is_last
+
+
+def has_activity(df, df_activities):
+    """Flag the rows of `df` whose activity has a row in `df_activities`."""
+    return pd.MultiIndex.from_frame(df[ACTIVITY_KEYS]).isin(pd.MultiIndex.from_frame(df_activities[ACTIVITY_KEYS]))
+
+
+def boundary_rows(df):
+    """
+    Select the rows of each activity that can pair up with rows of the same activity in other files.
+
+    These are its last row by timestamp if it is a start, left open for a later file, and its first row if it
+    is not a start, which continues a start of an earlier file. The other rows pair up within the file.
+
+    Args:
+        df (pd.DataFrame): Activity logs.
+
+    Returns:
+        pd.DataFrame: The boundary rows in the compact schema, sorted by activity_type, activity_id and timestamp.
+
+    """
+    df_keys = apply_schema(df[list(ACTIVITY_LOG_DTYPES)]).sort_values(ACTIVITY_KEYS + ['timestamp'], kind='stable')
+    is_first, is_last = activity_edges(df_keys)
+    is_start = stage_status(df_keys['activity_stage']) == "start"
+    return df_keys[(is_first & ~is_start) | (is_last & is_start)]
+
+
+def track_boundaries(chunks, boundaries):
+    """
+    Yield DataFrames read in chunks, keeping the boundary rows of the chunks read so far.
+
+    The boundary rows are reduced with each chunk, so that they only hold the activities still open, or
+    continued from earlier files, instead of the rows of the whole file. As for `process_chunks`, an activity
+    whose rows were all paired up in earlier chunks begins again at its next row.
+
+    Args:
+        chunks (iterable): DataFrames, e.g. from `read_activity_logs(..., chunksize=n)`.
+        boundaries (list): List holding the boundary rows, replaced with each chunk.
+
+    Yields:
+        pd.DataFrame: The DataFrames.
+
+    """
+    for chunk in chunks:
+        boundaries[:] = [boundary_rows(pd.concat(boundaries + [chunk[list(ACTIVITY_LOG_DTYPES)]], ignore_index=True))]
+        yield chunk
+
+
+class SessionStore:
+    """
+    Store of the activities left open at the edge of the files processed so far, to pair them across files.
+
+    Files are processed one at a time, so an activity started in one file and completed in the next
+    would lose its completion. The store keeps the last row of every activity whose latest stage in its
+    file is a start, with its timestamp, user and type. The first rows of the activities of later files
+    are joined against it, which adds the rows the processor would have produced from both files together.
+
+    Files can also arrive out of order, so the store keeps the first row of activities that do not begin
+    with a start too, which a start from a file processed later pairs with. Entries older than
+    `max_open_seconds` before the latest timestamp seen are expired. Activities are identified by their
+    type and id.
+
+    Args:
+        path (str): Path of the Parquet file the store is persisted to.
+        max_open_seconds (int): How long an activity can stay open, in seconds of event time.
+
+    """
+
+    def __init__(self, path, max_open_seconds=86400):
+        self.path = path
+        self.max_open_seconds = max_open_seconds
+        self.expired = 0
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            self.rows = read_activity_logs(path, file_format="parquet")
+        else:
+            self.rows = apply_schema(pd.DataFrame({column: [] for column in ACTIVITY_LOG_DTYPES}))
+        # The rows of the committed files only, which `save` persists, and the boundary rows of the files
+        # joined since, in order, until they are committed or discarded.
+        self._committed_rows = self.rows
+        self._pending = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def join(self, boundaries, activities=None, file_name=None):
+        """
+        Pair the boundary rows of a file with the open activities of earlier files, and update the store.
+
+        The later joins see the update at once. With a `file_name`, it is only staged for `save` though,
+        until the file is passed to `commit` once its outputs are written, or to `discard` if they are not.
+
+        Args:
+            boundaries (pd.DataFrame): Boundary rows of the file, e.g. from `boundary_rows`.
+            activities (list): The types of activity to process. Defaults to ACTIVITIES.
+            file_name (str): If set, the name of the file the update is staged under.
+
+        Returns:
+            dict: Processed DataFrame of the pairs for each activity type, keyed by activity.
+
+        """
+        with self._lock:
+            df_file = boundary_rows(boundaries)
+            df_pairs, self.rows, expired = self._update(self.rows, df_file)
+            self.expired += expired
+            if file_name is None:
+                self._committed_rows = self._update(self._committed_rows, df_file)[1]
+            else:
+                self._pending[file_name] = df_file
+            return ActivityProcessor().process_all(df_pairs, activities)
+
+    def commit(self, file_names):
+        """Make the updates of files, e.g. once their outputs and pairs are written, part of what `save` persists."""
+        with self._lock:
+            for file_name in [file_name for file_name in self._pending if file_name in set(file_names)]:
+                self._committed_rows = self._update(self._committed_rows, self._pending.pop(file_name))[1]
+
+    def discard(self, file_name):
+        """Undo the update of a file whose outputs were not written, so that a retry pairs its rows again."""
+        with self._lock:
+            if self._pending.pop(file_name, None) is None:
+                return
+            self.rows = self._committed_rows
+            for df_file in self._pending.values():
+                self.rows = self._update(self.rows, df_file)[1]
+
+    def _update(self, rows, df_file):
+        """
+        Pair the boundary rows of a file with the rows of a store.
+
+        Returns:
+            tuple: The rows of the pairs, the rows of the store updated with the file, and the number of
+                rows expired.
+
+        """
+        is_first, is_last = activity_edges(df_file)
+        heads = df_file[is_first]
+        tails = df_file[is_last & (stage_status(df_file['activity_stage']) == "start")]
+
+        latest = max(rows['timestamp'].max() if len(rows) else 0,
+                     df_file['timestamp'].max() if len(df_file) else 0)
+        watermark = int(latest) - self.max_open_seconds
+        stored, expired = self._expire(rows, watermark)
+
+        is_start = stage_status(stored['activity_stage']) == "start"
+        open_starts, early_heads = stored[is_start], stored[~is_start]
+
+        # Activities started in earlier files, continued in this one, and the other way around.
+        started = self._matches(open_starts, heads)
+        continued = self._matches(tails, early_heads)
+        is_started, is_continued = has_activity(open_starts, started), has_activity(early_heads, continued)
+        is_head_started, is_tail_continued = has_activity(heads, started), has_activity(tails, continued)
+        df_pairs = pd.concat([open_starts[is_started], heads[is_head_started],
+                              tails[is_tail_continued], early_heads[is_continued]], ignore_index=True)
+
+        heads = heads[(stage_status(heads['activity_stage']) != "start") & ~is_head_started]
+        rows = pd.concat([open_starts[~is_started], early_heads[~is_continued], tails[~is_tail_continued], heads],
+                         ignore_index=True)
+        rows = rows.sort_values('timestamp', kind='stable').drop_duplicates(
+            ACTIVITY_KEYS + ['activity_stage'], keep='last')
+        rows, expired_after = self._expire(rows, watermark)
+        return df_pairs, rows.reset_index(drop=True), expired + expired_after
+
+    @staticmethod
+    def _expire(rows, watermark):
+        """Drop the rows older than the watermark, and count them."""
+        is_expired = rows['timestamp'].to_numpy().astype(np.int64) < watermark
+        return rows[~is_expired], int(is_expired.sum())
+
+    @staticmethod
+    def _matches(starts, df_after):
+        """
+        Get the activities whose start in `starts` is followed by a strictly later row of another stage in
+        `df_after`, so that a start never pairs with itself, e.g. when the boundaries of a file are joined again.
+        """
+        columns = ACTIVITY_KEYS + ['timestamp', 'activity_stage']
+        df_matches = starts[columns].merge(df_after[columns], on=ACTIVITY_KEYS, suffixes=('_before', '_after'))
+        is_match = ((stage_status(df_matches['activity_stage_before']) == "start")
+                    & (stage_status(df_matches['activity_stage_after']) != "start")
+                    & (df_matches['timestamp_before'].to_numpy() < df_matches['timestamp_after'].to_numpy()))
+        return df_matches.loc[is_match, ACTIVITY_KEYS]
+
+    def save(self):
+        """Persist the store with the updates of the committed files, replacing the previous file atomically."""
+        with self._lock:
+            write_activity_logs(self._committed_rows, self.path + ".tmp", file_format="parquet")
+            os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,92 @@
+import json
+import time
+
+# Fields of a stage record that are summed in the totals.
+SUMMED_FIELDS = ["seconds", "rows_in", "rows_out", "memory_delta"]
+
+
+class StageRecorder:
+    """
+    Collect the stage records reported by an ActivityProcessor, used as its `on_stage` callback.
+
+    Example:
+        recorder = StageRecorder()
+        ActivityProcessor(on_stage=recorder).process_all(df)
+        print(recorder.totals())
+
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def totals(self):
+        """
+        Sum the records of each stage, across activities and chunks.
+
+        Returns:
+            dict: Summed seconds, rows in and out, memory delta and number of calls for each stage,
+                in the order the stages first ran.
+
+        """
+        totals = {}
+        for record in self.records:
+            stage_totals = totals.setdefault(record["stage"], dict.fromkeys(SUMMED_FIELDS + ["calls"], 0))
+            for field in SUMMED_FIELDS:
+                stage_totals[field] += record[field]
+            stage_totals["calls"] += 1
+        return totals
+
+
+def emit_metrics(event, **fields):
+    """
+    Print metrics as a single JSON line, which Cloud Logging stores as a structured log entry.
+
+    Args:
+        event (str): Name of the event, used as the log message.
+        **fields: The metrics.
+
+    """
+    entry = {"severity": "INFO", "message": event, "time": time.time(), **fields}
+    print(json.dumps(entry, default=str), flush=True)
+
+
+def read_record(df, seconds):
+    """
+    Get the stage record of a read, like the stages of an ActivityProcessor.
+
+    Args:
+        df (pd.DataFrame): The DataFrame read.
+        seconds (float): Wall time of the read.
+
+    Returns:
+        dict: The 'read' stage record.
+
+    """
+    return {"stage": "read", "activity": None, "seconds": seconds, "rows_in": 0, "rows_out": len(df),
+            "memory_delta": int(df.memory_usage(deep=False).sum())}
+
+
+def record_reads(chunks, on_stage):
+    """
+    Yield the DataFrames read by an iterator, reporting each read as a 'read' stage.
+
+    Args:
+        chunks (iterable): DataFrames, e.g. from `read_activity_logs(..., chunksize=n)`.
+        on_stage (callable): Called with the metrics of each read, like the stages of an ActivityProcessor.
+
+    Yields:
+        pd.DataFrame: The DataFrames.
+
+    """
+    chunks = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        on_stage(read_record(chunk, time.perf_counter() - start))
+        yield chunk
@@ -0,0 +1,390 @@
+import abc
+import base64
+import functools
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Files larger than this are downloaded in ranges of this size, in parallel.
+RANGE_SIZE = 8 * 2 ** 20
+
+# Maximum number of parallel range downloads per file, and of pooled connections per client.
+MAX_WORKERS = 8
+POOL_SIZE = 32
+
+# Files opened for writing are written under this prefix, outside of the raw data, until they are complete.
+TMP_PREFIX = "_tmp/"
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """
+    Get the Cloud Storage client shared by every bucket, created once per process.
+
+    Returns:
+        google.cloud.storage.Client: The client.
+
+    """
+    import google.auth
+    import requests
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import storage
+
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    # Keep enough pooled connections for parallel range downloads and concurrent files.
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+class Storage(abc.ABC):
+    """
+    Base class of the storage backends, listing, reading and writing files by name.
+
+    Args:
+        max_workers (int): Maximum number of parallel range downloads per file.
+
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+
+    def read(self, name):
+        """
+        Read the contents of a file, in parallel ranges if it is large.
+
+        Args:
+            name (str): Name of the file.
+
+        Returns:
+            bytes: The file contents.
+
+        """
+        # Every range is read from the version of the file that was measured, so that a file overwritten
+        # meanwhile fails the read instead of mixing the bytes of both versions.
+        size, generation = self.stat(name)
+        if size <= RANGE_SIZE:
+            return self.read_range(name, 0, size, generation)
+
+        ranges = [(start, min(start + RANGE_SIZE, size)) for start in range(0, size, RANGE_SIZE)]
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            parts = pool.map(lambda byte_range: self.read_range(name, *byte_range, generation), ranges)
+            return b"".join(parts)
+
+    def size(self, name):
+        """Get the size of a file in bytes."""
+        return self.stat(name)[0]
+
+    def read_generation(self, name):
+        """Read the contents of a small file at once, and their generation, e.g. to `replace` it if unchanged."""
+        size, generation = self.stat(name)
+        return self.read_range(name, 0, size, generation), generation
+
+    @abc.abstractmethod
+    def list(self, prefix="", start_offset=None):
+        """List the names of the files under a prefix, in lexicographic order, from `start_offset` if set."""
+
+    @abc.abstractmethod
+    def stat(self, name):
+        """Get the size of a file in bytes, and its generation, which changes when it is overwritten, or None."""
+
+    @abc.abstractmethod
+    def read_range(self, name, start, end, generation=None):
+        """Read the bytes of a file from `start` up to, but excluding, `end`, only from `generation` if set."""
+
+    @abc.abstractmethod
+    def write(self, name, data, content_type=None):
+        """Write the contents of a file."""
+
+    @abc.abstractmethod
+    def upload(self, name, path, content_type=None):
+        """Write a file from a local path."""
+
+    @abc.abstractmethod
+    def open(self, name, mode="rb", content_type=None):
+        """
+        Open a file as a binary file object, for streamed reads or writes, with `content_type` if written.
+
+        A file opened for writing is only written under its name once closed, and not at all if an error
+        is raised in its `with` block, so readers never see a partial file.
+
+        """
+
+    @abc.abstractmethod
+    def create(self, name, data, content_type=None):
+        """Write a file only if it does not exist yet, atomically. Returns True if the file was created."""
+
+    @abc.abstractmethod
+    def replace(self, name, data, generation, content_type=None):
+        """Overwrite a file only if it is still at `generation`. Returns True if the file was replaced."""
+
+    @abc.abstractmethod
+    def delete(self, name):
+        """Delete a file, if it exists."""
+
+    @abc.abstractmethod
+    def content_hash(self, name):
+        """Get a hash of the contents of a file, e.g. 'md5-<hex digest>', without downloading it when possible."""
+
+
+class GCSStorage(Storage):
+    """
+    Storage backend of a Cloud Storage bucket, sharing a pooled client with every other bucket.
+
+    Args:
+        bucket_name (str): Name of the bucket.
+        client (google.cloud.storage.Client): Client to use. Defaults to the shared client.
+        max_workers (int): Maximum number of parallel range downloads per file.
+
+    """
+
+    def __init__(self, bucket_name, client=None, max_workers=MAX_WORKERS):
+        super().__init__(max_workers)
+        self.client = get_client() if client is None else client
+        self.bucket = self.client.bucket(bucket_name)
+
+    def list(self, prefix="", start_offset=None):
+        return [blob.name for blob in self.client.list_blobs(self.bucket, prefix=prefix, start_offset=start_offset)]
+
+    def stat(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{self.bucket.name}/{name}")
+        return blob.size, blob.generation
+
+    def read_range(self, name, start, end, generation=None):
+        from google.api_core.exceptions import NotFound
+
+        if end <= start:
+            return b""
+        try:
+            return self.bucket.blob(name).download_as_bytes(start=start, end=end - 1, if_generation_match=generation)
+        except NotFound:
+            raise FileNotFoundError(f"gs://{self.bucket.name}/{name}") from None
+
+    def write(self, name, data, content_type=None):
+        self.bucket.blob(name).upload_from_string(data, content_type=content_type)
+
+    def upload(self, name, path, content_type=None):
+        self.bucket.blob(name).upload_from_filename(path, content_type=content_type)
+
+    def open(self, name, mode="rb", content_type=None):
+        if "w" in mode:
+            # Written in a resumable upload, one chunk at a time. Flushes, e.g. by the Parquet writer,
+            # are ignored, since a chunk can only be sent once it is full. Closing the upload creates the
+            # object even after an error, so it is uploaded under a temporary name and copied once complete.
+            tmp_blob = self.bucket.blob(f"{TMP_PREFIX}{uuid.uuid4().hex}")
+
+            def commit():
+                self.bucket.copy_blob(tmp_blob, self.bucket, name)
+                self.delete(tmp_blob.name)
+
+            return TempFileWriter(tmp_blob.open(mode, ignore_flush=True, content_type=content_type), commit,
+                                  lambda: self.delete(tmp_blob.name))
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{self.bucket.name}/{name}")
+        # Every chunk is read from the generation that was opened, like the ranges of `read`.
+        return blob.open(mode, if_generation_match=blob.generation)
+
+    def create(self, name, data, content_type=None):
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            # A generation of 0 only matches an object that does not exist.
+            self.bucket.blob(name).upload_from_string(data, content_type=content_type, if_generation_match=0)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def replace(self, name, data, generation, content_type=None):
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        try:
+            self.bucket.blob(name).upload_from_string(data, content_type=content_type,
+                                                      if_generation_match=generation)
+        except (NotFound, PreconditionFailed):
+            return False
+        return True
+
+    def delete(self, name):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self.bucket.blob(name).delete()
+        except NotFound:
+            pass
+
+    def content_hash(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{self.bucket.name}/{name}")
+        if blob.md5_hash:
+            return f"md5-{base64.b64decode(blob.md5_hash).hex()}"
+        # Composite objects only have a CRC32C checksum, which is combined with the size to lower collisions.
+        return f"crc32c-{base64.b64decode(blob.crc32c).hex()}-{blob.size}"
+
+
+class LocalStorage(Storage):
+    """
+    Storage backend of a local directory, behaving like a bucket with file names relative to the directory.
+
+    Args:
+        root (str): The directory.
+        max_workers (int): Maximum number of parallel range reads per file.
+
+    """
+
+    def __init__(self, root, max_workers=MAX_WORKERS):
+        super().__init__(max_workers)
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split("/"))
+
+    def list(self, prefix="", start_offset=None):
+        names = []
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                name = os.path.relpath(os.path.join(directory, file), self.root).replace(os.sep, "/")
+                if name.startswith(prefix) and (start_offset is None or name >= start_offset):
+                    names.append(name)
+        return sorted(names)
+
+    def stat(self, name):
+        # The inode and modification time stand for the generation, for `replace`, which writes a new file each
+        # time. Reads are not pinned to it.
+        stat = os.stat(self._path(name))
+        return stat.st_size, (stat.st_ino, stat.st_mtime_ns)
+
+    def read_range(self, name, start, end, generation=None):
+        with open(self._path(name), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def write(self, name, data, content_type=None):
+        with self.open(name, "wb") as f:
+            f.write(data)
+
+    def upload(self, name, path, content_type=None):
+        with open(path, "rb") as src, self.open(name, "wb") as f:
+            while True:
+                data = src.read(RANGE_SIZE)
+                if not data:
+                    break
+                f.write(data)
+
+    def open(self, name, mode="rb", content_type=None):
+        path = self._path(name)
+        if "w" not in mode:
+            return open(path, mode)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = self._path(f"{TMP_PREFIX}{uuid.uuid4().hex}")
+        os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+        return TempFileWriter(open(tmp_path, mode), lambda: os.replace(tmp_path, path), lambda: os.remove(tmp_path))
+
+    def create(self, name, data, content_type=None):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return True
+
+    def replace(self, name, data, generation, content_type=None):
+        # Unlike in Cloud Storage, the check and the write are not atomic across processes.
+        path = self._path(name)
+        try:
+            if self.stat(name)[1] != generation:
+                return False
+        except FileNotFoundError:
+            return False
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def content_hash(self, name):
+        md5 = hashlib.md5()
+        with open(self._path(name), "rb") as f:
+            for data in iter(lambda: f.read(RANGE_SIZE), b""):
+                md5.update(data)
+        return f"md5-{md5.hexdigest()}"
+
+
+class TempFileWriter:
+    """
+    File object writing to a temporary file, which is only moved to its name once closed without an error.
+
+    Args:
+        f (file): The temporary file, open for writing.
+        commit (callable): Called once `f` is closed, to move the temporary file to its name.
+        abort (callable): Called once `f` is closed after an error in a `with` block, to delete the temporary file.
+
+    """
+
+    def __init__(self, f, commit, abort):
+        self._f = f
+        self._commit = commit
+        self._abort = abort
+        self._done = False
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def close(self):
+        """Close the temporary file, and move it to its name."""
+        if self._done:
+            return
+        self._done = True
+        self._f.close()
+        self._commit()
+
+    def abort(self):
+        """Close and delete the temporary file, e.g. when writing it failed half-way."""
+        if self._done:
+            return
+        self._done = True
+        try:
+            self._f.close()
+        finally:
+            self._abort()
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage(url):
+    """
+    Get the storage backend of a URL, reused for every later call with the same URL.
+
+    Args:
+        url (str): 'gs://bucket' for a Cloud Storage bucket, or a local directory, optionally as 'file://path'.
+
+    Returns:
+        Storage: The storage backend.
+
+    """
+    if url.startswith("gs://"):
+        return GCSStorage(url[len("gs://"):].strip("/"))
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    return LocalStorage(url)
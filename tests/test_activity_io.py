@@ -0,0 +1,83 @@
+import io
+
+import pytest
+import pandas as pd
+
+from activity_io import ActivityLogWriter, detect_format, read_activity_logs, to_bytes, write_activity_logs
+from activity_schema import apply_schema
+
+
+@pytest.fixture(autouse=True)
+def df():
+    df = apply_schema(pd.read_csv("activity_logs_test.csv", sep="\t"))
+    yield df
+
+
+@pytest.mark.parametrize('file_format', ["csv", "parquet", "feather"])
+class TestActivityIO:
+
+    def test_round_trip(self, df, file_format, tmp_path):
+        path = str(tmp_path / f"activity_logs.{file_format}")
+        write_activity_logs(df, path)
+        pd.testing.assert_frame_equal(read_activity_logs(path), df)
+
+    def test_read_chunks(self, df, file_format, tmp_path):
+        path = str(tmp_path / f"activity_logs.{file_format}")
+        write_activity_logs(df, path)
+        chunks = list(read_activity_logs(path, chunksize=7))
+        assert [len(chunk) for chunk in chunks] == [7, 7, 7, 7, 7, 5]
+        pd.testing.assert_frame_equal(pd.concat(chunks), df)
+
+    def test_read_columns(self, df, file_format, tmp_path):
+        path = str(tmp_path / f"activity_logs.{file_format}")
+        write_activity_logs(df, path)
+        df_read = read_activity_logs(path, columns=['activity_id', 'activity_stage'])
+        pd.testing.assert_frame_equal(df_read, df[['activity_id', 'activity_stage']])
+
+    def test_to_bytes(self, df, file_format, tmp_path):
+        path = tmp_path / f"activity_logs.{file_format}"
+        path.write_bytes(to_bytes(df, file_format))
+        pd.testing.assert_frame_equal(read_activity_logs(str(path)), df)
+
+    def test_writer(self, df, file_format, tmp_path):
+        path = str(tmp_path / f"activity_logs.{file_format}")
+        with ActivityLogWriter(path) as writer:
+            for start in range(0, len(df), 15):
+                writer.write(df.iloc[start:start + 15])
+        assert writer.rows_written == len(df)
+        pd.testing.assert_frame_equal(read_activity_logs(path), df)
+
+    def test_writer_file_object(self, df, file_format):
+        class BlobFile:
+            """A binary file object which, like a Cloud Storage writer, has no mode and is not an io.IOBase."""
+
+            def __init__(self):
+                self.buffer = io.BytesIO()
+
+            def __getattr__(self, name):
+                return getattr(self.buffer, name)
+
+        f = BlobFile()
+        with ActivityLogWriter(f, file_format) as writer:
+            for start in range(0, len(df), 15):
+                writer.write(df.iloc[start:start + 15])
+        assert not hasattr(f, "mode")
+        pd.testing.assert_frame_equal(read_activity_logs(io.BytesIO(f.buffer.getvalue()), file_format=file_format), df)
+
+    @pytest.mark.parametrize('chunksize', [None, 7])
+    def test_read_unknown_stage(self, df, file_format, chunksize, tmp_path):
+        path = str(tmp_path / f"activity_logs.{file_format}")
+        df_unknown = df.astype({'activity_stage': object})
+        df_unknown.loc[20, 'activity_stage'] = "Quiz_pause"
+        write_activity_logs(df_unknown, path)
+        with pytest.raises(ValueError, match="Quiz_pause"):
+            df_read = read_activity_logs(path, chunksize=chunksize)
+            if chunksize is not None:
+                list(df_read)
+
+
+def test_detect_format():
+    assert detect_format("raw_data/data_1700000000.csv") == "csv"
+    assert detect_format("raw_data/data_1700000000.parquet") == "parquet"
+    with pytest.raises(ValueError):
+        detect_format("raw_data/data_1700000000.json")
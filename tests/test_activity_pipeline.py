@@ -0,0 +1,130 @@
+import tracemalloc
+
+import pytest
+import numpy as np
+import pandas as pd
+
+from activity_pipeline import (ACTIVITY_CONFIG, Derive, Filter, Pipeline, Sort, activity_plan, get_plan, optimize,
+                               sort_order)
+from activity_processor import ActivityProcessor
+from activity_schema import apply_schema
+from data_generator import DataGenerator
+
+
+def chain(df, activity):
+    """Process an activity by chaining the ActivityProcessor steps, as a reference."""
+    return ActivityProcessor().reference_processor(df, activity)
+
+
+@pytest.fixture(params=["csv", "schema", "generated"])
+def df(request):
+    df = pd.read_csv("activity_logs_test.csv", sep="\t")
+    if request.param == "schema":
+        df = apply_schema(df)
+    elif request.param == "generated":
+        df = DataGenerator("2023-01-01", "2023-01-31").generate_frame(500, seed=3)
+    yield df
+
+
+@pytest.mark.parametrize('activity', list(ACTIVITY_CONFIG))
+def test_plan_matches_chain(df, activity):
+    df_before = df.copy()
+    df_act = get_plan(activity).run(df)
+
+    pd.testing.assert_frame_equal(df_act, chain(df, activity))
+    pd.testing.assert_frame_equal(df, df_before)
+
+
+def test_unknown_activity():
+    with pytest.raises(ValueError):
+        get_plan("Survey")
+
+
+def test_new_activity_from_config():
+    df = pd.read_csv("activity_logs_test.csv", sep="\t")
+    df = df[df['activity_type'] == "Quiz"].replace({"Quiz": "Survey", "Quiz_start": "Survey_start",
+                                                    "Quiz_complete": "Survey_complete"})
+    df_survey = activity_plan("Survey", scored=True).run(df)
+
+    df_quiz = get_plan("Quiz").run(pd.read_csv("activity_logs_test.csv", sep="\t"))
+    pd.testing.assert_frame_equal(df_survey, df_quiz)
+
+
+def test_optimize():
+    steps = [
+        Sort("sort", ['b']),
+        Derive("double", ['a'], ['a2'], lambda columns: {'a2': 2 * columns['a']}),
+        Filter("positive", ['a'], lambda columns: columns['a'] > 0),
+        Filter("small", ['a2'], lambda columns: columns['a2'] < 10),
+    ]
+    groups = optimize(steps)
+
+    # The first filter moves before the sort and the step it does not depend on; the second one cannot.
+    assert [[step.name for step in group] for group in groups] == [["positive"], ["sort"], ["double"], ["small"]]
+
+
+def test_pipeline_projection():
+    df = pd.DataFrame({'a': [3, -1, 2, 6], 'b': [4, 3, 2, 1], 'unused': ["w", "x", "y", "z"]})
+    steps = [
+        Filter("positive", ['a'], lambda columns: columns['a'] > 0),
+        Filter("even_b", ['b'], lambda columns: columns['b'] % 2 == 0),
+        Sort("sort", ['b']),
+        Derive("double", ['a'], ['a2'], lambda columns: {'a2': 2 * columns['a']}),
+    ]
+    pipeline = Pipeline(steps, {'a2': 'a2'})
+    records = []
+
+    assert pipeline.inputs == ['a', 'b']
+    assert [[step.name for step in group] for group in pipeline.groups] == [["positive", "even_b"], ["sort"],
+                                                                             ["double"]]
+    df_out = pipeline.run(df, on_stage=records.append)
+    pd.testing.assert_frame_equal(df_out, pd.DataFrame({'a2': np.array([4, 6])}, index=[2, 0]))
+    assert [record["rows_out"] for record in records] == [2, 2, 2]
+
+
+@pytest.mark.parametrize('keys', [
+    # Packed into a single key, with ties kept in their input order.
+    [np.array([1, 0, 1, 0, 1], dtype=np.int8), np.array([5, 7, 5, 7, 2])],
+    # Ranges too wide to pack.
+    [np.array([2 ** 62, 0, 2 ** 62, 0, -2 ** 62]), np.array([5, 7, 5, 7, 2])],
+    # Not integers.
+    [np.array([1.5, 0.5, 1.5, 0.5, 1.5]), np.array([5, 7, 5, 7, 2])],
+])
+def test_sort_order(keys):
+    assert sort_order(keys).tolist() == np.lexsort(keys[::-1]).tolist()
+
+
+def test_run_partitioned():
+    df = pd.DataFrame({'code': [1, 0, 1, 0, 1], 'b': [3, 4, 1, 2, 5], 'a': [1, 2, 3, 4, 5]})
+    steps = [
+        Sort("sort", ['code', 'b']),
+        Derive("double", ['a'], ['a2'], lambda columns: {'a2': 2 * columns['a']}),
+        Filter("small", ['a2'], lambda columns: columns['a2'] < 8),
+    ]
+    pipeline = Pipeline(steps, {'a2': 'a2'})
+    records = []
+
+    df_0, df_1, df_2 = pipeline.run_partitioned(df, 'code', [{'a': 'a'}, {'a2': 'a2'}, {'a2': 'a2'}],
+                                                on_stage=records.append)
+    pd.testing.assert_frame_equal(df_0, pd.DataFrame({'a': np.array([2])}, index=[1]))
+    pd.testing.assert_frame_equal(df_1, pd.DataFrame({'a2': np.array([6, 2])}, index=[2, 0]))
+    assert df_2.empty
+    # The steps after the sort run on the rows of each code, and are reported once.
+    assert [(record["stage"], record["rows_in"], record["rows_out"]) for record in records] == [
+        ("sort", 5, 5), ("double", 5, 5), ("small", 5, 3)]
+
+
+def test_plan_memory():
+    df = DataGenerator("2023-01-01", "2023-01-31").generate_frame(50000, seed=1)
+    df_before = df.copy()
+
+    peaks = {}
+    for name, process in [("chain", chain), ("plan", lambda df, activity: get_plan(activity).run(df))]:
+        tracemalloc.start()
+        process(df, "Quiz")
+        peaks[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    # The plan only allocates the selected columns and the output, instead of a copy of the frame per step.
+    assert peaks["plan"] < peaks["chain"] / 2
+    pd.testing.assert_frame_equal(df, df_before)
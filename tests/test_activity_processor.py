@@ -1,7 +1,10 @@
+import warnings
+
 import pytest
 import pandas as pd
 
-from activity_processor import ActivityProcessor
+from activity_processor import ACTIVITIES, ActivityProcessor
+from stage_metrics import StageRecorder
 
 
 @pytest.fixture(autouse=True)
@@ -54,3 +57,109 @@ class TestProcessor:
         df_quiz = processor.processor(df, "Quiz").reset_index(drop=True)
         expected_df = pd.read_csv('activity_logs_quiz_result', sep="\t")
         pd.testing.assert_frame_equal(df_quiz, expected_df)
+
+    @pytest.mark.parametrize('activity', ["Quiz", "Challenge", "Video"])
+    def test_process_all(self, df, processor, activity):
+        recorder = StageRecorder()
+        results = ActivityProcessor(on_stage=recorder).process_all(df)
+        assert list(results) == ACTIVITIES
+        pd.testing.assert_frame_equal(results[activity], processor.reference_processor(df, activity))
+        # The frame is sorted once for every activity type.
+        assert recorder.totals()["sort_dataframe"]["calls"] == 1
+
+    def test_process_all_missing_activity(self, df, processor):
+        # An activity type without any row keeps the dtypes it gets when processed on its own.
+        df_other = df[df['activity_type'] != "Video"]
+        results = processor.process_all(df_other)
+        assert results["Video"].empty
+        pd.testing.assert_frame_equal(results["Video"], processor.reference_processor(df_other, "Video"))
+
+    def test_process_all_quiz_result(self, df, processor):
+        df_quiz = processor.process_all(df, ["Quiz"])["Quiz"].reset_index(drop=True)
+        expected_df = pd.read_csv('activity_logs_quiz_result', sep="\t")
+        pd.testing.assert_frame_equal(df_quiz, expected_df)
+
+    def test_add_lead_columns_presorted(self, df, processor):
+        df_sorted = processor.sort_dataframe(df)
+        df_grouped = processor.add_lead_columns(df_sorted.copy(), is_scorable_activity=True)
+        df_presorted = processor.add_lead_columns(df_sorted.copy(), is_scorable_activity=True, presorted=True)
+        pd.testing.assert_frame_equal(df_presorted, df_grouped)
+
+    def test_extract_status(self, df, processor):
+        df_lead = processor.add_lead_columns(df=df, is_scorable_activity=False)
+        df_status = processor.extract_status(df_lead)
+        expected = df_lead['act_stg_lead'].apply(lambda x: x.split("_")[1] if isinstance(x, str) else x)
+        pd.testing.assert_series_equal(df_status['status'], expected, check_names=False)
+
+    @pytest.mark.parametrize('chunksize', [1, 3, 7, 100])
+    def test_process_chunks(self, df, processor, chunksize):
+        chunks = pd.read_csv("activity_logs_test.csv", sep="\t", chunksize=chunksize)
+        chunk_results = list(processor.process_chunks(chunks))
+        expected = processor.process_all(df)
+        for activity, df_expected in expected.items():
+            df_chunked = pd.concat([results[activity] for results in chunk_results]).sort_index()
+            pd.testing.assert_frame_equal(df_chunked, df_expected.sort_index())
+
+    def test_open_activities(self, df, processor):
+        # The first two rows are a finished quiz, the third one starts another quiz.
+        assert processor.open_activities(df.iloc[:3]).tolist() == [False, False, True]
+
+    def test_open_activities_by_type(self, processor):
+        # A video and a quiz with the same id: only the video is still open.
+        df_shared = pd.DataFrame({"activity_id": [1, 1, 1], "timestamp": [10, 20, 30], "user_id": [5, 5, 5],
+                                  "activity_stage": ["Quiz_start", "Video_start", "Quiz_complete"],
+                                  "activity_type": ["Quiz", "Video", "Quiz"], "score": [None, None, 50]})
+        assert processor.open_activities(df_shared).tolist() == [False, True, False]
+
+    def test_cross_type_completion(self, processor):
+        # A quiz whose next stage is a challenge completion without a score is dropped, as any scored completion
+        # needs a score, while a video completion does not.
+        df_mixed = pd.DataFrame({"activity_id": [1, 1, 2, 2], "timestamp": [10, 20, 10, 20], "user_id": [5, 5, 5, 5],
+                                 "activity_stage": ["Quiz_start", "Challenge_complete", "Quiz_start", "Video_complete"],
+                                 "activity_type": ["Quiz", "Quiz", "Quiz", "Quiz"], "score": [None, None, None, None]})
+        df_expected = processor.reference_processor(df_mixed, "Quiz")
+        assert df_expected['activity_id'].tolist() == [2]
+        pd.testing.assert_frame_equal(processor.processor(df_mixed, "Quiz"), df_expected)
+        pd.testing.assert_frame_equal(processor.process_all(df_mixed)["Quiz"], df_expected)
+
+
+def test_on_stage(df):
+    records = []
+    df_quiz = ActivityProcessor(on_stage=records.append).processor(df, "Quiz")
+
+    pd.testing.assert_frame_equal(df_quiz, ActivityProcessor().processor(df, "Quiz"))
+    assert [record["stage"] for record in records] == [
+        "filter_activity_type", "sort_dataframe", "add_lead_columns", "remove_null_stages+remove_invalid_quiz_rows",
+        "calculate_activity_duration", "extract_status"]
+    assert all(record["activity"] == "Quiz" and record["seconds"] >= 0 for record in records)
+    assert records[0]["rows_in"] == len(df)
+    assert records[0]["rows_out"] == 18
+    assert records[-1]["rows_out"] == len(df_quiz)
+    # Adding the lead columns grows the frame.
+    assert records[2]["memory_delta"] > 0
+
+
+def test_steps_keep_input(df):
+    processor = ActivityProcessor()
+    df_before = df.copy()
+    df_quiz = processor.filter_activity_type(df, "Quiz")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", pd.errors.SettingWithCopyWarning)
+        df_lead = processor.add_lead_columns(df_quiz, is_scorable_activity=True)
+        df_duration = processor.calculate_activity_duration(df_lead)
+        df_status = processor.extract_status(df_duration)
+
+    assert list(df_quiz.columns) == list(df_before.columns)
+    assert "activity_duration" not in df_lead.columns
+    assert "status" not in df_duration.columns
+    assert "status" in df_status.columns
+    pd.testing.assert_frame_equal(df, df_before)
+
+
+def test_steps_inplace(df):
+    processor = ActivityProcessor()
+    df_lead = processor.add_lead_columns(df, is_scorable_activity=True, inplace=True)
+    df_status = processor.extract_status(df_lead, inplace=True)
+    assert df_status is df
+    assert "status" in df.columns
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from activity_processor import ActivityProcessor
+from activity_rollups import ROLLUP_KEYS, SCORE_BUCKETS, activity_rows, merge_rollups, rollup, rollup_results
+from data_generator import DataGenerator
+
+
+def test_rollup_results():
+    df = pd.read_csv("activity_logs_test.csv", sep="\t")
+    results = ActivityProcessor().process_all(df)
+    rollups = rollup_results(results)
+
+    df_daily = rollups["daily"]
+    assert df_daily['activities'].sum() == sum(len(df) for df in results.values())
+    df_quiz = df_daily[df_daily['activity_type'] == "Quiz"]
+    assert df_quiz['duration_sum'].sum() == results["Quiz"]['activity_duration'].sum()
+    assert df_quiz['score_sum'].sum() == results["Quiz"]['score'].sum()
+    assert df_quiz['score_count'].sum() == results["Quiz"]['score'].notna().sum()
+    assert df_quiz[SCORE_BUCKETS].to_numpy().sum() == df_quiz['score_count'].sum()
+    assert df_daily[df_daily['activity_type'] == "Video"]['score_count'].sum() == 0
+
+    df_user = rollups["user"]
+    completed = df_user[df_user['status'] == "complete"].groupby('user_id')['activities'].sum()
+    expected = pd.concat(results.values()).query("status == 'complete'").groupby('user_id').size()
+    pd.testing.assert_series_equal(completed, expected, check_names=False)
+
+
+def test_merge_rollups():
+    df = DataGenerator("2023-01-01", "2023-01-31").generate_frame(2000, seed=5)
+    processor = ActivityProcessor()
+    df_rows = activity_rows(processor.process_all(df))
+
+    # Rollups of parts of the activities combine into the rollup of all of them.
+    for name in ROLLUP_KEYS:
+        parts = [rollup(df_part, name) for df_part in np.array_split(df_rows, 3)]
+        df_merged = merge_rollups(parts, name)
+        df_whole = rollup(df_rows, name)
+        pd.testing.assert_frame_equal(df_merged, df_whole, check_exact=False)
+
+
+def test_rollup_empty():
+    df = pd.read_csv("activity_logs_test.csv", sep="\t").iloc[:0]
+    rollups = rollup_results(ActivityProcessor().process_all(df))
+    assert all(df_rollup.empty for df_rollup in rollups.values())
+    assert rollup_results({})["daily"].empty
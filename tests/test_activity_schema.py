@@ -0,0 +1,41 @@
+import pytest
+import pandas as pd
+
+from activity_processor import ActivityProcessor
+from activity_schema import ACTIVITY_LOG_DTYPES, apply_schema, memory_report
+from batch_sink import to_warehouse_types
+
+
+@pytest.fixture(autouse=True)
+def df():
+    df = pd.read_csv("activity_logs_test.csv", sep="\t")
+    yield df
+
+
+def test_apply_schema(df):
+    df_schema = apply_schema(df)
+    assert df_schema.dtypes.to_dict() == ACTIVITY_LOG_DTYPES
+    assert df_schema['score'].isna().sum() == df['score'].isna().sum()
+
+
+def test_apply_schema_unknown_stage(df):
+    df.loc[0, 'activity_stage'] = "Quiz_pause"
+    with pytest.raises(ValueError):
+        apply_schema(df)
+
+
+def test_read_csv_with_schema(df):
+    df_schema = pd.read_csv("activity_logs_test.csv", sep="\t", dtype=ACTIVITY_LOG_DTYPES)
+    pd.testing.assert_frame_equal(df_schema, apply_schema(df))
+
+
+def test_memory_report(df):
+    report = memory_report(df)
+    assert report.loc['total', 'after'] < report.loc['total', 'before'] / 2
+
+
+def test_processor_quiz_with_schema(df):
+    df_quiz = ActivityProcessor().processor(apply_schema(df), "Quiz").reset_index(drop=True)
+    expected_df = pd.read_csv('activity_logs_quiz_result', sep="\t")
+    # The outputs are written with the types of the warehouse tables, which are the types of the original outputs.
+    pd.testing.assert_frame_equal(to_warehouse_types(df_quiz), expected_df)
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+import activity_processor_bq
+from activity_io import to_bytes
+from backfill import backfill, file_timestamp, list_files
+from batch_sink import FileWriter
+from data_generator import DataGenerator
+from file_manifest import FileManifest
+from storage_backend import get_storage
+
+# Upload times of the raw files: two on 2023-11-14 and one on 2023-11-15, in UTC.
+TIMESTAMPS = [1699920000, 1699990000, 1700006400]
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    monkeypatch.setattr(activity_processor_bq, "storage_url", str(tmp_path / "bucket"))
+    monkeypatch.setattr(activity_processor_bq, "cpu_workers", 0)
+    bucket = get_storage(str(tmp_path / "bucket"))
+    for seed, timestamp in enumerate(TIMESTAMPS):
+        df = DataGenerator("2023-01-01", "2023-01-31").generate_frame(20, seed=seed)
+        bucket.write(f"raw_data/data_{timestamp}.parquet", to_bytes(df, "parquet"))
+    yield bucket
+
+
+def test_file_timestamp():
+    assert file_timestamp("raw_data/data_1700006400.parquet") == 1700006400
+    assert file_timestamp("raw_data/data_1700006400_00002.csv") == 1700006400
+    assert file_timestamp("raw_data/activity_logs.csv") is None
+
+
+def test_list_files(bucket):
+    bucket.write("raw_data/activity_logs.csv", b"")
+    assert len(list_files(bucket)) == 4
+    assert list_files(bucket, start_date="2023-11-14", end_date="2023-11-14") == \
+           [f"raw_data/data_{timestamp}.parquet" for timestamp in TIMESTAMPS[:2]]
+    assert list_files(bucket, start_date="2023-11-15") == [f"raw_data/data_{TIMESTAMPS[2]}.parquet"]
+    assert list_files(bucket, prefix="raw_data/data_17") == [f"raw_data/data_{TIMESTAMPS[2]}.parquet"]
+
+
+def test_backfill(bucket, tmp_path):
+    file_names = list_files(bucket)
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    stats = backfill(file_names, checkpoint_path, dataset="backfill", sink_dir=str(tmp_path / "sink"))
+    assert stats == {"files": 3, "skipped": 0, "ingested": 3, "failed": 0}
+
+    writer = FileWriter(str(tmp_path / "sink" / "backfill"))
+    assert sorted(writer.read_table("processing_logs")['filename']) == file_names
+    assert len(writer.read_table("quiz_table")) > 0
+    with open(checkpoint_path) as f:
+        assert json.load(f)["high_water_mark"] == file_names[-1]
+
+    stats = backfill(file_names, checkpoint_path, dataset="backfill", sink_dir=str(tmp_path / "sink"))
+    assert stats == {"files": 3, "skipped": 3, "ingested": 0, "failed": 0}
+
+
+def test_backfill_resume(bucket, tmp_path):
+    file_names = list_files(bucket)
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    backfill(file_names, checkpoint_path, dataset="backfill", sink_dir=str(tmp_path / "sink"))
+    writer = FileWriter(str(tmp_path / "sink" / "backfill"))
+    num_rows = len(writer.read_table("video_table"))
+
+    # Interrupted after the rows of the last file were written, but before it was checkpointed.
+    checkpoint = FileManifest(checkpoint_path)
+    checkpoint.high_water_mark = None
+    checkpoint.add(file_names[:2])
+
+    stats = backfill(file_names, checkpoint_path, dataset="backfill", sink_dir=str(tmp_path / "sink"))
+    assert stats == {"files": 3, "skipped": 2, "ingested": 1, "failed": 0}
+    assert len(writer.read_table("video_table")) == num_rows
+    assert sorted(writer.read_table("processing_logs")['filename']) == file_names
+
+
+def test_backfill_resume_first_flush(bucket, tmp_path, monkeypatch):
+    file_names = list_files(bucket)
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    write = FileWriter.write
+
+    def write_data_only(self, table_name, df):
+        # Interrupted during the first flush, after the rows of the files were written but before their logs.
+        if table_name == "processing_logs":
+            raise ConnectionError("Load job failed")
+        write(self, table_name, df)
+
+    monkeypatch.setattr(FileWriter, "write", write_data_only)
+    with pytest.raises(ConnectionError):
+        backfill(file_names, checkpoint_path, dataset="backfill", sink_dir=str(tmp_path / "sink"))
+
+    monkeypatch.setattr(FileWriter, "write", write)
+    stats = backfill(file_names, checkpoint_path, dataset="backfill", sink_dir=str(tmp_path / "sink"))
+    assert stats == {"files": 3, "skipped": 0, "ingested": 3, "failed": 0}
+    writer = FileWriter(str(tmp_path / "sink" / "backfill"))
+    backfill(file_names, str(tmp_path / "clean.json"), dataset="clean", sink_dir=str(tmp_path / "sink"))
+    assert len(writer.read_table("video_table")) == len(FileWriter(str(tmp_path / "sink" / "clean")).read_table(
+        "video_table"))
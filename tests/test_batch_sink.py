@@ -0,0 +1,235 @@
+import os
+import threading
+
+import pytest
+import pandas as pd
+
+from activity_processor import ActivityProcessor
+from activity_rollups import rollup_results
+from activity_schema import apply_schema
+import batch_sink
+from batch_sink import BatchingSink, FileWriter, TABLE_NAMES
+
+
+@pytest.fixture(autouse=True)
+def results():
+    df = pd.read_csv("activity_logs_test.csv", sep="\t")
+    yield ActivityProcessor().process_all(df)
+
+
+class RecordingWriter:
+    def __init__(self, fail_table=None):
+        self.writes = []
+        self.fail_table = fail_table
+
+    def write(self, table_name, df):
+        if table_name == self.fail_table:
+            raise ConnectionError("Load job failed")
+        self.writes.append((table_name, len(df)))
+
+
+def test_sink_batches_files(results):
+    writer = RecordingWriter()
+    with BatchingSink(writer, max_rows=10 ** 6, max_seconds=3600) as sink:
+        for i in range(5):
+            sink.add(f"raw_data/data_{i}.csv", results)
+        assert writer.writes == []
+
+    num_rows = {TABLE_NAMES[activity]: 5 * len(df) for activity, df in results.items()}
+    assert writer.writes == list(num_rows.items()) + [("processing_logs", 5)]
+
+
+def test_sink_flushes_on_rows(results):
+    writer = RecordingWriter()
+    sink = BatchingSink(writer, max_rows=sum(len(df) for df in results.values()), max_seconds=3600)
+    sink.add("raw_data/data_0.csv", results)
+    assert len(writer.writes) == 4
+    assert sink.rows_pending == 0
+
+
+def test_sink_flushes_on_time(results):
+    writer = RecordingWriter()
+    sink = BatchingSink(writer, max_rows=10 ** 6, max_seconds=0)
+    sink.add("raw_data/data_0.csv", results)
+    assert writer.writes[-1] == ("processing_logs", 1)
+
+
+def test_sink_flushes_on_timer(results):
+    writer = RecordingWriter()
+    flushed = threading.Event()
+    sink = BatchingSink(writer, max_rows=10 ** 6, max_seconds=0.1, on_flushed=lambda tables: flushed.set())
+    sink.add("raw_data/data_0.csv", results)
+    assert writer.writes == []
+
+    # Flushed once due, although nothing else is added.
+    assert flushed.wait(5)
+    assert writer.writes[-1] == ("processing_logs", 1)
+    sink.close()
+
+
+def test_sink_retries_failed_flush(results, monkeypatch):
+    monkeypatch.setattr(batch_sink, "MIN_RETRY_SECONDS", 0.1)
+    writer = RecordingWriter(fail_table="challenge_table")
+    logged = threading.Event()
+    sink = BatchingSink(writer, max_rows=1, max_seconds=0, on_logged=lambda file_names: logged.set())
+    # The failed flush does not fail the file, whose rows are kept.
+    sink.add("raw_data/data_0.csv", results)
+    assert sink.rows_pending > 0
+
+    writer.fail_table = None
+    assert logged.wait(5)
+    assert sink.rows_pending == 0
+    sink.close()
+
+
+def test_sink_logs_after_data(results):
+    writer = RecordingWriter(fail_table="challenge_table")
+    sink = BatchingSink(writer, max_rows=10 ** 6, max_seconds=3600)
+    sink.add("raw_data/data_0.csv", results)
+    with pytest.raises(ConnectionError):
+        sink.flush()
+    assert "processing_logs" not in dict(writer.writes)
+
+    # A retried flush only writes the tables that were not written yet, and then the logs.
+    writer.fail_table = None
+    sink.flush()
+    assert [table_name for table_name, _ in writer.writes] == ["quiz_table", "video_table",
+                                                               "challenge_table", "processing_logs"]
+
+
+def test_file_writer(results, tmp_path):
+    writer = FileWriter(str(tmp_path))
+    with BatchingSink(writer) as sink:
+        sink.add("raw_data/data_0.csv", results)
+        sink.flush()
+        sink.add("raw_data/data_1.csv", results)
+
+    df_quiz = writer.read_table("quiz_table")
+    assert len(df_quiz) == 2 * len(results["Quiz"])
+    assert "ingested_at" in df_quiz.columns
+    assert writer.read_table("processing_logs", columns=["filename"])['filename'].tolist() == [
+        "raw_data/data_0.csv", "raw_data/data_1.csv"]
+    assert writer.read_table("missing_table").empty
+
+
+def test_sink_on_logged(results):
+    logged = []
+    sink = BatchingSink(RecordingWriter(fail_table="quiz_table"), on_logged=logged.extend)
+    sink.add("raw_data/data_0.csv", results)
+    with pytest.raises(ConnectionError):
+        sink.flush()
+    assert logged == []
+
+    sink.writer.fail_table = None
+    sink.flush()
+    assert logged == ["raw_data/data_0.csv"]
+
+
+def test_sink_on_flushed(results):
+    flushes = []
+    sink = BatchingSink(RecordingWriter(), on_flushed=flushes.append)
+    sink.flush()
+    sink.add("raw_data/data_0.csv", results)
+    sink.flush()
+
+    assert len(flushes) == 1
+    assert flushes[0]["quiz_table"]["rows"] == len(results["Quiz"])
+    assert flushes[0]["processing_logs"]["rows"] == 1
+
+
+def test_sink_replaces_batches(results, tmp_path):
+    writer = FileWriter(str(tmp_path))
+    with BatchingSink(writer) as sink:
+        sink.add("raw_data/data_0.csv", results, batch_id="hash-0")
+        sink.add("raw_data/data_1.csv", results, batch_id="hash-1")
+    # A partial write of a batch, e.g. by an attempt that failed before logging the file.
+    with BatchingSink(writer) as sink:
+        sink.write("quiz_table", results["Quiz"], batch_id="hash-0")
+
+    # The retry deletes the rows of the failed attempts before writing its own.
+    with BatchingSink(writer) as sink:
+        sink.replace("hash-0")
+        sink.add("raw_data/data_0.csv", results, batch_id="hash-0")
+
+    df_quiz = writer.read_table("quiz_table")
+    assert df_quiz['batch_id'].value_counts().to_dict() == {"hash-0": len(results["Quiz"]),
+                                                            "hash-1": len(results["Quiz"])}
+    df_logs = writer.read_table("processing_logs")
+    assert sorted(zip(df_logs['filename'], df_logs['batch_id'])) == [("raw_data/data_0.csv", "hash-0"),
+                                                                     ("raw_data/data_1.csv", "hash-1")]
+
+
+def test_file_writer_partitions(results, tmp_path):
+    writer = FileWriter(str(tmp_path))
+    with BatchingSink(writer) as sink:
+        sink.add("raw_data/data_0.csv", results)
+
+    df_quiz = writer.read_table("quiz_table")
+    days = sorted(df_quiz['start_day'].unique())
+    assert (df_quiz['start_day'] == pd.to_datetime(df_quiz['start_timestamp'], unit="s").dt.normalize()).all()
+    assert sorted(os.listdir(tmp_path / "quiz_table")) == [f"day={day:%Y-%m-%d}" for day in pd.to_datetime(days)]
+    assert os.listdir(tmp_path / "processing_logs")[0].endswith(".parquet")
+
+    # Reading a day only reads the files of its partition.
+    df_day = writer.read_table("quiz_table", days=days[:1])
+    pd.testing.assert_frame_equal(df_day, df_quiz[df_quiz['start_day'] == days[0]].reset_index(drop=True))
+
+
+def test_ingestion_timestamp(results, tmp_path):
+    writer = FileWriter(str(tmp_path))
+    with BatchingSink(writer) as sink:
+        sink.add("raw_data/data_0.csv", results)
+
+    df_quiz = writer.read_table("quiz_table")
+    df_logs = writer.read_table("processing_logs")
+    assert df_quiz['ingested_at'].dtype == "datetime64[ns]"
+    assert df_quiz['ingested_at'].nunique() == 1
+    assert df_logs['ingested_at'].iloc[0] == df_quiz['ingested_at'].iloc[0]
+
+
+def test_sink_warehouse_types(tmp_path):
+    # Processed in the compact schema, but written with the types of the warehouse columns.
+    results = ActivityProcessor().process_all(apply_schema(pd.read_csv("activity_logs_test.csv", sep="\t")))
+    writer = FileWriter(str(tmp_path))
+    with BatchingSink(writer) as sink:
+        sink.add("raw_data/data_0.csv", results, batch_id="md5-0", rollups=rollup_results(results))
+
+    df_quiz = writer.read_table("quiz_table")
+    assert df_quiz.dtypes.astype(str).to_dict() == {
+        'activity_id': 'int64', 'user_id': 'int64', 'start_timestamp': 'int64', 'activity_duration': 'float64',
+        'status': 'object', 'score': 'float64', 'batch_id': 'object', 'start_day': 'datetime64[ns]',
+        'ingested_at': 'datetime64[ns]'}
+    df_user = writer.read_table("user_daily_activity_rollup")
+    assert df_user[['user_id', 'activity_type', 'status', 'activities']].dtypes.astype(str).tolist() == [
+        'int64', 'object', 'object', 'int64']
+
+
+def test_sink_add_chunks(results):
+    writer = RecordingWriter()
+    chunks = [{activity: df.iloc[:2] for activity, df in results.items()},
+              {activity: df.iloc[2:] for activity, df in results.items()}]
+    with BatchingSink(writer) as sink:
+        sink.add_chunks("raw_data/data_0.csv", iter(chunks), batch_id="md5-0")
+
+    written = dict(writer.writes)
+    for activity, df in results.items():
+        assert written[TABLE_NAMES[activity]] == len(df)
+    # The rollups of the chunks are combined into one rollup of the file.
+    assert written["daily_activity_rollup"] == len(rollup_results(results)["daily"])
+    assert written["processing_logs"] == 1
+
+
+def test_sink_add_chunks_failure(results):
+    def chunks():
+        yield results
+        raise ValueError("Broken file")
+
+    writer = RecordingWriter()
+    with BatchingSink(writer) as sink:
+        sink.add("raw_data/data_0.csv", results, batch_id="md5-0")
+        with pytest.raises(ValueError):
+            sink.add_chunks("raw_data/data_1.csv", chunks(), batch_id="md5-1")
+        # Only the rows of the file that failed half-way are dropped.
+        assert sink.rows_pending == sum(len(df) for df in results.values())
+
+    assert writer.writes[-1] == ("processing_logs", 1)
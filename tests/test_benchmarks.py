@@ -0,0 +1,72 @@
+from benchmarks.imports import parse_importtime
+from benchmarks.suite import benchmark_size, find_regressions, find_slow_process_all, parse_size
+
+
+def record(stage, seconds, size="10k", activity="Quiz"):
+    return {"size": size, "activity": activity, "stage": stage, "seconds": seconds}
+
+
+def test_parse_size():
+    assert [parse_size(size) for size in ["10k", "1M", "2.5m", "500"]] == [10000, 1000000, 2500000, 500]
+
+
+def test_find_regressions():
+    baseline = {"records": [record("sort_dataframe", 0.100), record("extract_status", 0.100),
+                            record("filter_activity_type", 0.001)]}
+    results = {"records": [
+        # 50% slower than the baseline.
+        record("sort_dataframe", 0.150),
+        # Within the threshold.
+        record("extract_status", 0.110),
+        # Slower, but too fast in the baseline to compare.
+        record("filter_activity_type", 0.010),
+        # Not in the baseline.
+        record("sort_dataframe", 1.0, size="1M"),
+    ]}
+
+    regressions = find_regressions(results, baseline, threshold=0.2, min_seconds=0.005)
+    assert regressions == ["10k/Quiz/sort_dataframe: 0.1500s vs 0.1000s baseline"]
+    assert find_regressions(results, baseline, threshold=0.6, min_seconds=0.005) == []
+
+
+def test_find_import_regressions():
+    baseline = {"records": [{"module": "main", "seconds": 0.100}, {"module": "activity_processor_bq", "seconds": 0.500},
+                            {"module": "data_generator_gcp", "seconds": 0.001}]}
+    results = {"records": [{"module": "main", "seconds": 0.300}, {"module": "activity_processor_bq", "seconds": 0.550},
+                           {"module": "data_generator_gcp", "seconds": 0.050},
+                           {"module": "activity_processor_gcs_trigger", "seconds": 1.0}]}
+
+    regressions = find_regressions(results, baseline, threshold=0.2, min_seconds=0.01, fields=("module",))
+    assert regressions == ["main: 0.3000s vs 0.1000s baseline"]
+
+
+def test_parse_importtime():
+    stderr = "\n".join([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       100 |        100 |     json.decoder",
+        "import time:       200 |        300 |   json",
+        "import time:       500 |       1500 | main",
+    ])
+    assert parse_importtime(stderr) == [("json.decoder", 0.0001, 2), ("json", 0.0003, 1), ("main", 0.0015, 0)]
+
+
+def test_find_slow_process_all():
+    results = {"records": [
+        record("processor", 0.100, activity="all"), record("process_all", 0.150, activity="all"),
+        # As fast as the processor calls.
+        record("processor", 0.200, size="1M", activity="all"), record("process_all", 0.190, size="1M", activity="all"),
+        # Too fast to compare.
+        record("processor", 0.001, size="1k", activity="all"), record("process_all", 0.010, size="1k", activity="all"),
+        record("processor", 1.0, size="10M"),
+    ]}
+
+    slow = find_slow_process_all(results, threshold=0.2, min_seconds=0.005)
+    assert slow == ["10k/all/process_all: 0.1500s vs 0.1000s for the processor of each activity type"]
+    assert find_slow_process_all(results, threshold=0.6, min_seconds=0.005) == []
+
+
+def test_process_all_not_slower_than_processor():
+    # The fastest of a few runs, with some slack for the noise of shared machines.
+    size_results = benchmark_size(200000, repeat=3)
+    results = {"records": [{"size": "200k", **record} for record in size_results["records"]]}
+    assert find_slow_process_all(results, threshold=0.25, min_seconds=0.005) == []
@@ -1,10 +1,13 @@
+import os
 import pytest
 import random
 import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 
-from data_generator import DataGenerator
+from activity_io import read_activity_logs
+from activity_schema import ACTIVITY_CONFIG, ACTIVITY_LOG_DTYPES
+from data_generator import DataGenerator, generate_shards, stream_records
 
 
 def set_seed():
@@ -63,6 +66,120 @@ class TestGenerator:
         expected_columns = ['activity_id', 'timestamp', 'user_id', 'activity_stage', 'activity_type', 'score']
         assert all(col in records_df.columns for col in expected_columns)
 
+    def test_generate_frame(self, generator):
+        records_df = generator.generate_frame(10, seed=1234)
 
+        expected_columns = ['activity_id', 'timestamp', 'user_id', 'activity_stage', 'activity_type', 'score']
+        assert records_df.columns.tolist() == expected_columns
+        assert records_df.dtypes.equals(generator.generate_records(10).dtypes)
+
+    def test_generate_frame_seed(self, generator):
+        pd.testing.assert_frame_equal(generator.generate_frame(100, seed=1), generator.generate_frame(100, seed=1))
+        assert not generator.generate_frame(100, seed=1).equals(generator.generate_frame(100, seed=2))
 
+    def test_generate_frame_records(self, generator):
+        records_df = generator.generate_frame(1000, seed=1234)
 
+        start_datetime = datetime.strptime(generator.start_date, "%Y-%m-%d")
+        end_datetime = datetime.strptime(generator.end_date, "%Y-%m-%d")
+        assert records_df['timestamp'].min() >= start_datetime.timestamp()
+        assert records_df['timestamp'].max() <= end_datetime.timestamp() + 120
+        assert records_df['user_id'].between(100000, 999999).all()
+
+        # Every activity starts, and is followed by at most one more stage 30 seconds to 2 minutes later
+        first = records_df.groupby('activity_id').head(1)
+        assert first['activity_stage'].str.endswith("_start").all()
+        gaps = records_df.groupby('activity_id')['timestamp'].agg(lambda x: x.max() - x.min())
+        sizes = records_df.groupby('activity_id').size()
+        assert sizes.isin([1, 2]).all()
+        assert gaps[sizes == 2].between(30, 120).all()
+
+        has_score = records_df['activity_stage'].isin(["Quiz_complete", "Challenge_complete"])
+        assert records_df.loc[has_score, 'score'].notna().all()
+        assert records_df.loc[~has_score, 'score'].isna().all()
+
+    def test_generate_frame_distributions(self, generator):
+        records_df = generator.generate_frame(20000, seed=1234)
+
+        activities = records_df.groupby('activity_id')['activity_type'].first()
+        act_shares = activities.value_counts(normalize=True)
+        for act, config in ACTIVITY_CONFIG.items():
+            assert abs(act_shares[act] - config["weight"]) < 0.02
+
+        sizes = records_df.groupby('activity_id').size()
+        assert abs((sizes == 1).mean() - 0.1) < 0.02
+
+    def test_generate_adversarial_frame(self, generator):
+        pd.testing.assert_frame_equal(generator.generate_adversarial_frame(100, seed=1),
+                                      generator.generate_frame(100, seed=1))
+
+        records_df = generator.generate_adversarial_frame(1000, seed=1, duplicate_timestamps=1, extra_stages=1,
+                                                          missing_scores=1, orphan_completes=1)
+        assert records_df.dtypes.equals(generator.generate_frame(10).dtypes)
+        assert (records_df.groupby('activity_id')['timestamp'].nunique() == 1).all()
+        assert records_df.groupby('activity_id').size().min() >= 1
+        assert records_df['score'].isna().all()
+
+        mismatched_df = generator.generate_adversarial_frame(1000, seed=1, mismatched_stages=1)
+        is_later = mismatched_df['activity_id'].duplicated()
+        stage_types = mismatched_df['activity_stage'].astype(str).str.rsplit("_", n=1).str[0]
+        assert (stage_types[is_later] != mismatched_df['activity_type'][is_later].astype(str)).all()
+        assert (stage_types[~is_later] == mismatched_df['activity_type'][~is_later].astype(str)).all()
+
+        shuffled_df = generator.generate_adversarial_frame(1000, seed=1, duplicate_rows=0.5, shuffle=True)
+        assert len(shuffled_df) > len(generator.generate_frame(1000, seed=1))
+        assert not shuffled_df['activity_id'].is_monotonic_increasing
+
+
+@pytest.mark.parametrize('file_format', ["csv", "parquet"])
+class TestShards:
+    def test_generate_shards(self, file_format, tmp_path):
+        paths = generate_shards("2023-10-01", "2023-10-31", 250, str(tmp_path), seed=1,
+                                users_per_shard=100, workers=2, file_format=file_format)
+        assert [os.path.basename(path) for path in paths] == [f"shard_{i:05d}.{file_format}" for i in range(3)]
+        assert pd.concat([read_activity_logs(path) for path in paths])['user_id'].nunique() <= 250
+
+    def test_generate_shards_workers(self, file_format, tmp_path):
+        paths_1 = generate_shards("2023-10-01", "2023-10-31", 250, str(tmp_path / "1"), seed=1,
+                                  users_per_shard=100, workers=1, file_format=file_format)
+        paths_3 = generate_shards("2023-10-01", "2023-10-31", 250, str(tmp_path / "3"), seed=1,
+                                  users_per_shard=100, workers=3, file_format=file_format)
+        for path_1, path_3 in zip(paths_1, paths_3):
+            pd.testing.assert_frame_equal(read_activity_logs(path_1), read_activity_logs(path_3))
+
+    def test_generate_shards_concat(self, file_format, tmp_path):
+        paths = generate_shards("2023-10-01", "2023-10-31", 250, str(tmp_path), seed=1,
+                                users_per_shard=100, workers=2, file_format=file_format)
+        concat_paths = generate_shards("2023-10-01", "2023-10-31", 250, str(tmp_path), seed=1,
+                                       users_per_shard=100, workers=2, file_format=file_format, concat=True)
+        assert len(concat_paths) == 1
+        df_shards = pd.concat([read_activity_logs(path) for path in paths], ignore_index=True)
+        pd.testing.assert_frame_equal(read_activity_logs(concat_paths[0]), df_shards)
+
+    def test_generate_shards_concat_empty(self, file_format, tmp_path):
+        concat_paths = generate_shards("2023-10-01", "2023-10-31", 0, str(tmp_path), seed=1, workers=1,
+                                       file_format=file_format, concat=True)
+        df_empty = read_activity_logs(concat_paths[0])
+        assert df_empty.empty
+        assert df_empty.dtypes.to_dict() == ACTIVITY_LOG_DTYPES
+
+
+def test_generate_batches():
+    generator = DataGenerator("2023-10-01", "2023-10-31")
+    batches = list(generator.generate_batches(250, batch_users=100, seed=1))
+    assert len(batches) == 3
+    assert batches[-1]['user_id'].nunique() <= 50
+    pd.testing.assert_frame_equal(batches[1], list(generator.generate_batches(250, batch_users=100, seed=1))[1])
+
+
+@pytest.mark.parametrize('file_format', ["csv", "parquet", "feather"])
+def test_stream_records(file_format, tmp_path):
+    # The same records as the shards of generate_shards, in a single file.
+    shard_paths = generate_shards("2023-10-01", "2023-10-31", 250, str(tmp_path / "shards"), seed=1,
+                                  users_per_shard=100, workers=1, file_format=file_format)
+    path = str(tmp_path / f"activity_logs.{file_format}")
+    rows = stream_records("2023-10-01", "2023-10-31", 250, path, seed=1, batch_users=100)
+
+    df_shards = pd.concat([read_activity_logs(shard_path) for shard_path in shard_paths], ignore_index=True)
+    assert rows == len(df_shards)
+    pd.testing.assert_frame_equal(read_activity_logs(path), df_shards)
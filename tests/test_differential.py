@@ -0,0 +1,64 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from activity_processor import ACTIVITIES, ActivityProcessor
+from data_generator import DataGenerator
+
+# Number of random datasets each optimized path is checked on. Set DIFFERENTIAL_CASES to run thousands.
+NUM_CASES = int(os.environ.get("DIFFERENTIAL_CASES", 100))
+
+# Rates of the edge cases injected by `DataGenerator.generate_adversarial_frame`.
+KNOBS = ["duplicate_timestamps", "extra_stages", "missing_scores", "orphan_completes", "null_stages",
+         "duplicate_rows", "mismatched_stages"]
+
+
+def random_case(seed):
+    """Draw the size, edge case rates and record order of a dataset, and generate it."""
+    rng = np.random.default_rng(seed)
+    num_users = int(rng.integers(1, 60, endpoint=True))
+    knobs = {knob: float(rng.choice([0, 0.05, 0.3, 1])) for knob in KNOBS}
+    shuffle = bool(rng.random() < 0.5)
+    df = DataGenerator("2023-01-01", "2023-01-31").generate_adversarial_frame(num_users, seed=seed, shuffle=shuffle,
+                                                                            **knobs)
+    # Half of the datasets with the dtypes inferred from a CSV file instead of the compact schema.
+    if rng.random() < 0.5:
+        df = pd.read_csv(io.StringIO(df.to_csv(index=False)))
+    return df, shuffle
+
+
+@pytest.fixture(params=range(NUM_CASES), ids=lambda seed: f"seed={seed}")
+def case(request):
+    yield random_case(request.param)
+
+
+def test_processor_matches_reference(case):
+    df, _ = case
+    df_before = df.copy()
+    processor = ActivityProcessor()
+
+    results = processor.process_all(df)
+    for activity in ACTIVITIES:
+        df_expected = processor.reference_processor(df, activity)
+        pd.testing.assert_frame_equal(processor.processor(df, activity), df_expected)
+        pd.testing.assert_frame_equal(results[activity], df_expected)
+    pd.testing.assert_frame_equal(df, df_before)
+
+
+def test_process_chunks_matches_whole(case):
+    df, shuffle = case
+    if shuffle:
+        # Chunks only pair up the records of an activity that are next to each other in the file.
+        df = df.sort_values('activity_id', kind='stable')
+    processor = ActivityProcessor()
+    chunksize = 1 + len(df) // 3
+    chunks = [df.iloc[start:start + chunksize] for start in range(0, max(len(df), 1), chunksize)]
+
+    # Activities are never processed before all of their records are read, however many chunks they span.
+    chunk_results = list(processor.process_chunks(chunks, max_carry=len(chunks)))
+    for activity, df_expected in processor.process_all(df).items():
+        df_chunked = pd.concat([results[activity] for results in chunk_results])
+        pd.testing.assert_frame_equal(df_chunked.sort_index(), df_expected.sort_index())
@@ -0,0 +1,121 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+import activity_processor_gcs_trigger
+from activity_io import to_bytes
+from activity_processor import ActivityProcessor
+from batch_sink import FileWriter
+from data_generator import DataGenerator
+from event_worker import EventWorker, read_events, run_worker
+from session_store import SessionStore
+from storage_backend import get_storage
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    monkeypatch.setattr(activity_processor_gcs_trigger, "storage_url", str(tmp_path / "bucket"))
+    monkeypatch.setattr(activity_processor_gcs_trigger, "sink_dir", str(tmp_path / "sink"))
+    bucket = get_storage(str(tmp_path / "bucket"))
+    for seed in range(4):
+        df = DataGenerator("2023-01-01", "2023-01-31").generate_frame(20, seed=seed)
+        bucket.write(f"raw_data/data_{seed}.parquet", to_bytes(df, "parquet"))
+    yield bucket
+
+
+async def stream(events):
+    for event in events:
+        yield event
+
+
+def test_run_worker(bucket, tmp_path):
+    events = [{"bucket": "hom_case_study", "name": f"raw_data/data_{seed}.parquet"} for seed in range(4)]
+    # Duplicate deliveries, and an event of another bucket.
+    events += events[:2] + [{"bucket": "other", "name": "raw_data/data_0.parquet"}]
+
+    stats = asyncio.run(run_worker(stream(events), debounce_seconds=0.05, max_batch_files=3, cpu_workers=0))
+
+    assert stats["events"] == 7
+    assert stats["ingested"] == 4
+    assert stats["failed"] == 0
+    writer = FileWriter(str(tmp_path / "sink" / activity_processor_gcs_trigger.dataset))
+    assert sorted(writer.read_table("processing_logs")['filename']) == [e["name"] for e in events[:4]]
+
+
+def test_worker_sessions(bucket, tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions.parquet")
+    monkeypatch.setattr(activity_processor_gcs_trigger, "session_store_path", path)
+    monkeypatch.setattr(activity_processor_gcs_trigger, "max_open_seconds", 31 * 86400)
+    # The starts of the activities in one file, and their other stages in another, ingested in two batches.
+    df = DataGenerator("2023-01-01", "2023-01-31").generate_frame(20, seed=9)
+    is_start = df['activity_stage'].astype(str).str.endswith("_start")
+    bucket.write("raw_data/starts.parquet", to_bytes(df[is_start], "parquet"))
+    bucket.write("raw_data/stages.parquet", to_bytes(df[~is_start], "parquet"))
+    events = [{"bucket": "hom_case_study", "name": f"raw_data/{name}.parquet"} for name in ["starts", "stages"]]
+
+    stats = asyncio.run(run_worker(stream(events), debounce_seconds=0.05, max_batch_files=1, cpu_workers=0))
+
+    assert stats["ingested"] == 2
+    writer = FileWriter(str(tmp_path / "sink" / activity_processor_gcs_trigger.dataset))
+    assert len(writer.read_table("quiz_table")) == len(ActivityProcessor().process_all(df)["Quiz"])
+    # Only the activities that never finished are left open in the saved store.
+    assert set(SessionStore(path).rows['activity_stage'].str.endswith("_start")) <= {True}
+
+
+def test_worker_skips_ingested(bucket, tmp_path):
+    events = [{"bucket": "hom_case_study", "name": "raw_data/data_0.parquet"}]
+    asyncio.run(run_worker(stream(events), debounce_seconds=0.01, cpu_workers=0))
+
+    # A copy of an ingested file, in a later batch.
+    bucket.write("raw_data/copy.parquet", bucket.read("raw_data/data_0.parquet"))
+    stats = asyncio.run(run_worker(stream([{"bucket": "hom_case_study", "name": "raw_data/copy.parquet"},
+                                           {"bucket": "hom_case_study", "name": "raw_data/missing.parquet"}]),
+                                   debounce_seconds=0.01, cpu_workers=0))
+    assert stats["ingested"] == 0
+    assert stats["skipped"] == 2
+
+
+def test_worker_releases_failed_batch(bucket, tmp_path, monkeypatch):
+    write = FileWriter.write
+    fail = [True]
+
+    def failing_write(self, table_name, df):
+        if fail[0]:
+            raise ConnectionError("Load job failed")
+        return write(self, table_name, df)
+
+    monkeypatch.setattr(FileWriter, "write", failing_write)
+    events = [{"bucket": "hom_case_study", "name": f"raw_data/data_{seed}.parquet"} for seed in range(4)]
+    stats = asyncio.run(run_worker(stream(events), debounce_seconds=0.05, cpu_workers=0))
+    assert stats["ingested"] == 0
+    assert stats["failed"] == 4
+
+    # The rows of the released files were dropped, and their claims released, so they are all retried.
+    fail[0] = False
+    stats = asyncio.run(run_worker(stream(events), debounce_seconds=0.05, cpu_workers=0))
+    assert stats["ingested"] == 4
+    writer = FileWriter(str(tmp_path / "sink" / activity_processor_gcs_trigger.dataset))
+    assert sorted(writer.read_table("processing_logs")['filename']) == [e["name"] for e in events]
+
+
+def test_worker_backpressure():
+    async def submit_all():
+        worker = EventWorker(max_pending=2)
+        await worker.submit({"name": "raw_data/data_0.parquet"})
+        await worker.submit({"name": "raw_data/data_1.parquet"})
+        # The worker is not running, so the queue stays full and the next event waits.
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(worker.submit({"name": "raw_data/data_2.parquet"}), 0.05)
+
+    asyncio.run(submit_all())
+
+
+def test_read_events():
+    f = io.StringIO(json.dumps({"bucket": "b", "name": "n"}) + "\n\n" + json.dumps({"bucket": "b", "name": "m"}))
+
+    async def read_all():
+        return [event async for event in read_events(f)]
+
+    assert asyncio.run(read_all()) == [{"bucket": "b", "name": "n"}, {"bucket": "b", "name": "m"}]
@@ -0,0 +1,42 @@
+import pytest
+
+from file_manifest import FileManifest
+
+
+@pytest.fixture
+def path(tmp_path):
+    yield str(tmp_path / "manifest.json")
+
+
+def test_new_manifest(path):
+    manifest = FileManifest(path)
+    assert not manifest.exists
+    assert manifest.new_files(["raw_data/data_2.csv", "raw_data/data_1.csv"]) == ["raw_data/data_1.csv",
+                                                                                   "raw_data/data_2.csv"]
+
+
+def test_manifest_persists(path):
+    FileManifest(path).add(["raw_data/data_1.csv"])
+
+    manifest = FileManifest(path)
+    assert manifest.exists
+    assert manifest.new_files(["raw_data/data_1.csv", "raw_data/data_2.csv"]) == ["raw_data/data_2.csv"]
+
+
+def test_advance(path):
+    listed = ["raw_data/data_1.csv", "raw_data/data_2.csv", "raw_data/data_3.csv", "raw_data/data_4.csv"]
+    manifest = FileManifest(path)
+    manifest.add(["raw_data/data_1.csv", "raw_data/data_2.csv", "raw_data/data_4.csv"])
+    manifest.advance(listed)
+
+    # The mark stops before the first file that was not ingested, and the index only keeps later files.
+    assert manifest.high_water_mark == "raw_data/data_2.csv"
+    assert manifest.processed == {"raw_data/data_4.csv"}
+
+    manifest = FileManifest(path)
+    assert manifest.new_files(listed + ["raw_data/data_5.csv"]) == ["raw_data/data_3.csv", "raw_data/data_5.csv"]
+
+    manifest.add(["raw_data/data_3.csv"])
+    manifest.advance(listed)
+    assert manifest.high_water_mark == "raw_data/data_4.csv"
+    assert manifest.processed == set()
@@ -0,0 +1,66 @@
+import pytest
+
+from ingestion_ledger import IngestionLedger
+from storage_backend import LocalStorage
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    yield IngestionLedger(LocalStorage(str(tmp_path)))
+
+
+def test_claim_once(ledger):
+    assert ledger.claim("raw_data/data_0.csv", "md5-0") == {"batch_id": "md5-0", "retry": False}
+    # A duplicate event, or a copy of the file under another name, while it is being ingested.
+    assert ledger.claim("raw_data/data_0.csv", "md5-0") is None
+    assert ledger.claim("raw_data/copy.csv", "md5-0") is None
+    assert ledger.claim("raw_data/data_1.csv", "md5-1") == {"batch_id": "md5-1", "retry": False}
+
+
+def test_complete(ledger):
+    ledger.claim("raw_data/data_0.csv", "md5-0")
+    assert not ledger.is_done("md5-0")
+
+    ledger.complete("raw_data/data_0.csv", "md5-0")
+    assert ledger.is_done("md5-0")
+    assert ledger.claim("raw_data/copy.csv", "md5-0") is None
+
+
+def test_release(ledger):
+    ledger.claim("raw_data/data_0.csv", "md5-0")
+    ledger.release("raw_data/data_0.csv", "md5-0")
+
+    assert ledger.claim("raw_data/data_0.csv", "md5-0") == {"batch_id": "md5-0", "retry": True}
+    assert ledger.claim("raw_data/data_0.csv", "md5-0") is None
+
+
+def test_abandoned_claim(ledger):
+    ledger.claim("raw_data/data_0.csv", "md5-0")
+    ledger.claim_seconds = 0
+
+    assert ledger.claim("raw_data/data_0.csv", "md5-0") == {"batch_id": "md5-0", "retry": True}
+
+
+def test_concurrent_takeover(ledger):
+    ledger.claim("raw_data/data_0.csv", "md5-0")
+    ledger.claim_seconds = 0
+    storage = ledger.storage
+    read_generation = storage.read_generation
+
+    def read_then_race(name):
+        # Another worker takes the abandoned claim over between the read and the takeover.
+        result = read_generation(name)
+        storage.read_generation = read_generation
+        assert ledger.claim("raw_data/data_0.csv", "md5-0") == {"batch_id": "md5-0", "retry": True}
+        return result
+
+    storage.read_generation = read_then_race
+    assert ledger.claim("raw_data/data_0.csv", "md5-0") is None
+
+
+def test_release_after_complete(ledger):
+    ledger.claim("raw_data/data_0.csv", "md5-0")
+    ledger.complete("raw_data/data_0.csv", "md5-0")
+    ledger.release("raw_data/data_0.csv", "md5-0")
+
+    assert ledger.storage.list("ingestion_ledger/claims/") == []
@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def imported_modules(code):
+    """Run code in a fresh interpreter, returning the names of the modules it imported."""
+    completed = subprocess.run([sys.executable, "-c", code + "\nimport sys\nprint(' '.join(sys.modules))"],
+                               cwd=ROOT, capture_output=True, text=True, check=True)
+    return set(completed.stdout.split())
+
+
+def test_main_imports_lazily():
+    modules = imported_modules("import main")
+    assert "pandas" not in modules
+    assert "data_generator_gcp" not in modules
+
+
+def test_generator_imports():
+    modules = imported_modules("import data_generator_gcp")
+    # The generator does not load the processing or BigQuery code, nor the clients before their first use.
+    for module in ["activity_processor", "batch_sink", "pandas_gbq", "google.cloud.storage", "fsspec"]:
+        assert module not in modules
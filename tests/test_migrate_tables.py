@@ -0,0 +1,27 @@
+from migrate_tables import migration_queries
+
+
+def test_migration_queries():
+    create, drop, rename = migration_queries(
+        "project.dataset.quiz_table", "quiz_table",
+        ["activity_id", "user_id", "start_timestamp", "status", "score", "ingested_at"])
+
+    assert create == (
+        "create table `project.dataset.quiz_table__migration` partition by start_day cluster by user_id, activity_id"
+        " as select activity_id, user_id, start_timestamp, status, score, cast(ingested_at as TIMESTAMP) as"
+        " ingested_at, date(timestamp_seconds(start_timestamp)) as start_day, cast(null as string) as batch_id"
+        " from `project.dataset.quiz_table`")
+    assert drop == "drop table `project.dataset.quiz_table`"
+    assert rename == "alter table `project.dataset.quiz_table__migration` rename to `quiz_table`"
+
+
+def test_migration_queries_typed_columns():
+    create, _, _ = migration_queries("project.dataset.processing_logs", "processing_logs",
+                                     ["filename", "batch_id", "ingested_at"])
+    assert create == ("create table `project.dataset.processing_logs__migration` as select filename, batch_id,"
+                      " cast(ingested_at as TIMESTAMP) as ingested_at from `project.dataset.processing_logs`")
+
+    create, _, _ = migration_queries("project.dataset.daily_activity_rollup", "daily_activity_rollup",
+                                     ["day", "activity_type", "status", "activities", "batch_id"])
+    assert "partition by day cluster by activity_type, status" in create
+    assert "cast(day as DATE) as day" in create
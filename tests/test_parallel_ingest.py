@@ -0,0 +1,169 @@
+import io
+import threading
+
+import pytest
+import pandas as pd
+
+from activity_io import to_bytes
+from activity_processor import ActivityProcessor
+from activity_schema import apply_schema
+import storage_backend
+from parallel_ingest import file_opener, ingest_files, process_stream
+from result_cache import ResultCache
+from session_store import SessionStore
+
+
+@pytest.fixture(autouse=True)
+def df():
+    df = apply_schema(pd.read_csv("activity_logs_test.csv", sep="\t"))
+    yield df
+
+
+@pytest.fixture
+def files(df):
+    files = {f"raw_data/data_{i}.{file_format}": to_bytes(df, file_format)
+             for i, file_format in enumerate(["csv", "parquet", "feather"])}
+    yield files
+
+
+def opener(files):
+    return lambda file_name: io.BytesIO(files[file_name])
+
+
+def sort_rows(df):
+    return df.sort_values(['activity_id', 'start_timestamp']).reset_index(drop=True)
+
+
+def concat_chunks(chunks):
+    chunks = list(chunks)
+    return {activity: pd.concat([results[activity] for results in chunks]) for activity in chunks[0]}
+
+
+@pytest.mark.parametrize('chunksize', [None, 7])
+def test_process_stream(df, chunksize):
+    chunks = list(process_stream(io.BytesIO(to_bytes(df, "parquet")), "parquet", chunksize))
+    assert (len(chunks) == 1) == (chunksize is None)
+    results = concat_chunks(chunks)
+    expected = ActivityProcessor().process_all(df)
+    for activity, df_expected in expected.items():
+        pd.testing.assert_frame_equal(results[activity].sort_index(), df_expected.sort_index())
+
+
+@pytest.mark.parametrize('cpu_workers,chunksize', [(0, None), (2, None), (0, 7), (2, 7)])
+def test_ingest_files(df, files, cpu_workers, chunksize):
+    uploaded = {}
+    lock = threading.Lock()
+
+    def upload(file_name, chunks):
+        results = concat_chunks(chunks)
+        with lock:
+            uploaded[file_name] = results
+
+    ingested_files, failed_files = ingest_files(list(files), opener(files), upload, io_workers=3,
+                                                cpu_workers=cpu_workers, chunksize=chunksize)
+
+    assert sorted(ingested_files) == sorted(files)
+    assert failed_files == {}
+    expected = ActivityProcessor().process_all(df)
+    for results in uploaded.values():
+        for activity, df_expected in expected.items():
+            pd.testing.assert_frame_equal(results[activity].sort_index(), df_expected.sort_index())
+
+
+@pytest.mark.parametrize('chunksize', [None, 7])
+def test_file_opener(files, chunksize, tmp_path, monkeypatch):
+    storage = storage_backend.LocalStorage(str(tmp_path / "bucket"))
+    for file_name, data in files.items():
+        storage.write(file_name, data)
+    monkeypatch.setattr(storage_backend, "RANGE_SIZE", 1000)
+    ranges = []
+    read_range = storage.read_range
+    monkeypatch.setattr(storage, "read_range", lambda *args: ranges.append(args) or read_range(*args))
+
+    # Files read at once are downloaded in parallel ranges, files read in chunks are streamed.
+    for file_name, data in files.items():
+        with file_opener(storage, chunksize)(file_name) as f:
+            assert f.read() == data
+    assert len(ranges) == (sum(-(-len(data) // 1000) for data in files.values()) if chunksize is None else 0)
+
+
+def test_ingest_files_failures(files):
+    files["raw_data/data_broken.parquet"] = b"not a parquet file"
+    uploaded = []
+
+    def upload(file_name, chunks):
+        for _ in chunks:
+            if "data_1" in file_name:
+                raise ConnectionError("Upload failed")
+        uploaded.append(file_name)
+
+    ingested_files, failed_files = ingest_files(list(files), opener(files), upload, io_workers=2, cpu_workers=0)
+
+    assert sorted(ingested_files) == sorted(uploaded) == ["raw_data/data_0.csv", "raw_data/data_2.feather"]
+    assert sorted(failed_files) == ["raw_data/data_1.parquet", "raw_data/data_broken.parquet"]
+    assert isinstance(failed_files["raw_data/data_1.parquet"], ConnectionError)
+
+
+@pytest.mark.parametrize('cpu_workers', [0, 2])
+def test_ingest_files_metrics(df, files, cpu_workers):
+    metrics = []
+    ingest_files(list(files), opener(files), lambda file_name, chunks: list(chunks), io_workers=3,
+                 cpu_workers=cpu_workers, on_metrics=metrics.append)
+
+    assert sorted(file_metrics["file"] for file_metrics in metrics) == sorted(files)
+    for file_metrics in metrics:
+        assert file_metrics["rows"] == len(df)
+        assert file_metrics["bytes"] == len(files[file_metrics["file"]])
+        assert file_metrics["rows_out"] == sum(len(df) for df in ActivityProcessor().process_all(df).values())
+        assert file_metrics["stages"]["sort_dataframe"]["calls"] == 1
+
+
+def test_ingest_files_sessions(df, tmp_path):
+    # Every activity is split between two files, its start in the first one and its other stages in the second one.
+    is_start = df['activity_stage'].astype(str).str.endswith("_start")
+    files = {"raw_data/data_0.parquet": to_bytes(df[is_start], "parquet"),
+             "raw_data/data_1.parquet": to_bytes(df[~is_start], "parquet")}
+    uploaded = {}
+
+    def upload(file_name, chunks):
+        uploaded[file_name] = concat_chunks(chunks)
+
+    session_store = SessionStore(str(tmp_path / "sessions.parquet"), max_open_seconds=31 * 86400)
+    ingest_files(list(files), opener(files), upload, io_workers=2, cpu_workers=0, session_store=session_store)
+
+    expected = ActivityProcessor().process_all(df)
+    for activity, df_expected in expected.items():
+        df_uploaded = pd.concat([results[activity] for results in uploaded.values()])
+        pd.testing.assert_frame_equal(sort_rows(df_uploaded), sort_rows(df_expected))
+
+
+@pytest.mark.parametrize('hashed', [False, True])
+def test_ingest_files_cache(df, files, tmp_path, hashed):
+    cache = ResultCache(str(tmp_path / "cache"))
+    content_hash = (lambda file_name: f"hash-{file_name}") if hashed else None
+    uploaded = {}
+    opened = []
+
+    def open_file(file_name):
+        opened.append(file_name)
+        return io.BytesIO(files[file_name])
+
+    def upload(file_name, chunks):
+        uploaded.setdefault(file_name, []).append(concat_chunks(chunks))
+
+    metrics = []
+    for _ in range(2):
+        ingest_files(list(files), open_file, upload, io_workers=2, cpu_workers=0, chunksize=7,
+                     on_metrics=metrics.append, cache=cache, content_hash=content_hash)
+
+    # With the content hashes from the storage, the cached files are not even opened.
+    assert len(opened) == (len(files) if hashed else 2 * len(files))
+    assert (cache.hits, cache.misses) == (len(files), len(files))
+    assert [file_metrics["cached"] for file_metrics in metrics] == [False] * len(files) + [True] * len(files)
+    for (results, cached_results) in uploaded.values():
+        for activity, df_result in results.items():
+            pd.testing.assert_frame_equal(cached_results[activity], df_result)
+
+    # Processed with another chunk size, the files miss the cache.
+    ingest_files(list(files), open_file, upload, io_workers=2, cpu_workers=0, cache=cache, content_hash=content_hash)
+    assert cache.misses == 2 * len(files)
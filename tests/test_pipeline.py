@@ -0,0 +1,133 @@
+import shutil
+
+import pytest
+
+import activity_processor_bq
+import activity_processor_gcs_trigger
+import data_generator_gcp
+from activity_io import to_bytes
+from activity_processor import ActivityProcessor
+from batch_sink import FileWriter
+from data_generator import DataGenerator
+from storage_backend import get_storage
+
+
+@pytest.fixture
+def local_pipeline(tmp_path, monkeypatch):
+    bucket_dir = str(tmp_path / "bucket")
+    for module in [data_generator_gcp, activity_processor_bq, activity_processor_gcs_trigger]:
+        monkeypatch.setattr(module, "storage_url", bucket_dir)
+    for module in [activity_processor_bq, activity_processor_gcs_trigger]:
+        monkeypatch.setattr(module, "sink_dir", str(tmp_path / "sink"))
+    monkeypatch.setattr(activity_processor_bq, "manifest_path", str(tmp_path / "manifest.json"))
+    monkeypatch.setattr(activity_processor_bq, "cpu_workers", 0)
+    yield tmp_path
+
+
+def raw_file(tmp_path):
+    """Get the name of the first raw data file in the local bucket."""
+    return get_storage(str(tmp_path / "bucket")).list("raw_data/")[0]
+
+
+def test_activity_process_to_bq(local_pipeline):
+    data_generator_gcp.generate_data()
+
+    assert activity_processor_bq.activity_process_to_bq() == {"Status": "Files ingested: 1", "Failed": 0}
+    assert activity_processor_bq.activity_process_to_bq() == {"Status": "No files to ingest."}
+
+    writer = FileWriter(str(local_pipeline / "sink" / activity_processor_bq.dataset))
+    assert len(writer.read_table("processing_logs")) == 1
+    assert len(writer.read_table("quiz_table")) > 0
+    df_daily = writer.read_table("daily_activity_rollup")
+    assert df_daily.loc[df_daily['activity_type'] == "Quiz", 'activities'].sum() == len(writer.read_table("quiz_table"))
+
+
+@pytest.mark.parametrize('chunk_size', [None, 500000])
+def test_activity_process_gcs_to_bq(local_pipeline, monkeypatch, chunk_size):
+    # Without a chunk size, the file is downloaded at once and processed whole.
+    monkeypatch.setattr(activity_processor_gcs_trigger, "chunk_size", chunk_size)
+    data_generator_gcp.generate_data()
+    file_name = raw_file(local_pipeline)
+
+    activity_processor_gcs_trigger.activity_process_gcs_to_bq({"bucket": "hom_case_study", "name": file_name}, None)
+
+    writer = FileWriter(str(local_pipeline / "sink" / activity_processor_gcs_trigger.dataset))
+    assert writer.read_table("processing_logs")['filename'].tolist() == [file_name]
+    assert len(writer.read_table("video_table")) > 0
+    df_user = writer.read_table("user_daily_activity_rollup")
+    assert df_user.loc[df_user['activity_type'] == "Video", 'activities'].sum() == len(writer.read_table("video_table"))
+
+
+def test_activity_process_gcs_to_bq_sessions(local_pipeline, monkeypatch):
+    monkeypatch.setattr(activity_processor_gcs_trigger, "session_store_path", str(local_pipeline / "sessions.parquet"))
+    monkeypatch.setattr(activity_processor_gcs_trigger, "max_open_seconds", 31 * 86400)
+    # The starts of the activities in one file, and their other stages in the next one.
+    df = DataGenerator("2023-01-01", "2023-01-31").generate_frame(50, seed=4)
+    is_start = df['activity_stage'].astype(str).str.endswith("_start")
+    bucket = get_storage(str(local_pipeline / "bucket"))
+    for file_name, df_file in [("raw_data/starts.parquet", df[is_start]), ("raw_data/stages.parquet", df[~is_start])]:
+        bucket.write(file_name, to_bytes(df_file, "parquet"))
+        activity_processor_gcs_trigger.activity_process_gcs_to_bq({"bucket": "hom_case_study", "name": file_name}, None)
+
+    writer = FileWriter(str(local_pipeline / "sink" / activity_processor_gcs_trigger.dataset))
+    assert len(writer.read_table("video_table")) == len(ActivityProcessor().process_all(df)["Video"]) > 0
+
+
+def test_activity_process_to_bq_lost_manifest(local_pipeline):
+    data_generator_gcp.generate_data()
+    activity_processor_bq.activity_process_to_bq()
+    writer = FileWriter(str(local_pipeline / "sink" / activity_processor_bq.dataset))
+    num_rows = len(writer.read_table("quiz_table"))
+
+    # Without the manifest or the logs, the ledger still knows the contents were ingested.
+    (local_pipeline / "manifest.json").unlink()
+    shutil.rmtree(local_pipeline / "sink" / activity_processor_bq.dataset / "processing_logs")
+    assert activity_processor_bq.activity_process_to_bq() == {"Status": "Files ingested: 0", "Failed": 0}
+    assert len(writer.read_table("quiz_table")) == num_rows
+
+
+def test_activity_process_to_bq_retry(local_pipeline, monkeypatch):
+    data_generator_gcp.generate_data()
+    writer = FileWriter(str(local_pipeline / "sink" / activity_processor_bq.dataset))
+    write = FileWriter.write
+
+    def fail_on_video(self, table_name, df):
+        if table_name == "video_table":
+            raise ConnectionError("Load job failed")
+        write(self, table_name, df)
+
+    # The first attempt writes some of the tables, and fails before logging the file.
+    monkeypatch.setattr(FileWriter, "write", fail_on_video)
+    with pytest.raises(ConnectionError):
+        activity_processor_bq.activity_process_to_bq()
+    num_rows = len(writer.read_table("quiz_table"))
+    assert num_rows > 0
+
+    monkeypatch.setattr(FileWriter, "write", write)
+    assert activity_processor_bq.activity_process_to_bq() == {"Status": "Files ingested: 1", "Failed": 0}
+    assert len(writer.read_table("quiz_table")) == num_rows
+    assert len(writer.read_table("processing_logs")) == 1
+
+
+def test_activity_process_gcs_to_bq_duplicate_event(local_pipeline):
+    data_generator_gcp.generate_data()
+    file_name = raw_file(local_pipeline)
+    event = {"bucket": "hom_case_study", "name": file_name}
+
+    activity_processor_gcs_trigger.activity_process_gcs_to_bq(event, None)
+    assert activity_processor_gcs_trigger.activity_process_gcs_to_bq(event, None) == {
+        "Status": "File already ingested."}
+
+    writer = FileWriter(str(local_pipeline / "sink" / activity_processor_gcs_trigger.dataset))
+    assert writer.read_table("processing_logs")['filename'].tolist() == [file_name]
+
+
+def test_generate_data_stream_file(local_pipeline, monkeypatch):
+    monkeypatch.setattr(data_generator_gcp, "users_per_shard", 50)
+    monkeypatch.setattr(data_generator_gcp, "stream_file", True)
+    monkeypatch.setattr(data_generator_gcp, "batch_users", 30)
+    data_generator_gcp.generate_data()
+
+    assert activity_processor_bq.activity_process_to_bq() == {"Status": "Files ingested: 1", "Failed": 0}
+    writer = FileWriter(str(local_pipeline / "sink" / activity_processor_bq.dataset))
+    assert writer.read_table("processing_logs")['filename'].str.match(r"raw_data/data_\d+\.parquet").all()
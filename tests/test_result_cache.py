@@ -0,0 +1,82 @@
+import os
+
+import pandas as pd
+import pytest
+
+from activity_processor import ActivityProcessor
+from activity_schema import apply_schema
+from result_cache import ResultCache, processor_fingerprint
+
+
+@pytest.fixture
+def results():
+    df = apply_schema(pd.read_csv("activity_logs_test.csv", sep="\t"))
+    yield ActivityProcessor().process_all(df)
+
+
+def test_cache_roundtrip(results, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get("md5-1") is None
+
+    boundaries = pd.DataFrame({"activity_id": [1, 2]})
+    chunks = [{activity: df.iloc[:3] for activity, df in results.items()},
+              {activity: df.iloc[3:] for activity, df in results.items()}]
+    cache.put("md5-1", chunks, boundaries)
+    cached_chunks, cached_boundaries = cache.get("md5-1")
+    # Read back one chunk at a time, in order.
+    for cached_results, chunk_results in zip(cached_chunks, chunks, strict=True):
+        assert sorted(cached_results) == sorted(chunk_results)
+        for activity, df in chunk_results.items():
+            pd.testing.assert_frame_equal(cached_results[activity], df)
+    pd.testing.assert_frame_equal(cached_boundaries, boundaries)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.put("md5-2", [results])
+    assert cache.get("md5-2")[1] is None
+
+
+def test_cache_replaces_incomplete_entry(results, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put("md5-1", [results])
+    cache.put("md5-1", [results])
+    assert cache.get("md5-1")[1] is None
+
+    # An entry cached without the boundary rows is replaced by one with them, but not the other way around.
+    boundaries = pd.DataFrame({"activity_id": [1, 2]})
+    cache.put("md5-1", [results], boundaries)
+    pd.testing.assert_frame_equal(cache.get("md5-1")[1], boundaries)
+    cache.put("md5-1", [results])
+    pd.testing.assert_frame_equal(cache.get("md5-1")[1], boundaries)
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_cache_key():
+    assert ResultCache.key("md5-1", 500000) != ResultCache.key("md5-1")
+
+
+def test_cache_fingerprint(results, tmp_path):
+    ResultCache(str(tmp_path), fingerprint="v1").put("md5-1", [results])
+
+    # Entries of another version of the processing logic are not read.
+    assert ResultCache(str(tmp_path), fingerprint="v2").get("md5-1") is None
+    assert ResultCache(str(tmp_path), fingerprint="v1").get("md5-1") is not None
+    assert ResultCache(str(tmp_path)).fingerprint == processor_fingerprint()
+    assert processor_fingerprint(("activity_processor",)) != processor_fingerprint(("activity_pipeline",))
+
+
+def test_cache_eviction(results, tmp_path):
+    ResultCache(str(tmp_path), fingerprint="v0").put("md5-0", [results])
+    entry_bytes = sum(entry.stat().st_size for entry in os.scandir(tmp_path / "v0-md5-0"))
+    cache = ResultCache(str(tmp_path), max_bytes=int(2.5 * entry_bytes), fingerprint="v1")
+
+    cache.put("md5-1", [results])
+    # Entries of other versions are evicted first.
+    cache.put("md5-2", [results])
+    assert sorted(os.listdir(tmp_path)) == ["v1-md5-1", "v1-md5-2"]
+
+    # Then the least recently used ones.
+    os.utime(tmp_path / "v1-md5-1", (0, 0))
+    os.utime(tmp_path / "v1-md5-2", (1, 1))
+    cache.get("md5-1")
+    cache.put("md5-3", [results])
+    assert sorted(os.listdir(tmp_path)) == ["v1-md5-1", "v1-md5-3"]
@@ -0,0 +1,137 @@
+import pytest
+import pandas as pd
+
+from activity_processor import ActivityProcessor
+from activity_schema import apply_schema
+from data_generator import DataGenerator
+from session_store import SessionStore, boundary_rows, track_boundaries
+
+
+@pytest.fixture(autouse=True)
+def df():
+    df = DataGenerator("2023-01-01", "2023-01-03").generate_frame(3000, seed=2)
+    yield df
+
+
+@pytest.fixture
+def files(df):
+    # Two consecutive files, with some activities started in the first one and finished in the second one.
+    split = int(df['timestamp'].median())
+    yield [df[df['timestamp'] < split], df[df['timestamp'] >= split]]
+
+
+@pytest.fixture
+def path(tmp_path):
+    yield str(tmp_path / "sessions.parquet")
+
+
+def sort_rows(df):
+    return df.sort_values(['activity_id', 'start_timestamp']).reset_index(drop=True)
+
+
+def process_files(files, store):
+    outputs = {}
+    for df_file in files:
+        results = ActivityProcessor().process_all(df_file)
+        pairs = store.join(boundary_rows(df_file))
+        for activity in results:
+            outputs.setdefault(activity, []).extend([results[activity], pairs[activity]])
+    return {activity: sort_rows(pd.concat(dfs)) for activity, dfs in outputs.items()}
+
+
+@pytest.mark.parametrize('part', [0, 1])
+def test_boundary_rows(files, part):
+    df = files[part]
+    df_boundaries = boundary_rows(df)
+    assert len(df_boundaries) > 0
+
+    # The last row of an activity if it is a start, and its first row if it is not.
+    df_sorted = df.sort_values(['activity_type', 'activity_id', 'timestamp'], kind='stable')
+    df_groups = df_sorted.groupby(['activity_type', 'activity_id'], observed=True)
+    df_last, df_first = df_groups.tail(1), df_groups.head(1)
+    df_expected = pd.concat([df_first[~df_first['activity_stage'].str.endswith("_start")],
+                             df_last[df_last['activity_stage'].str.endswith("_start")]]).sort_index()
+    pd.testing.assert_frame_equal(df_boundaries.sort_index(), df_expected)
+
+
+def test_track_boundaries(df):
+    boundaries = []
+    chunks = [df.iloc[start:start + 1000] for start in range(0, len(df), 1000)]
+    assert len(list(track_boundaries(chunks, boundaries))) == len(chunks)
+    # Reduced with each chunk, to the boundary rows of the whole file.
+    pd.testing.assert_frame_equal(boundaries[0].reset_index(drop=True), boundary_rows(df).reset_index(drop=True))
+    assert len(boundaries[0]) < len(df) // 10
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_join_across_files(df, files, path, reverse):
+    store = SessionStore(path, max_open_seconds=7 * 86400)
+    outputs = process_files(files[::-1] if reverse else files, store)
+
+    expected = ActivityProcessor().process_all(df)
+    for activity, df_expected in expected.items():
+        pd.testing.assert_frame_equal(outputs[activity], sort_rows(df_expected))
+    # Only the activities that never finished are left open.
+    assert set(store.rows['activity_stage'].str.endswith("_start")) == {True}
+
+
+def test_store_persists(files, path):
+    store = SessionStore(path, max_open_seconds=7 * 86400)
+    store.join(boundary_rows(files[0]))
+    store.save()
+
+    store = SessionStore(path, max_open_seconds=7 * 86400)
+    assert len(store) > 0
+    pairs = store.join(boundary_rows(files[1]))
+    assert sum(len(df_pairs) for df_pairs in pairs.values()) > 0
+
+
+def test_expiry(files, path):
+    store = SessionStore(path, max_open_seconds=0)
+    store.join(boundary_rows(files[0]))
+    pairs = store.join(boundary_rows(files[1]))
+
+    assert sum(len(df_pairs) for df_pairs in pairs.values()) == 0
+    assert store.expired > 0
+
+
+def test_join_again(files, path):
+    store = SessionStore(path, max_open_seconds=7 * 86400)
+    store.join(boundary_rows(files[0]))
+    # The boundaries of the same file joined again, e.g. by a retry, never pair a start with itself.
+    pairs = store.join(boundary_rows(files[0]))
+    assert sum(len(df_pairs) for df_pairs in pairs.values()) == 0
+
+
+def test_commit_and_discard(files, path):
+    store = SessionStore(path, max_open_seconds=7 * 86400)
+    store.join(boundary_rows(files[0]), file_name="data_0")
+    # Staged, but not saved, until the file is committed.
+    store.save()
+    assert len(SessionStore(path)) == 0
+    store.commit(["data_0"])
+    store.save()
+    assert len(SessionStore(path)) == len(store) > 0
+
+    rows = store.rows
+    pairs = store.join(boundary_rows(files[1]), file_name="data_1")
+    assert sum(len(df_pairs) for df_pairs in pairs.values()) > 0
+    # A discarded file is undone, so that its retry pairs the same rows again.
+    store.discard("data_1")
+    pd.testing.assert_frame_equal(store.rows, rows)
+    retried_pairs = store.join(boundary_rows(files[1]), file_name="data_1")
+    for activity, df_pairs in pairs.items():
+        pd.testing.assert_frame_equal(retried_pairs[activity], df_pairs)
+
+
+def test_join_by_activity_type(df, path):
+    df_logs = apply_schema(pd.DataFrame({
+        "user_id": [1, 1], "activity_id": [5, 5], "activity_type": ["Quiz", "Video"],
+        "activity_stage": ["Quiz_start", "Video_complete"], "timestamp": [1000, 1060],
+        "score": [None, None]}))
+    store = SessionStore(path)
+    store.join(boundary_rows(df_logs.iloc[:1]))
+    # The same id in another activity type is another activity.
+    pairs = store.join(boundary_rows(df_logs.iloc[1:]))
+    assert sum(len(df_pairs) for df_pairs in pairs.values()) == 0
+    assert sorted(store.rows['activity_stage']) == ["Quiz_start", "Video_complete"]
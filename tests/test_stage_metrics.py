@@ -0,0 +1,35 @@
+import json
+
+import pandas as pd
+
+from activity_processor import ActivityProcessor
+from stage_metrics import StageRecorder, emit_metrics, record_reads
+
+
+def test_stage_recorder():
+    df = pd.read_csv("activity_logs_test.csv", sep="\t")
+    recorder = StageRecorder()
+    results = ActivityProcessor(on_stage=recorder).process_all(df)
+
+    totals = recorder.totals()
+    assert list(totals)[:3] == ["encode_activity_type", "filter_activity_type", "sort_dataframe"]
+    # Every activity type is processed in a single pass over the frame.
+    assert totals["filter_activity_type"]["rows_in"] == len(df)
+    assert totals["filter_activity_type"]["calls"] == 1
+    assert totals["extract_status"]["rows_out"] == sum(len(df_act) for df_act in results.values())
+
+
+def test_record_reads():
+    chunks = pd.read_csv("activity_logs_test.csv", sep="\t", chunksize=7)
+    recorder = StageRecorder()
+    num_rows = sum(len(chunk) for chunk in record_reads(chunks, recorder))
+
+    assert recorder.totals()["read"]["rows_out"] == num_rows
+    assert recorder.totals()["read"]["calls"] == len(recorder.records)
+
+
+def test_emit_metrics(capsys):
+    emit_metrics("file_ingested", file="raw_data/data_0.csv", rows=10)
+    entry = json.loads(capsys.readouterr().out)
+    assert entry["message"] == "file_ingested"
+    assert entry["rows"] == 10
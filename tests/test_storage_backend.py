@@ -0,0 +1,105 @@
+import pytest
+
+import storage_backend
+from storage_backend import LocalStorage, Storage, get_storage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    storage.write("raw_data/data_1.csv", b"a,b\n1,2\n")
+    storage.write("raw_data/data_2.csv", b"a,b\n3,4\n")
+    storage.write("other/data_3.csv", b"a,b\n5,6\n")
+    yield storage
+
+
+def test_list(storage):
+    assert storage.list() == ["other/data_3.csv", "raw_data/data_1.csv", "raw_data/data_2.csv"]
+    assert storage.list("raw_data/") == ["raw_data/data_1.csv", "raw_data/data_2.csv"]
+    assert storage.list("raw_data/", start_offset="raw_data/data_2.csv") == ["raw_data/data_2.csv"]
+
+
+def test_read(storage):
+    assert storage.read("raw_data/data_1.csv") == b"a,b\n1,2\n"
+    with pytest.raises(FileNotFoundError):
+        storage.read("raw_data/missing.csv")
+
+
+def test_read_ranges(storage, monkeypatch):
+    data = bytes(range(256)) * 100
+    storage.write("raw_data/large.bin", data)
+    monkeypatch.setattr(storage_backend, "RANGE_SIZE", 1000)
+    assert storage.read("raw_data/large.bin") == data
+
+
+def test_upload_and_open(storage, tmp_path):
+    path = tmp_path / "local.csv"
+    path.write_bytes(b"a,b\n7,8\n")
+    storage.upload("raw_data/sub/data_4.csv", str(path))
+    with storage.open("raw_data/sub/data_4.csv") as f:
+        assert f.read() == b"a,b\n7,8\n"
+
+
+def test_open_for_writing(storage):
+    with storage.open("raw_data/data_5.csv", "wb") as f:
+        f.write(b"a,b\n")
+        # Not visible until it is complete.
+        assert storage.list("raw_data/data_5") == []
+    assert storage.read("raw_data/data_5.csv") == b"a,b\n"
+
+    # An error half-way leaves no file, nor a partial one in place of an earlier version.
+    for name in ["raw_data/data_6.csv", "raw_data/data_5.csv"]:
+        with pytest.raises(ValueError):
+            with storage.open(name, "wb") as f:
+                f.write(b"a,b\n9")
+                raise ValueError("Generation failed")
+    assert storage.list() == ["other/data_3.csv", "raw_data/data_1.csv", "raw_data/data_2.csv", "raw_data/data_5.csv"]
+    assert storage.read("raw_data/data_5.csv") == b"a,b\n"
+
+
+def test_get_storage(tmp_path):
+    assert isinstance(get_storage(f"file://{tmp_path}"), LocalStorage)
+    assert get_storage(str(tmp_path)) is get_storage(str(tmp_path))
+
+
+def test_create_and_delete(storage):
+    assert storage.create("ledger/claim.json", b"first")
+    assert not storage.create("ledger/claim.json", b"second")
+    assert storage.read("ledger/claim.json") == b"first"
+
+    storage.delete("ledger/claim.json")
+    storage.delete("ledger/claim.json")
+    assert storage.create("ledger/claim.json", b"third")
+
+
+def test_content_hash(storage):
+    storage.write("raw_data/copy.csv", b"a,b\n1,2\n")
+    assert storage.content_hash("raw_data/data_1.csv") == storage.content_hash("raw_data/copy.csv")
+    assert storage.content_hash("raw_data/data_1.csv") != storage.content_hash("raw_data/data_2.csv")
+    assert storage.content_hash("raw_data/data_1.csv").startswith("md5-")
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_read_pins_generation(tmp_path, monkeypatch):
+    class VersionedStorage(LocalStorage):
+        def __init__(self, root):
+            super().__init__(root)
+            self.generations = []
+
+        def stat(self, name):
+            return super().stat(name)[0], 7
+
+        def read_range(self, name, start, end, generation=None):
+            self.generations.append(generation)
+            return super().read_range(name, start, end)
+
+    storage = VersionedStorage(str(tmp_path))
+    storage.write("raw_data/large.bin", bytes(range(256)) * 100)
+    monkeypatch.setattr(storage_backend, "RANGE_SIZE", 1000)
+    storage.read("raw_data/large.bin")
+    # Every range is read from the generation the size was read from.
+    assert storage.generations == [7] * 26